@@ -81,6 +81,30 @@ def const_to_python(typ, val):
     else:
         raise IDLError("%r cannot be converted to a python const" % (val,))
 
+def func_priority(func):
+    """returns the priority given to the function by its "priority" annotation,
+    or None if it has none"""
+    for anno in func.annotations:
+        if anno.name == "priority":
+            try:
+                return int(anno.value)
+            except ValueError:
+                raise IDLError("priority of %r must be an integer, not %r" % (func.name, anno.value))
+    return None
+
+def func_oneway(func):
+    """returns whether the function is oneway (by its "oneway" annotation): 
+    its invocations are sent without waiting for a reply, which the server
+    does not send"""
+    for anno in func.annotations:
+        if anno.name == "oneway":
+            if anno.value not in ("true", "false"):
+                raise IDLError("oneway of %r must be 'true' or 'false', not %r" % (func.name, anno.value))
+            if anno.value == "true" and func.type != compiler.t_void:
+                raise IDLError("oneway function %r must return void" % (func.name,))
+            return anno.value == "true"
+    return False
+
 
 class PythonTarget(TargetBase):
     from ..langs import python
@@ -94,6 +118,9 @@ class PythonTarget(TargetBase):
             DOC = module.doc
             
             STMT("import agnos")
+            if "asyncio" in self.options:
+                STMT("import agnos.aio")
+                STMT("import asyncio")
             STMT("from agnos import packers")
             STMT("from agnos import utils")
             STMT("from functools import partial")
@@ -150,6 +177,9 @@ class PythonTarget(TargetBase):
             DOC("client", spacer = True)
             self.generate_client(module, service)
             SEP()
+            if "asyncio" in self.options:
+                self.generate_client(module, service, asynchronous = True)
+                SEP()
 
     def _generate_templated_packer_for_type(self, tp):
         if isinstance(tp, compiler.TList):
@@ -292,10 +322,12 @@ class PythonTarget(TargetBase):
             for method in cls.all_methods:
                 if not method.clientside:
                     continue
-                args = ", ".join(arg.name for arg in method.args)
-                with BLOCK("def {0}(self, {1})", method.name, args):
-                    callargs = ["self"] + [arg.name for arg in method.args]
+                args = [arg.name for arg in method.args]
+                with BLOCK("def {0}(self, {1})", method.name, ", ".join(args + ["_timeout = None"])):
+                    callargs = ["self"] + args + ["_timeout"]
                     STMT("return self._client._funcs.sync_{0}({1})", method.func.id, ", ".join(callargs))
+                with BLOCK("def {0}_async(self, {1})", method.name, ", ".join(args + ["_timeout = None"])):
+                    STMT("return self._client._funcs.async_{0}({1})", method.func.id, ", ".join(callargs))
             if cls.all_derived:
                 SEP()
                 DOC("downcasts")
@@ -318,7 +350,9 @@ class PythonTarget(TargetBase):
             for member in service.funcs.values():
                 if isinstance(member, compiler.Func):
                     args = ", ".join(arg.name for arg in member.args)
-                    with BLOCK("def {0}(self, {1})", member.fullname, args):
+                    with BLOCK("{0}def {1}(self, {2})", 
+                            "async " if "asyncio" in self.options else "", 
+                            member.fullname, args):
                         STMT("raise NotImplementedError()")
 
     def generate_processor(self, module, service):
@@ -352,6 +386,13 @@ class PythonTarget(TargetBase):
                         STMT("{0} : (_func_{0}, _unpack_{0}, {1}),", 
                             func.id, type_to_packer(func.type))
                 SEP()
+                priorities = [(func.id, func_priority(func)) for func in service.funcs.values()]
+                priorities = [(id, prio) for id, prio in priorities if prio]
+                if priorities:
+                    with BLOCK("self.func_priorities = ", prefix = "{", suffix = "}"):
+                        for id, prio in priorities:
+                            STMT("{0} : {1},", id, prio)
+                    SEP()
                 with BLOCK("self.packed_exceptions = ", prefix = "{", suffix = "}"):
                     for exc in service.exceptions():
                         STMT("{0} : {1},", exc.name, type_to_packer(exc))
@@ -369,6 +410,12 @@ class PythonTarget(TargetBase):
                     STMT('info["COMPRESSION_SUPPORTED"] = False')
                 with BLOCK("else"):
                     STMT('info["COMPRESSION_SUPPORTED"] = True')
+                STMT('info.add("COMPRESSION_CODECS", packers.Str, agnos.supported_codecs(), packers.list_of_str)')
+                STMT('info["CHUNKED_FRAMES_SUPPORTED"] = True')
+                STMT('info["DEADLINES_SUPPORTED"] = True')
+                STMT('info["BATCH_SUPPORTED"] = True')
+                STMT('info["ONEWAY_SUPPORTED"] = True')
+                STMT('info.add("WIRE_FORMATS", packers.Str, list(self.transport.supported_wire_formats()), packers.list_of_int32)')
                 STMT('info["IMPLEMENTATION"] = "libagnos-python"')
                 STMT('codes = {}')
                 STMT('codes["INFO_META"] = agnos.INFO_META')
@@ -399,7 +446,7 @@ class PythonTarget(TargetBase):
                     if func.annotations:
                         with BLOCK("anno = ", prefix = "{", suffix = "}"):
                             for anno in func.annotations:
-                                STMT('"{0}" : "{1}",', anno.name, repr(anno.value))
+                                STMT('"{0}" : {1},', anno.name, repr(anno.value))
                         STMT('funcinfo.add("annotations", packers.Str, anno, packers.map_of_str_str)')
             SEP()
             ######
@@ -442,7 +489,7 @@ class PythonTarget(TargetBase):
                         if attr.annotations:
                             with BLOCK("anno = ", prefix = "{", suffix = "}"):
                                 for anno in attr.annotations:
-                                    STMT('"{0}" : "{1}",', anno.name, repr(anno.value))
+                                    STMT('"{0}" : {1},', anno.name, repr(anno.value))
                             STMT('a.add("annotations", packers.Str, anno, packers.map_of_str_str)')
                     for meth in cls.methods:
                         STMT('m = meth_group.new_map("{0}")', meth.name)
@@ -451,7 +498,7 @@ class PythonTarget(TargetBase):
                         if meth.annotations:
                             with BLOCK("anno = ", prefix = "{", suffix = "}"):
                                 for anno in meth.annotations:
-                                    STMT('"{0}" : "{1}",', anno.name, repr(anno.value))
+                                    STMT('"{0}" : {1},', anno.name, repr(anno.value))
                             STMT('m.add("annotations", packers.Str, anno, packers.map_of_str_str)')
                         STMT("arg_names = []")
                         STMT("arg_types = []")
@@ -471,7 +518,7 @@ class PythonTarget(TargetBase):
                     if func.annotations:
                         with BLOCK("anno = ", prefix = "{", suffix = "}"):
                             for anno in func.annotations:
-                                STMT('"{0}" : "{1}",', anno.name, repr(anno.value))
+                                STMT('"{0}" : {1},', anno.name, repr(anno.value))
                         STMT('func.add("annotations", packers.Str, anno, packers.map_of_str_str)')
                     STMT("arg_names = []")
                     STMT("arg_types = []")
@@ -490,6 +537,13 @@ class PythonTarget(TargetBase):
         SEP()
         with BLOCK("def ProcessorFactory(handler, exception_map = {})"):
             STMT("return lambda transport: Processor(transport, handler, exception_map)")
+        if "asyncio" in self.options:
+            SEP()
+            with BLOCK("class AsyncProcessor(agnos.aio.AsyncProcessorMixin, Processor)"):
+                STMT("pass")
+            SEP()
+            with BLOCK("def AsyncProcessorFactory(handler, exception_map = {})"):
+                STMT("return lambda transport: AsyncProcessor(transport, handler, exception_map)")
     
     def _generate_processor_function(self, module, func):
         BLOCK = module.block
@@ -525,28 +579,49 @@ class PythonTarget(TargetBase):
                 for arg in func.args:
                     STMT("{0}.unpack(self.transport),", type_to_packer(arg.type))
     
-    def generate_client(self, module, service):
+    def generate_client(self, module, service, asynchronous = False):
         BLOCK = module.block
         STMT = module.stmt
         SEP = module.sep
 
+        if asynchronous:
+            # the functions return awaitables; connect with 
+            # `await AsyncClient.connect(...)`
+            with BLOCK("class AsyncClient(agnos.aio.BaseAsyncClient)"):
+                with BLOCK("def __init__(self, transport)"):
+                    self.generate_client_ctor(module, service, asynchronous)
+                SEP()
+                self._generate_client_funcs(module, service)
+                SEP()
+                self.generate_client_helpers(module, service, asynchronous)
+            return
         with BLOCK("class Client(agnos.BaseClient)"):
-            with BLOCK("def __init__(self, transport, checked)"):
+            with BLOCK("def __init__(self, transport, checked, multiplexed = False)"):
                 self.generate_client_ctor(module, service)
                 SEP()
                 with BLOCK("if checked"):
                     STMT("self.assert_service_compatibility()")
             SEP()
-            for func in service.funcs.values():
-                if not isinstance(func, compiler.Func) or func.namespace or not func.clientside:
-                    continue
-                args = ", ".join(arg.name for arg in func.args)
-                with BLOCK("def {0}(_self, {1})", func.name, args):
-                    STMT("return _self._funcs.sync_{0}({1})", func.id, args)
+            self._generate_client_funcs(module, service)
             SEP()
             self.generate_client_helpers(module, service)
 
-    def generate_client_ctor(self, module, service):
+    def _generate_client_funcs(self, module, service):
+        BLOCK = module.block
+        STMT = module.stmt
+        
+        funcs = [func for func in service.funcs.values() 
+            if isinstance(func, compiler.Func) and not func.namespace and func.clientside]
+        # the functions that a batch (agnos.Batch) makes available
+        STMT("_functions = frozenset([{0}])", ", ".join('"%s"' % (func.name,) for func in funcs))
+        for func in funcs:
+            args = [arg.name for arg in func.args]
+            with BLOCK("def {0}(_self, {1})", func.name, ", ".join(args + ["_timeout = None"])):
+                STMT("return _self._funcs.sync_{0}({1})", func.id, ", ".join(args + ["_timeout"]))
+            with BLOCK("def {0}_async(_self, {1})", func.name, ", ".join(args + ["_timeout = None"])):
+                STMT("return _self._funcs.async_{0}({1})", func.id, ", ".join(args + ["_timeout"]))
+
+    def generate_client_ctor(self, module, service, asynchronous = False):
         BLOCK = module.block
         STMT = module.stmt
         SEP = module.sep
@@ -555,7 +630,11 @@ class PythonTarget(TargetBase):
             self.generate_record_packer(module, rec)
             SEP()
         STMT("packed_exceptions = {}")
-        STMT("self._utils = agnos.ClientUtils(transport, packed_exceptions)")
+        if asynchronous:
+            STMT("self._utils = agnos.aio.AsyncClientUtils(transport, packed_exceptions)")
+        else:
+            STMT("utils_class = agnos.MultiplexedClientUtils if multiplexed else agnos.ClientUtils")
+            STMT("self._utils = utils_class(transport, packed_exceptions)")
         SEP()
         STMT("storer = lambda proxy: -1 if proxy is None else proxy._objref")
         for cls in service.classes():
@@ -577,20 +656,37 @@ class PythonTarget(TargetBase):
         with BLOCK("class Functions(object)"):
             with BLOCK("def __init__(self, utils)"):
                 STMT("self.utils = utils")
-                STMT("self.lock = threading.Lock()")
+                if not asynchronous:
+                    STMT("self.lock = utils.call_lock()")
             for func in service.funcs.values():
-                args = ", ".join(arg.name for arg in func.args)
-                with BLOCK("def sync_{0}(_self, {1})", func.id, args):
-                    with BLOCK("with _self.lock"):
-                        with BLOCK("with _self.utils.invocation({0}, {1}) as seq", 
-                                func.id, type_to_packer(func.type)):
-                            if not func.args:
-                                STMT("pass")
-                            else:
-                                for arg in func.args:
-                                    STMT("{0}.pack({1}, _self.utils.transport)", 
-                                        type_to_packer(arg.type), arg.name)
-                        STMT("return _self.utils.get_reply(seq)")
+                # the timeout (in seconds) is also sent to the server, as the
+                # deadline of the invocation
+                args = ", ".join([arg.name for arg in func.args] + ["_timeout = None"])
+                callargs = ", ".join([arg.name for arg in func.args] + ["_timeout"])
+                if func_oneway(func):
+                    # only the request is sent; both variants return as soon
+                    # as it has been written
+                    self._generate_oneway_funcs(module, func, args, asynchronous)
+                elif asynchronous:
+                    # same names as the synchronous functions, so that the 
+                    # proxies serve both clients; these are coroutines, 
+                    # and any number of them may await their replies at once
+                    with BLOCK("async def sync_{0}(_self, {1})", func.id, args):
+                        self._generate_client_invocation(module, func)
+                        STMT("return await _self.utils.get_reply(seq, _timeout)")
+                    with BLOCK("def async_{0}(_self, {1})", func.id, args):
+                        STMT("return asyncio.ensure_future(_self.sync_{0}({1}))", func.id, callargs)
+                else:
+                    with BLOCK("def sync_{0}(_self, {1})", func.id, args):
+                        with BLOCK("with _self.lock"):
+                            self._generate_client_invocation(module, func)
+                            STMT("return _self.utils.get_reply(seq, _timeout)")
+                    # sends the request and returns a ReplyFuture, whose 
+                    # reply is received later, under the same lock
+                    with BLOCK("def async_{0}(_self, {1})", func.id, args):
+                        with BLOCK("with _self.lock"):
+                            self._generate_client_invocation(module, func)
+                        STMT("return agnos.ReplyFuture(_self.utils, seq, _self.lock, _timeout)")
         SEP()
         STMT("self._funcs = Functions(self._utils)")
         SEP()
@@ -611,14 +707,58 @@ class PythonTarget(TargetBase):
             head, tail = (const.namespace + "." + const.name).split(".", 1)
             STMT("self.{0}['{1}'] = {2}", head, tail, const_to_python(const.type, const.value))        
 
-    def generate_client_helpers(self, module, service):
+    def _generate_oneway_funcs(self, module, func, args, asynchronous):
+        BLOCK = module.block
+        STMT = module.stmt
+        
+        if asynchronous:
+            with BLOCK("async def sync_{0}(_self, {1})", func.id, args):
+                self._generate_oneway_invocation(module, func)
+                STMT("await _self.utils.transport.flush()")
+            with BLOCK("def async_{0}(_self, {1})", func.id, args):
+                STMT("return asyncio.ensure_future(_self.sync_{0}({1}))", func.id, 
+                    ", ".join([arg.name for arg in func.args] + ["_timeout"]))
+        else:
+            for name in ["sync", "async"]:
+                with BLOCK("def {0}_{1}(_self, {2})", name, func.id, args):
+                    self._generate_oneway_invocation(module, func)
+
+    def _generate_oneway_invocation(self, module, func):
+        BLOCK = module.block
+        STMT = module.stmt
+        
+        with BLOCK("with _self.utils.oneway_invocation({0}) as seq", func.id):
+            if not func.args:
+                STMT("pass")
+            for arg in func.args:
+                STMT("{0}.pack({1}, _self.utils.transport)", 
+                    type_to_packer(arg.type), arg.name)
+
+    def _generate_client_invocation(self, module, func):
+        BLOCK = module.block
+        STMT = module.stmt
+        
+        with BLOCK("with _self.utils.invocation({0}, {1}, _timeout) as seq", 
+                func.id, type_to_packer(func.type)):
+            if not func.args:
+                STMT("pass")
+            else:
+                for arg in func.args:
+                    STMT("{0}.pack({1}, _self.utils.transport)", 
+                        type_to_packer(arg.type), arg.name)
+
+    def generate_client_helpers(self, module, service, asynchronous = False):
         BLOCK = module.block
         STMT = module.stmt
         SEP = module.sep
 
-        with BLOCK("def assert_service_compatibility(self)"):
-            STMT("meta_info = self.get_service_info(agnos.INFO_META)")
-            STMT("service_info = self.get_service_info(agnos.INFO_SERVICE)")
+        if asynchronous:
+            prefix, await_ = "async ", "await "
+        else:
+            prefix, await_ = "", ""
+        with BLOCK("{0}def assert_service_compatibility(self)", prefix):
+            STMT("meta_info = {0}self.get_service_info(agnos.INFO_META)", await_)
+            STMT("service_info = {0}self.get_service_info(agnos.INFO_SERVICE)", await_)
             
             with BLOCK('if meta_info["AGNOS_PROTOCOL_VERSION"] != AGNOS_PROTOCOL_VERSION'):
                 STMT('''raise agnos.WrongAgnosVersion("expected protocol '%s' found '%s'" % '''
@@ -630,6 +770,10 @@ class PythonTarget(TargetBase):
                 STMT('supported_versions = service_info.get("SUPPORTED_VERSIONS", None)')
                 with BLOCK('if not supported_versions or CLIENT_VERSION not in supported_versions'):
                     STMT('''raise agnos.IncompatibleServiceVersion("server does not support client version '%s'" % (CLIENT_VERSION,))''')
+            STMT("{0}self._utils.negotiate_wire_format(meta_info)", await_)
+            STMT('self._utils.deadlines_supported = meta_info.get("DEADLINES_SUPPORTED", False)')
+            STMT('self._utils.batches_supported = meta_info.get("BATCH_SUPPORTED", False)')
+            STMT('self._utils.oneway_supported = meta_info.get("ONEWAY_SUPPORTED", False)')
 
 
 
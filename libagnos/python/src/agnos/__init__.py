@@ -24,15 +24,21 @@ This library is usually used by code generated by the Agnos compiler;
 End-user code may use it to import various transports, exceptions classes,
 and constants.
 """
-from .transports import Transport, TransportFactory
-from .transports import SocketTransport, SocketTransportFactory, ProcTransport
+from .transports import Transport, TransportFactory, TransportTimeout
+from .transports import SocketTransport, SocketTransportFactory, ProcTransport, ProcPool
+from .transports import UnixSocketTransport, UnixSocketTransportFactory
+from .transports import SharedMemoryTransport, SharedMemoryTransportFactory
 from .httptransport import HttpClientTransport
 
 from .protocol import BaseRecord, BaseProxy, BaseClient, ClientUtils, BaseProcessor, Namespace
-from .protocol import ProtocolError, PackedException, GenericException
+from .protocol import MultiplexedClientUtils, ReplyFuture, gather, wait_all
+from .protocol import Batch, BatchResult, ClientPool
+from .protocol import ProtocolError, PackedException, GenericException, ServerOverloaded
+from .protocol import AdmissionControl, remaining_time
 from .packers import PackingError
 from .protocol import WrongAgnosVersion, WrongServiceName, IncompatibleServiceVersion
 from .protocol import INFO_META, INFO_SERVICE, INFO_FUNCTIONS, INFO_REFLECTION
 
 from .utils import HeteroMap, Enum
+from .compression import supported_codecs
 
@@ -0,0 +1,555 @@
+##############################################################################
+# Part of the Agnos RPC Framework
+#    http://agnos.sourceforge.net
+#
+# Copyright 2011, International Business Machines Corp.
+#                 Author: Tomer Filiba (tomerf@il.ibm.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+"""
+asyncio runtime (python 3.7+). messages are received and sent as a whole by
+the event loop, while framing, compression and (un)packing are done in memory
+by the regular (synchronous) Transport, so that the same packers serve both
+worlds. to use it, generate the bindings with the "asyncio" option (e.g.,
+``agnosc -t python -O asyncio``), which provides AsyncProcessorFactory and
+AsyncClient, and lets the handler's methods be coroutines
+"""
+import os
+import sys
+import socket
+import asyncio
+import inspect
+from optparse import OptionParser
+from .transports import Transport
+from .protocol import ClientUtils, ProtocolError, INFO_META, CMD_PING
+from . import protocol
+from . import transports
+from .packers import Int8, Str
+from .utils import Logger, LogSink, NullLogger
+from . import compression
+from . import servers
+
+
+class StreamFile(object):
+    """
+    the file of an AsyncTransport: incoming data is buffered (by feed) until
+    it makes up whole messages, which are then read without blocking; data
+    written is collected until taken (by take)
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._rbuf = bytearray()
+        self._rstart = 0
+        self._wbuf = []
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+    def fileno(self):
+        return self.writer.get_extra_info("socket").fileno()
+    def flush(self):
+        pass
+
+    def pending(self):
+        """returns the number of bytes already received but not yet read"""
+        return len(self._rbuf) - self._rstart
+    def poll(self, timeout = None):
+        return self.pending() > 0
+    def peek(self):
+        return self._rbuf, self._rstart, len(self._rbuf)
+
+    def feed(self, data):
+        """appends received data to the buffer"""
+        if self._rstart and self._rstart >= len(self._rbuf) // 2:
+            # compact the buffer, rather than have it grow forever
+            del self._rbuf[:self._rstart]
+            self._rstart = 0
+        self._rbuf += data
+
+    def read(self, count):
+        start = self._rstart
+        end = min(start + count, len(self._rbuf))
+        if count > 0 and end == start:
+            raise EOFError()
+        self._rstart = end
+        return bytes(self._rbuf[start:end])
+
+    def write(self, data):
+        self._wbuf.append(bytes(data))
+    def writev(self, buffers):
+        for buf in buffers:
+            self.write(buf)
+
+    def take(self):
+        """returns (and clears) the data written so far"""
+        data = b"".join(self._wbuf)
+        del self._wbuf[:]
+        return data
+
+
+class AsyncTransport(Transport):
+    """
+    a transport over asyncio streams. the synchronous transaction API works on
+    the messages already received (see receive) and on the send buffer (see
+    flush); no transaction ever spans an await, so they need no locking
+    beyond that of Transport
+    """
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, reader, writer):
+        streamfile = StreamFile(reader, writer)
+        Transport.__init__(self, streamfile, streamfile)
+        sock = writer.get_extra_info("socket")
+        self._family = sock.family if sock is not None else None
+    def __repr__(self):
+        return "<AsyncTransport %s>" % (self.infile.writer.get_extra_info("peername")
+            if self.infile and self.infile.writer else "(closed)",)
+
+    def _get_compression_threshold(self):
+        if self._family in (socket.AF_INET, getattr(socket, "AF_INET6", None)):
+            return 4 * 1024
+        return -1
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+    @classmethod
+    async def connect_unix(cls, path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    async def receive(self):
+        """waits until (at least) one whole message has been received. raises
+        EOFError if the other party closes the connection"""
+        streamfile = self.infile
+        while not self.has_complete_message():
+            data = await streamfile.reader.read(self.READ_SIZE)
+            if not data:
+                raise EOFError("the other party has closed")
+            streamfile.feed(data)
+
+    async def flush(self):
+        """sends the messages written so far"""
+        streamfile = self.outfile
+        data = streamfile.take()
+        if data:
+            streamfile.writer.write(data)
+            await streamfile.writer.drain()
+
+
+class AsyncProcessorMixin(object):
+    """
+    makes a (generated) processor asynchronous: invocations run as tasks of
+    the event loop, awaiting the handler when it returns an awaitable, so the
+    processor goes on with the following requests in the meantime. replies
+    are sent as soon as they are ready, not necessarily in order. all the
+    other commands are processed in order
+    """
+
+    @property
+    def executor(self):
+        return self
+
+    def submit(self, func, *args):
+        """the executor interface (see BaseProcessor.executor)"""
+        tasks = self.__dict__.setdefault("_tasks", set())
+        task = asyncio.ensure_future(func(*args))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    async def _execute(self, seq, invocation, queued_at, deadline):
+        funcid, func, args, res_packer = invocation
+        try:
+            late = self._past_deadline(deadline)
+            if late:
+                outcome = None
+            elif self.admission is not None and self.admission.expired(queued_at):
+                self.logger.info("    queue time budget exceeded")
+                outcome = None
+            else:
+                outcome = await self._call(func, args, deadline)
+            with self.transport.writing(seq):
+                if late:
+                    self.send_deadline_exceeded()
+                elif outcome is None:
+                    self.send_overloaded("queue time budget exceeded")
+                else:
+                    # BaseProcessor.invoke takes care of the reply, or its exception
+                    self._handle(self.invoke, outcome, args, res_packer)
+            await self.transport.flush()
+        except Exception:
+            # the connection is probably gone; there's no one to reply to
+            self.logger.exception()
+        finally:
+            self._release()
+
+    async def _execute_oneway(self, seq, invocation, queued_at, deadline):
+        funcid, func, args, res_packer = invocation
+        try:
+            if self.admission is not None and self.admission.expired(queued_at):
+                self.logger.info("    queue time budget exceeded, dropped")
+            else:
+                # BaseProcessor.invoke_oneway logs the exception, if any
+                self.invoke_oneway(await self._call(func, args, None), args)
+        finally:
+            self._release()
+
+    async def _execute_batch(self, seq, invocations, queued_at):
+        try:
+            if self.admission is not None and self.admission.expired(queued_at):
+                self.logger.info("    queue time budget exceeded")
+                reply = None
+            else:
+                # in order, each awaited before the next one begins
+                outcomes = []
+                for funcid, func, args, res_packer in invocations:
+                    outcome = await self._call(func, args, None)
+                    outcomes.append((funcid, outcome, args, res_packer))
+                # BaseProcessor.invoke_batch takes care of the replies
+                reply = self.invoke_batch(outcomes)
+            with self.transport.writing(seq):
+                if reply is None:
+                    self.send_overloaded("queue time budget exceeded")
+                else:
+                    self.transport.write(reply)
+            await self.transport.flush()
+        except Exception:
+            # the connection is probably gone; there's no one to reply to
+            self.logger.exception()
+        finally:
+            self._release()
+
+    async def _call(self, func, args, deadline):
+        """calls the (possibly asynchronous) function, returning a 
+        replacement function that gives the same outcome synchronously"""
+        # the task runs in a context of its own, so this is seen only by
+        # remaining_time() calls on behalf of this invocation
+        protocol._deadline.set(deadline)
+        try:
+            res = func(args)
+            if inspect.isawaitable(res):
+                res = await res
+        except Exception:
+            exc = sys.exc_info()[1]
+            def outcome(args):
+                raise exc
+        else:
+            def outcome(args):
+                return res
+        return outcome
+
+    async def serve(self):
+        """serves the connection until the client disconnects (or quits)"""
+        transport = self.transport
+        try:
+            while True:
+                await transport.receive()
+                while transport.has_complete_message():
+                    self.process()
+                await transport.flush()
+        except EOFError:
+            self.logger.info("got EOF")
+        except KeyboardInterrupt:
+            # CMD_QUIT
+            self.logger.info("got quit")
+        finally:
+            for task in list(self.__dict__.get("_tasks", ())):
+                task.cancel()
+            self.close()
+
+
+class AsyncClientUtils(ClientUtils):
+    """
+    ClientUtils for an AsyncTransport, where get_reply (and whatever returns
+    its result) is a coroutine. replies are received by a single task, on
+    behalf of all the coroutines awaiting them, so any number of requests
+    can be in flight at the same time
+    """
+
+    def __init__(self, transport, packed_exceptions):
+        ClientUtils.__init__(self, transport, packed_exceptions)
+        self._waiters = {}
+        self._receiver = None
+
+    def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        ClientUtils.close(self)
+
+    async def _receive(self):
+        transport = self.transport
+        try:
+            while any(not w.done() for w in self._waiters.values()):
+                await transport.receive()
+                while transport.has_complete_message():
+                    self.process_incoming(0)
+                for seq, waiter in list(self._waiters.items()):
+                    if not waiter.done() and self.is_reply_ready(seq):
+                        waiter.set_result(None)
+        except Exception as ex:
+            for waiter in self._waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(ex)
+        finally:
+            self._receiver = None
+
+    async def wait_reply(self, seq, timeout = None):
+        await self.transport.flush()
+        if not self.is_reply_ready(seq):
+            waiter = self._waiters[seq] = asyncio.get_running_loop().create_future()
+            if self._receiver is None:
+                self._receiver = asyncio.ensure_future(self._receive())
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                self.discard_reply(seq)
+                raise
+            finally:
+                del self._waiters[seq]
+        return self.replies.pop(seq)
+
+    async def get_reply(self, seq, timeout = None):
+        tp, obj = await self.wait_reply(seq, timeout)
+        if tp == self.REPLY_SLOT_SUCCESS:
+            return obj
+        elif tp == self.REPLY_SLOT_ERROR:
+            raise obj
+        else:
+            raise ValueError("invalid reply slot type: %r" % (seq,))
+
+    # the methods of ClientUtils that do more than return get_reply(...)
+
+    async def ping(self, payload, timeout):
+        seq = self.seq.next()
+        with self.transport.writing(seq):
+            Int8.pack(CMD_PING, self.transport)
+            Str.pack(payload, self.transport)
+        self.replies[seq] = (self.REPLY_SLOT_EMPTY, Str)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        payload2 = await self.get_reply(seq, timeout)
+        dt = loop.time() - t0
+        if payload2 != payload:
+            raise ProtocolError("ping reply does not match payload")
+        return dt
+
+    async def enable_compression(self, codecs = None, level = None, adaptive = False):
+        meta_info = await self.get_service_info(INFO_META)
+        if not meta_info.get("COMPRESSION_SUPPORTED", False):
+            return False
+        peer_codecs = meta_info.get("COMPRESSION_CODECS", None)
+        if peer_codecs is None:
+            return self.transport.enabled_compression(["zlib"], level, adaptive)
+        if codecs is None:
+            codecs = compression.supported_codecs()
+        codec = compression.negotiate([c for c in codecs if c in peer_codecs])
+        if codec is None or not self.transport.enabled_compression([codec.NAME],
+                level, adaptive):
+            return False
+        return await self.set_compression(codec.NAME)
+
+    async def enable_chunking(self, chunk_size = None):
+        meta_info = await self.get_service_info(INFO_META)
+        if not meta_info.get("CHUNKED_FRAMES_SUPPORTED", False):
+            return False
+        if chunk_size is None:
+            chunk_size = Transport.CHUNK_SIZE
+        if not self.transport.enable_chunking(chunk_size):
+            return False
+        return await self.set_chunking(chunk_size)
+
+    async def negotiate_wire_format(self, meta_info):
+        peer_formats = meta_info.get("WIRE_FORMATS", None) or [1]
+        common = [v for v in self.transport.supported_wire_formats()
+            if v in peer_formats]
+        version = max(common) if common else 1
+        if version != self.transport.wire_format and await self.set_wire_format(version):
+            self.transport.set_wire_format(version)
+        return self.transport.wire_format
+
+
+class BaseAsyncClient(object):
+    """the base class of the generated AsyncClient. connect with
+    ``await AsyncClient.connect(...)``; the service's functions (and the
+    methods and attributes of proxies) are then awaitable"""
+
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *args):
+        self.close()
+
+    @classmethod
+    async def _connect(cls, transport, checked):
+        client = cls(transport)
+        if checked:
+            try:
+                await client.assert_service_compatibility()
+            except Exception:
+                client.close()
+                raise
+        return client
+    @classmethod
+    async def connect(cls, host, port, checked = True):
+        return await cls._connect(await AsyncTransport.connect(host, port), checked)
+    @classmethod
+    async def connect_unix(cls, path, checked = True):
+        return await cls._connect(await AsyncTransport.connect_unix(path), checked)
+
+    def close(self):
+        self._utils.close()
+    def get_service_info(self, code):
+        return self._utils.get_service_info(code)
+    def enable_compression(self, codecs = None, level = None, adaptive = False):
+        return self._utils.enable_compression(codecs, level, adaptive)
+    def enable_chunking(self, chunk_size = None):
+        return self._utils.enable_chunking(chunk_size)
+
+
+class AsyncServer(object):
+    """
+    an Agnos server where all the clients are served by the event loop. the
+    processor factory is expected to create asynchronous processors (such as
+    the generated AsyncProcessorFactory does)
+    """
+
+    def __init__(self, processor_factory, logger = NullLogger):
+        self.processor_factory = processor_factory
+        self.logger = logger.sublogger("srv")
+        self.server = None
+        self.path = None
+        self.host = None
+        self.port = None
+
+    async def start(self, host = "localhost", port = 0):
+        self.server = await asyncio.start_server(self._handle_client, host, port)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        self.logger.info("started serving on %s:%s", self.host, self.port)
+
+    async def start_unix(self, path):
+        """listens on a unix-domain socket; as with the library mode, `host`
+        is the path and `port` is 0. the socket file is removed when the
+        server is closed"""
+        sock = transports._listen_unix(path, 100)
+        self.server = await asyncio.start_unix_server(self._handle_client, sock = sock)
+        self.path = path
+        self.host, self.port = path, 0
+        self.logger.info("started serving on %s", path)
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.close()
+        self.server = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def _handle_client(self, reader, writer):
+        transport = AsyncTransport(reader, writer)
+        self.logger.info("accepted %s", transport)
+        processor = self.processor_factory(transport)
+        processor.logger = self.logger.sublogger("proc")
+        try:
+            await processor.serve()
+        except Exception:
+            self.logger.exception()
+
+    async def serve(self):
+        """serves until cancelled"""
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def serve_library_mode(self):
+        """the library mode (see servers.LibraryModeServer): writes the
+        server's details to stdout, and serves a single connection"""
+        done = asyncio.get_running_loop().create_future()
+        handle_client = self._handle_client
+        async def handle_single_client(reader, writer):
+            self.close()
+            try:
+                await handle_client(reader, writer)
+            finally:
+                done.set_result(None)
+        self._handle_client = handle_single_client
+        sys.stdout.write("AGNOS\n%s\n%d\n\n" % (self.host, self.port))
+        sys.stdout.flush()
+        sys.stdout.close()
+        await done
+
+
+def server_main(processor_factory, mode = "async", port = 0, host = "localhost",
+        logfile = ".server.log", unix = None, max_in_flight = 0, 
+        max_in_flight_per_connection = 0, max_queue_time = 0):
+    """the asyncio counterpart of servers.server_main; the modes are "async"
+    and "lib" (library mode)"""
+    parser = OptionParser(conflict_handler="resolve")
+    parser.add_option("-m", "--mode", dest="mode", default=mode,
+                      help="server mode (async, lib)", metavar="MODE")
+    parser.add_option("-p", "--port", dest="port", default=port,
+                      help="tcp port number; 0 = random port", metavar="PORT")
+    parser.add_option("-h", "--host", dest="host", default=host,
+                      help="host to bind", metavar="HOST")
+    parser.add_option("-l", "--log", dest="logfile", default=None,
+                      help="log file to write to", metavar="FILENAME")
+    parser.add_option("-u", "--unix", dest="unix", default=unix,
+                      help="unix-domain socket to bind (instead of tcp)", metavar="PATH")
+    servers._add_admission_options(parser, max_in_flight, max_in_flight_per_connection,
+        max_queue_time)
+
+    options, args = parser.parse_args()
+    if args:
+        parser.error("server does not take positional arguments")
+    options.mode = options.mode.lower()
+    if options.mode not in ("async", "lib", "library"):
+        parser.error("invalid mode: %r" % (options.mode,))
+    if options.mode == "async" and int(options.port) == 0 and not options.unix:
+        parser.error("must specify port for %s mode" % (options.mode,))
+
+    if options.logfile:
+        logger = Logger(LogSink([open(options.logfile, "w")]))
+    elif logfile:
+        logger = Logger(LogSink([open(logfile, "w")]))
+    else:
+        logger = NullLogger
+    admission = servers._admission_from_options(options)
+    if admission is not None:
+        processor_factory = servers._admission_factory(processor_factory, admission)
+
+    async def main():
+        s = AsyncServer(processor_factory, logger)
+        if options.unix:
+            await s.start_unix(options.unix)
+        else:
+            await s.start(options.host, int(options.port))
+        try:
+            if options.mode == "async":
+                await s.serve()
+            else:
+                await s.serve_library_mode()
+        finally:
+            s.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
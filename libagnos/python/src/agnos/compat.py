@@ -23,3 +23,108 @@ else:
 
 
 
+
+try:
+    import selectors
+except ImportError:
+    # a minimal stand-in for the selectors module (python 3.4+), which 
+    # provides the subset of DefaultSelector used by libagnos, on top of 
+    # epoll (where available) or select
+    import select as _select
+    from collections import namedtuple as _namedtuple
+    
+    class selectors(object):
+        EVENT_READ = 1
+        EVENT_WRITE = 2
+        SelectorKey = _namedtuple("SelectorKey", ["fileobj", "fd", "events", "data"])
+        
+        class EpollSelector(object):
+            def __init__(self):
+                self._epoll = _select.epoll()
+                self._keys = {}
+            def _mask(self, events):
+                mask = 0
+                if events & selectors.EVENT_READ:
+                    mask |= _select.EPOLLIN
+                if events & selectors.EVENT_WRITE:
+                    mask |= _select.EPOLLOUT
+                return mask
+            def register(self, fileobj, events, data = None):
+                key = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+                self._epoll.register(key.fd, self._mask(events))
+                self._keys[key.fd] = key
+                return key
+            def modify(self, fileobj, events, data = None):
+                key = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+                self._epoll.modify(key.fd, self._mask(events))
+                self._keys[key.fd] = key
+                return key
+            def unregister(self, fileobj):
+                key = self._keys.pop(fileobj.fileno())
+                self._epoll.unregister(key.fd)
+                return key
+            def select(self, timeout = None):
+                ready = []
+                for fd, mask in self._epoll.poll(-1 if timeout is None else timeout):
+                    key = self._keys.get(fd)
+                    if key is None:
+                        continue
+                    events = 0
+                    if mask & (_select.EPOLLIN | _select.EPOLLHUP | _select.EPOLLERR):
+                        events |= selectors.EVENT_READ
+                    if mask & (_select.EPOLLOUT | _select.EPOLLHUP | _select.EPOLLERR):
+                        events |= selectors.EVENT_WRITE
+                    ready.append((key, events & key.events))
+                return ready
+            def close(self):
+                self._epoll.close()
+                self._keys.clear()
+        
+        class SelectSelector(object):
+            def __init__(self):
+                self._keys = {}
+            def register(self, fileobj, events, data = None):
+                key = selectors.SelectorKey(fileobj, fileobj.fileno(), events, data)
+                self._keys[key.fd] = key
+                return key
+            modify = register
+            def unregister(self, fileobj):
+                return self._keys.pop(fileobj.fileno())
+            def select(self, timeout = None):
+                rlist = [fd for fd, key in self._keys.items() if key.events & selectors.EVENT_READ]
+                wlist = [fd for fd, key in self._keys.items() if key.events & selectors.EVENT_WRITE]
+                rlist, wlist, _ = _select.select(rlist, wlist, [], timeout)
+                ready = {}
+                for fd in rlist:
+                    ready[fd] = selectors.EVENT_READ
+                for fd in wlist:
+                    ready[fd] = ready.get(fd, 0) | selectors.EVENT_WRITE
+                return [(self._keys[fd], events) for fd, events in ready.items()]
+            def close(self):
+                self._keys.clear()
+        
+        if hasattr(_select, "epoll"):
+            DefaultSelector = EpollSelector
+        else:
+            DefaultSelector = SelectSelector
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # a minimal stand-in for contextvars.ContextVar (python 3.7+), where 
+    # each thread has its own context
+    import threading as _threading
+    
+    class ContextVar(object):
+        def __init__(self, name, default = None):
+            self.name = name
+            self._default = default
+            self._local = _threading.local()
+        def get(self):
+            return getattr(self._local, "value", self._default)
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+        def reset(self, token):
+            self._local.value = token
@@ -0,0 +1,319 @@
+##############################################################################
+# Part of the Agnos RPC Framework
+#    http://agnos.sourceforge.net
+#
+# Copyright 2011, International Business Machines Corp.
+#                 Author: Tomer Filiba (tomerf@il.ibm.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##############################################################################
+"""
+compression codecs. a compressed frame does not name its codec; instead, the
+codec is detected by the magic prefix of the compressed data, which all the
+supported formats have, among the codecs that have been negotiated (zlib, 
+which parties may use without negotiating, is always accepted). the 
+compression level only concerns the compressing side, so it is not negotiated
+"""
+try:
+    import zlib
+except ImportError:
+    zlib = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+class CompressionError(IOError):
+    pass
+
+class Codec(object):
+    """a compression codec (compressor) with a given compression level"""
+    NAME = None
+    MODULE = None
+    MAGIC = None
+    DEFAULT_LEVEL = None
+    LEVELS = ()
+
+    def __init__(self, level = None):
+        if level is None:
+            level = self.DEFAULT_LEVEL
+        elif level not in self.LEVELS:
+            raise ValueError("invalid %s compression level: %r" % (self.NAME, level))
+        self.level = level
+    def __repr__(self):
+        return "<%s codec, level %r>" % (self.NAME, self.level)
+
+    @classmethod
+    def is_supported(cls):
+        """returns whether this codec is available on this platform"""
+        return cls.MODULE is not None
+    @classmethod
+    def matches(cls, data):
+        """returns whether the given compressed data was produced by this codec"""
+        return data[:len(cls.MAGIC)] == cls.MAGIC
+
+    def compress(self, data):
+        raise NotImplementedError()
+    @classmethod
+    def decompress(cls, data):
+        raise NotImplementedError()
+    @classmethod
+    def decompressobj(cls):
+        """returns a new incremental decompressor of the underlying module"""
+        raise NotImplementedError()
+    @classmethod
+    def decompressor(cls):
+        """returns a new, output-bounded Decompressor"""
+        return Decompressor(cls.decompressobj())
+
+class NoneCodec(Codec):
+    """the 'none' codec: negotiating it means data is not to be compressed"""
+    NAME = "none"
+    MODULE = True
+    MAGIC = None
+
+    @classmethod
+    def matches(cls, data):
+        return False
+    def compress(self, data):
+        return data
+    @classmethod
+    def decompress(cls, data):
+        return data
+
+class ZlibCodec(Codec):
+    NAME = "zlib"
+    MODULE = zlib
+    DEFAULT_LEVEL = 6
+    LEVELS = range(0, 10)
+
+    @classmethod
+    def matches(cls, data):
+        # RFC 1950: CM (low nibble of CMF) is 8 and CMF*256 + FLG is a
+        # multiple of 31
+        head = bytearray(data[:2])
+        return len(head) == 2 and (head[0] & 0x0f) == 8 and \
+            (head[0] * 256 + head[1]) % 31 == 0
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+    @classmethod
+    def decompress(cls, data):
+        return zlib.decompress(data)
+    @classmethod
+    def decompressobj(cls):
+        return zlib.decompressobj()
+
+class Bz2Codec(Codec):
+    NAME = "bz2"
+    MODULE = bz2
+    MAGIC = b"BZh"
+    DEFAULT_LEVEL = 9
+    LEVELS = range(1, 10)
+
+    @classmethod
+    def is_supported(cls):
+        # python 2's decompressor cannot bound its output, which would let 
+        # the other party inflate a small frame without limit
+        return bz2 is not None and hasattr(bz2.BZ2Decompressor(), "needs_input")
+    def compress(self, data):
+        return bz2.compress(data, self.level)
+    @classmethod
+    def decompress(cls, data):
+        return bz2.decompress(data)
+    @classmethod
+    def decompressobj(cls):
+        return bz2.BZ2Decompressor()
+
+class LzmaCodec(Codec):
+    NAME = "lzma"
+    MODULE = lzma
+    MAGIC = b"\xfd7zXZ\x00"
+    DEFAULT_LEVEL = 6
+    LEVELS = range(0, 10)
+
+    def compress(self, data):
+        return lzma.compress(data, preset = self.level)
+    @classmethod
+    def decompress(cls, data):
+        return lzma.decompress(data)
+    @classmethod
+    def decompressobj(cls):
+        return lzma.LZMADecompressor()
+
+
+class Decompressor(object):
+    """
+    a uniform interface to the incremental decompressors of zlib, bz2 and 
+    lzma, whose output is bounded: decompress() never returns more than 
+    max_length bytes, and keeps the rest of the work for the next calls 
+    (whenever needs_input is False, decompress() must be called with no 
+    new data). decompressors that cannot bound their output are refused
+    """
+    
+    def __init__(self, obj):
+        if not hasattr(obj, "unconsumed_tail") and not hasattr(obj, "needs_input"):
+            raise CompressionError("%s cannot bound its output" % (type(obj).__name__,))
+        self.obj = obj
+        # zlib: the compressed input that has not been consumed yet
+        self.tail = b""
+        # zlib: the output of flush(), once there is no more input
+        self.leftover = b""
+        self._zlib = hasattr(obj, "unconsumed_tail")
+    
+    @property
+    def needs_input(self):
+        if self.tail or self.leftover:
+            return False
+        return getattr(self.obj, "needs_input", True)
+    
+    def decompress(self, data, max_length):
+        if self.leftover:
+            output = self.leftover[:max_length]
+            self.leftover = self.leftover[max_length:]
+            return output
+        if self._zlib:
+            if self.tail:
+                data = self.tail + data if data else self.tail
+            output = self.obj.decompress(data, max_length)
+            self.tail = self.obj.unconsumed_tail
+            return output
+        return self.obj.decompress(data, max_length)
+    
+    def finish(self):
+        """called when there is no more input; makes any output the 
+        decompressor still holds available to decompress()"""
+        if self._zlib and not self.tail:
+            self.leftover = self.obj.flush()
+
+
+# in order of preference
+CODECS = [ZlibCodec, LzmaCodec, Bz2Codec, NoneCodec]
+CODECS_BY_NAME = dict((cls.NAME, cls) for cls in CODECS)
+# the number of bytes needed to detect the codec of compressed data
+MAGIC_LENGTH = max(len(cls.MAGIC) for cls in CODECS if cls.MAGIC)
+
+def supported_codecs():
+    """returns the names of the codecs supported by this platform, in order
+    of preference"""
+    return [cls.NAME for cls in CODECS if cls.is_supported()]
+
+def get_codec(name, level = None):
+    """returns a codec instance by its name"""
+    try:
+        cls = CODECS_BY_NAME[name]
+    except KeyError:
+        raise CompressionError("unknown codec %r" % (name,))
+    if not cls.is_supported():
+        raise CompressionError("codec %r is not supported on this platform" % (name,))
+    return cls(level)
+
+def negotiate(peer_codecs, level = None):
+    """returns an instance of the first codec in `peer_codecs` (the codecs the
+    other party supports, in order of preference) that is also supported
+    locally, or None if there is no such codec"""
+    for name in peer_codecs:
+        cls = CODECS_BY_NAME.get(name)
+        if cls is not None and cls.is_supported():
+            return cls(level)
+    return None
+
+def detect_codec(data, codecs = None):
+    """returns the codec class that produced the given compressed data, 
+    among the given codec classes (by default, all the supported ones)"""
+    for cls in CODECS:
+        if codecs is not None and cls not in codecs:
+            continue
+        if cls.is_supported() and cls.matches(data):
+            return cls
+    raise CompressionError("compressed data of unknown (or not negotiated) format")
+
+
+class _SizeClassStats(object):
+    __slots__ = ["ratio", "cost", "enabled", "samples", "skipped"]
+    def __init__(self):
+        self.ratio = 1.0
+        self.cost = 0.0
+        self.enabled = True
+        self.samples = 0
+        self.skipped = 0
+
+class AdaptiveCompression(object):
+    """
+    a compression policy that learns whether compressing pays off. frames are
+    grouped into size classes (powers of two); for each class, the policy 
+    keeps a moving average of the compression ratio and of the compression 
+    time per byte. compression remains enabled for a class as long as the 
+    time it saves on the wire (at the given bandwidth, in bytes per second) 
+    is greater than the time it costs. frames of a disabled class are 
+    sampled again every PROBE_INTERVAL frames, to follow changes in the data
+    """
+    PROBE_INTERVAL = 64
+    WEIGHT = 0.25
+    
+    def __init__(self, bandwidth = 10 * 1024 * 1024):
+        self.bandwidth = float(bandwidth)
+        self.classes = {}
+        self.counters = dict(frames = 0, compressed = 0, skipped = 0, 
+            probes = 0, incompressible = 0, bytes_in = 0, bytes_out = 0)
+    
+    def should_compress(self, length):
+        """returns whether a frame of the given length should be compressed"""
+        self.counters["frames"] += 1
+        stats = self.classes.get(length.bit_length())
+        if stats is None or stats.enabled:
+            return True
+        stats.skipped += 1
+        if stats.skipped >= self.PROBE_INTERVAL:
+            stats.skipped = 0
+            self.counters["probes"] += 1
+            return True
+        self.counters["skipped"] += 1
+        return False
+    
+    def record(self, length, compressed_length, elapsed):
+        """records a sample: a frame of `length` bytes that took `elapsed` 
+        seconds to compress into `compressed_length` bytes"""
+        sizeclass = length.bit_length()
+        stats = self.classes.get(sizeclass)
+        if stats is None:
+            stats = self.classes[sizeclass] = _SizeClassStats()
+        ratio = float(compressed_length) / length
+        cost = float(elapsed) / length
+        if stats.samples == 0:
+            stats.ratio = ratio
+            stats.cost = cost
+        else:
+            stats.ratio += self.WEIGHT * (ratio - stats.ratio)
+            stats.cost += self.WEIGHT * (cost - stats.cost)
+        stats.samples += 1
+        stats.enabled = (1.0 - stats.ratio) / self.bandwidth > stats.cost
+        self.counters["compressed"] += 1
+        self.counters["bytes_in"] += length
+        self.counters["bytes_out"] += min(compressed_length, length)
+        if compressed_length >= length:
+            self.counters["incompressible"] += 1
+    
+    def get_stats(self):
+        """returns the counters, and the learned ratio, cost (seconds per 
+        megabyte) and decision of each size class (keyed by the class' upper
+        bound, in bytes)"""
+        stats = dict(self.counters)
+        stats["classes"] = dict((2 ** sizeclass, dict(ratio = cls.ratio, 
+                cost = cls.cost * 2 ** 20, enabled = cls.enabled, samples = cls.samples))
+            for sizeclass, cls in self.classes.items())
+        return stats
@@ -50,6 +50,8 @@ class HttpRequest(object):
 
 
 class HttpClientTransport(Transport):
+    SUPPORTED_WIRE_FORMATS = (1,)
+    
     def __init__(self, url):
         Transport.__init__(self, None, None)
         self.url = url
@@ -77,6 +79,10 @@ class HttpClientTransport(Transport):
         req["Content-type"] = "application/octet-stream"
         return req
 
+    def enable_chunking(self, chunk_size = None):
+        # each message is sent as a single http request
+        return False
+
     def begin_read(self, timeout = None):
         if not self.infile:
             raise IOError("begin_read must be called only after end_write")
@@ -89,7 +95,7 @@ class HttpClientTransport(Transport):
 
     def end_write(self):
         self._assert_wlock()
-        data = "".join(self._write_buffer)
+        data = b"".join(self._write_buffer)
         del self._write_buffer[:]
         if data:
             outstream = StringIO()
@@ -20,8 +20,16 @@
 
 from struct import Struct as _Struct
 from datetime import datetime, timedelta
-from .utils import HeteroMap
+from .utils import HeteroMap, pack_varint, read_varint
 import time
+try:
+    xrange
+except NameError:
+    xrange = range
+try:
+    long
+except NameError:
+    long = int
 
 
 class PackingError(Exception):
@@ -42,28 +50,53 @@ class Packer(object):
         raise NotImplementedError()
 
 class PrimitivePacker(Packer):
-    __slots__ = ["id", "struct"]
-    def __init__(self, id, fmt):
+    """
+    a packer of a fixed-size primitive. integer packers (`varint` is True) 
+    encode their values as varints on streams that use wire format 2 or 
+    above (see Transport.wire_format)
+    """
+    __slots__ = ["id", "struct", "varint", "min", "max"]
+    def __init__(self, id, fmt, varint = False):
         self.id = id
         self.struct = _Struct(fmt)
+        self.varint = varint
+        bits = self.struct.size * 8
+        self.min = -(1 << (bits - 1))
+        self.max = (1 << (bits - 1)) - 1
     def get_id(self):
         return self.id
     def pack(self, obj, stream):
         if obj is None:
             obj = 0
-        try:
-            data = self.struct.pack(obj)
-        except (TypeError, ValueError) as ex:
-            raise PackingError(ex)
+        if self.varint and getattr(stream, "wire_format", 1) >= 2:
+            try:
+                if not self.min <= obj <= self.max:
+                    raise ValueError("integer out of range: %r" % (obj,))
+                data = pack_varint(int(obj))
+            except (TypeError, ValueError) as ex:
+                raise PackingError(ex)
+        else:
+            try:
+                data = self.struct.pack(obj)
+            except (TypeError, ValueError) as ex:
+                raise PackingError(ex)
         stream.write(data)
     def unpack(self, stream):
+        if self.varint and getattr(stream, "wire_format", 1) >= 2:
+            if hasattr(stream, "unpack_varint"):
+                return stream.unpack_varint()
+            return read_varint(stream)
+        if hasattr(stream, "unpack_struct"):
+            return stream.unpack_struct(self.struct)[0]
         data = stream.read(self.struct.size)
         return self.struct.unpack(data)[0]
 
 Int8 = PrimitivePacker(1, "!b")
-Int16 = PrimitivePacker(3, "!h")
-Int32 = PrimitivePacker(4, "!l")
-Int64 = PrimitivePacker(5, "!q")
+Int16 = PrimitivePacker(3, "!h", varint = True)
+Int32 = PrimitivePacker(4, "!l", varint = True)
+Int64 = PrimitivePacker(5, "!q", varint = True)
+# dates are (large) integers too, but varints would only make them longer
+_FixedInt64 = PrimitivePacker(5, "!q")
 Float = PrimitivePacker(6, "!d")
 
 class Bool(Packer):
@@ -122,10 +155,10 @@ class Date(Packer):
 
     @classmethod
     def pack(cls, obj, stream):
-        Int64.pack(cls.datetime_to_usec(obj), stream)
+        _FixedInt64.pack(cls.datetime_to_usec(obj), stream)
     @classmethod
     def unpack(cls, stream):
-        return cls.usec_to_datetime(Int64.unpack(stream))
+        return cls.usec_to_datetime(_FixedInt64.unpack(stream))
 
 class Buffer(Packer):
     ID = 7
@@ -22,13 +22,17 @@ import sys
 import traceback
 import weakref
 import time
+from timeit import default_timer
+import threading
 from . import utils
 from contextlib import contextmanager
+from functools import partial
 from .packers import Int8, Int32, Int64, Str, Bool, BuiltinHeteroMapPacker 
 from .packers import PackingError
-from .compat import icount
+from .compat import icount, ContextVar
 from . import transports
 from . import httptransport
+from . import compression
 
 
 CMD_PING = 0
@@ -39,11 +43,18 @@ CMD_INCREF = 4
 CMD_GETINFO = 5
 CMD_CHECK_CAST = 6
 CMD_QUERY_PROXY_TYPE = 7
+CMD_SET_COMPRESSION = 8
+CMD_SET_CHUNKING = 9
+CMD_SET_WIRE_FORMAT = 10
+CMD_INVOKE_DEADLINE = 11
+CMD_BATCH = 12
+CMD_INVOKE_ONEWAY = 13
 
 REPLY_SUCCESS = 0
 REPLY_PROTOCOL_ERROR = 1
 REPLY_PACKED_EXCEPTION = 2
 REPLY_GENERIC_EXCEPTION = 3
+REPLY_OVERLOADED = 4
 
 INFO_META = 0
 INFO_SERVICE = 1
@@ -51,6 +62,20 @@ INFO_FUNCTIONS = 2
 INFO_REFLECTION = 3
 
 
+# the deadline (in terms of default_timer) of the invocation being carried out
+_deadline = ContextVar("agnos_deadline", default = None)
+
+def remaining_time():
+    """returns the number of seconds left until the deadline of the invocation
+    being carried out (in the handler's thread or task), or None if the 
+    client has not set one. it may be negative, when the client has already
+    given up on the invocation"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - default_timer()
+
+
 class BaseRecord(object):
     def __eq__(self, other):
         return type(other) == type(self) and self.__dict__ == other.__dict__
@@ -78,6 +103,17 @@ class GenericException(Exception):
 class ProtocolError(Exception):
     pass
 
+class ServerOverloaded(Exception):
+    """the server has turned the request down, as it is overloaded (see 
+    AdmissionControl). the request has not been carried out, so it is safe
+    to retry it, preferably after `retry_after` seconds"""
+    def __init__(self, msg, retry_after):
+        Exception.__init__(self, msg, retry_after)
+        self.msg = msg
+        self.retry_after = retry_after
+    def __str__(self):
+        return "%s (retry after %s seconds)" % (self.msg, self.retry_after)
+
 class WrongAgnosVersion(ProtocolError):
     pass
 class WrongServiceName(ProtocolError):
@@ -86,6 +122,24 @@ class IncompatibleServiceVersion(ProtocolError):
     pass
 
 
+class _BufferStream(object):
+    """a write-only stream that holds the message it is given, for a 
+    message that is part of a larger one (a batch)"""
+    def __init__(self, wire_format):
+        self.wire_format = wire_format
+        self.chunks = []
+    def write(self, data):
+        self.chunks.append(data)
+    def mark(self):
+        return len(self.chunks)
+    def rewind(self, mark):
+        del self.chunks[mark:]
+    def clear(self):
+        del self.chunks[:]
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
 class BaseProxy(object):
     __slots__ = ["_client", "_objref", "_disposed", "__weakref__"]
     def __init__(self, client, objref, owns_ref):
@@ -110,7 +164,11 @@ class BaseProxy(object):
         if self._disposed:
             return
         self._disposed = True
-        self._client._utils.decref(self._objref)
+        try:
+            self._client._utils.decref(self._objref)
+        except ReferenceError:
+            # the client is gone, and the server has dropped its objects
+            pass
         self._client = None
         self._objref = None
     
@@ -118,11 +176,96 @@ class BaseProxy(object):
         return self._client._utils.get_proxy_type(self._objref)
 
 
+class AdmissionControl(object):
+    """
+    limits the invocations a server carries out at the same time: in total
+    (`max_in_flight`) and per connection (`max_in_flight_per_connection`). 
+    invocations beyond these limits, as well as deferred invocations (see 
+    BaseProcessor.executor) that have waited longer than `max_queue_time` 
+    seconds to start, are turned down right away with REPLY_OVERLOADED, which
+    tells the client to retry after `retry_after` seconds. an instance is 
+    shared by all the processors it applies to (see BaseProcessor.admission)
+    """
+    
+    def __init__(self, max_in_flight = None, max_in_flight_per_connection = None, 
+            max_queue_time = None, retry_after = 0.1):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_connection = max_in_flight_per_connection
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self.counters = dict(admitted = 0, rejected = 0, expired = 0)
+    
+    def admit(self, processor):
+        """returns whether an invocation of the given processor may start; 
+        if so, release() must be called once it is done"""
+        with self._lock:
+            if (self.max_in_flight and self.in_flight >= self.max_in_flight) or \
+                    (self.max_in_flight_per_connection and 
+                    processor._in_flight >= self.max_in_flight_per_connection):
+                self.counters["rejected"] += 1
+                return False
+            self.in_flight += 1
+            processor._in_flight += 1
+            self.counters["admitted"] += 1
+            return True
+    
+    def release(self, processor):
+        with self._lock:
+            self.in_flight -= 1
+            processor._in_flight -= 1
+    
+    def expired(self, queued_at):
+        """returns whether a deferred invocation, queued at the given time 
+        (in terms of default_timer), has run out of its queue time budget"""
+        if self.max_queue_time is None:
+            return False
+        if default_timer() - queued_at <= self.max_queue_time:
+            return False
+        with self._lock:
+            self.counters["expired"] += 1
+        return True
+    
+    def get_stats(self):
+        """returns the counters, and the number of invocations in flight"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = self.in_flight
+        return stats
+
+
+# the errors of a request that are replied to the client (see 
+# BaseProcessor._handle)
+_REPLIED_ERRORS = (ProtocolError, GenericException, PackingError, PackedException, 
+    transports.MessageAborted)
+
 class BaseProcessor(object):
+    # whether replies are compressed adaptively, once the client enables 
+    # compression (see transports.Transport.enabled_compression)
+    adaptive_compression = True
+    # when set (to a concurrent.futures-like executor), invocations are 
+    # carried out by the executor, while the processor goes on reading the 
+    # following requests. replies are then sent as soon as they are ready,
+    # not necessarily in the order of the requests
+    executor = None
+    # when set to an AdmissionControl, invocations are subject to its limits
+    admission = None
+    
     def __init__(self, transport):
         self.transport = transport
+        # the priorities of the functions, by function id (set by the 
+        # generated code from the functions' "priority" annotations; 0 by 
+        # default). an executor with a submit_prioritized method (see 
+        # servers.PriorityExecutor) carries out the invocations of higher 
+        # priorities first
+        self.func_priorities = {}
         self.cells = {}
+        self._cells_lock = threading.Lock()
         self.logger = utils.NullLogger
+        self._next_wire_format = None
+        # the number of admitted invocations in flight (see AdmissionControl)
+        self._in_flight = 0
     
     def close(self):
         self.transport.close()
@@ -139,11 +282,12 @@ class BaseProcessor(object):
         if obj is None:
             return -1
         oid = id(obj)
-        if oid in self.cells:
-            ref = self.cells[oid][0]
-        else:
-            ref = 0
-        self.cells[oid] = (ref + 1, obj)
+        with self._cells_lock:
+            if oid in self.cells:
+                ref = self.cells[oid][0]
+            else:
+                ref = 0
+            self.cells[oid] = (ref + 1, obj)
         return oid
     
     def load(self, oid):
@@ -152,76 +296,269 @@ class BaseProcessor(object):
         return self.cells[oid][1]
     
     def decref(self, oid):
-        if oid not in self.cells:
-            return
-        ref, obj = self.cells[oid]
-        if ref <= 1:
-            del self.cells[oid]
-        else:
-            self.cells[oid] = (ref - 1, obj)
+        with self._cells_lock:
+            if oid not in self.cells:
+                return
+            ref, obj = self.cells[oid]
+            if ref <= 1:
+                del self.cells[oid]
+            else:
+                self.cells[oid] = (ref - 1, obj)
 
     def incref(self, oid):
-        if oid not in self.cells:
-            return
-        ref, obj = self.cells[oid]
-        self.cells[oid] = (ref + 1, obj)
+        with self._cells_lock:
+            if oid not in self.cells:
+                return
+            ref, obj = self.cells[oid]
+            self.cells[oid] = (ref + 1, obj)
 
-    def send_protocol_error(self, exc):
-        Int8.pack(REPLY_PROTOCOL_ERROR, self.transport)
-        Str.pack(str(exc), self.transport)
+    # the send_xxx methods write to the transport, unless given another 
+    # stream (the reply of an invocation within a batch)
+    def send_protocol_error(self, exc, stream = None):
+        if stream is None:
+            stream = self.transport
+        Int8.pack(REPLY_PROTOCOL_ERROR, stream)
+        Str.pack(str(exc), stream)
     
-    def send_generic_exception(self, exc): 
-        Int8.pack(REPLY_GENERIC_EXCEPTION, self.transport)
-        Str.pack(exc.msg, self.transport)
-        Str.pack(exc.traceback, self.transport)
+    def send_generic_exception(self, exc, stream = None): 
+        if stream is None:
+            stream = self.transport
+        Int8.pack(REPLY_GENERIC_EXCEPTION, stream)
+        Str.pack(exc.msg, stream)
+        Str.pack(exc.traceback, stream)
 
-    def send_packed_exception(self, exc): 
-        Int8.pack(REPLY_PACKED_EXCEPTION, self.transport)
-        Int32.pack(exc._idl_id, self.transport)
+    def send_packed_exception(self, exc, stream = None): 
+        if stream is None:
+            stream = self.transport
+        Int8.pack(REPLY_PACKED_EXCEPTION, stream)
+        Int32.pack(exc._idl_id, stream)
         packer = self.packed_exceptions[type(exc)]
-        packer.pack(exc, self.transport)
+        packer.pack(exc, stream)
+    
+    def send_deadline_exceeded(self):
+        self.logger.info("    deadline exceeded, dropped")
+        # the client has discarded the reply slot, so any reply will do
+        self.send_generic_exception(GenericException("deadline exceeded", ""))
+    
+    def send_overloaded(self, msg):
+        Int8.pack(REPLY_OVERLOADED, self.transport)
+        Str.pack(msg, self.transport)
+        Int32.pack(int(self.admission.retry_after * 1000), self.transport)
     
     def process(self):
         self.logger.info("new request")
+        invocation = batch = None
         with self.transport.reading() as seq:
             cmd = Int8.unpack(self.transport)
             self.logger.info("    seq = %r, cmd = %r", seq, cmd)
-            with self.transport.writing(seq):
+            deadline = None
+            # oneway invocations have no reply at all, not even an error
+            oneway = cmd == CMD_INVOKE_ONEWAY
+            if cmd == CMD_INVOKE_DEADLINE:
+                # the time the client is willing to wait, from now on
+                deadline = default_timer() + Int32.unpack(self.transport) / 1000.0
+                cmd = CMD_INVOKE
+            elif oneway:
+                cmd = CMD_INVOKE
+            if cmd != CMD_INVOKE and cmd != CMD_BATCH:
+                with self.transport.writing(seq):
+                    self._handle(self._dispatch, seq, cmd)
+            elif self.admission is not None and not self.admission.admit(self):
+                # turned down without even reading the arguments
+                self.logger.info("    overloaded")
+                if not oneway:
+                    with self.transport.writing(seq):
+                        self.send_overloaded("too many requests in flight")
+            elif cmd == CMD_BATCH:
+                # a batch is carried out in order, as a single invocation
+                batch = self._read_deferred(seq, self.read_batch)
+                if batch is not None and self.executor is None:
+                    try:
+                        reply = self.invoke_batch(batch)
+                        with self.transport.writing(seq):
+                            self.transport.write(reply)
+                    finally:
+                        self._release()
+                    batch = None
+            elif self.executor is not None:
+                invocation = self._read_deferred(seq, self.read_invocation, oneway)
+            else:
                 try:
-                    if cmd == CMD_INVOKE:
-                        self.process_invoke(seq)
-                    elif cmd == CMD_PING:
-                        self.process_ping(seq)
-                    elif cmd == CMD_DECREF:
-                        self.process_decref(seq)
-                    elif cmd == CMD_QUIT:
-                        self.process_quit(seq)
-                    elif cmd == CMD_GETINFO:
-                        self.process_get_info(seq)
-                    elif cmd == CMD_QUERY_PROXY_TYPE:
-                        self.process_query_proxy_type(seq)
-                    elif cmd == CMD_CHECK_CAST:
-                        self.process_check_cast(seq)
-                    else:
-                        raise ProtocolError("unknown command code: %d" % (cmd,))
-                except ProtocolError as ex:
-                    self.logger.info("    got ProtocolError %r", ex)
-                    self.transport.restart_write()
-                    self.send_protocol_error(ex)
-                except GenericException as ex:
-                    self.logger.info("    got GenericException %r", ex)
-                    self.transport.restart_write()
-                    self.send_generic_exception(ex)
-                except PackingError as ex:
-                    self.logger.info("    got PackingError %r", ex)
-                    tbtext = "".join(traceback.format_exception(*sys.exc_info())[:-1])
-                    self.transport.restart_write()
-                    self.send_generic_exception(GenericException(str(ex), tbtext))
-                except PackedException as ex:
-                    self.logger.info("    got PackedException %r", ex)
-                    self.transport.restart_write()
-                    self.send_packed_exception(ex)
+                    with self.transport.writing(seq):
+                        if oneway:
+                            self._handle(self.process_invoke_oneway, seq)
+                            # drop the error reply, if any
+                            self.transport.restart_write()
+                        else:
+                            self._handle(self.process_invoke, seq, deadline)
+                finally:
+                    self._release()
+        if self._next_wire_format is not None:
+            # switch only after the reply has been sent in the former format
+            self.transport.set_wire_format(self._next_wire_format)
+            self._next_wire_format = None
+        if invocation is not None:
+            self._submit(self.func_priorities.get(invocation[0], 0), 
+                self._execute_oneway if oneway else self._execute, 
+                seq, invocation, default_timer(), deadline)
+        elif batch is not None:
+            # as urgent as its most urgent invocation
+            priority = max([self.func_priorities.get(funcid, 0) 
+                for funcid, _, _, _ in batch] or [0])
+            self._submit(priority, self._execute_batch, seq, batch, default_timer())
         self.logger.info("end request")
+    
+    def _submit(self, priority, func, *args):
+        submit_prioritized = getattr(self.executor, "submit_prioritized", None)
+        if submit_prioritized is not None:
+            submit_prioritized(priority, func, *args)
+        else:
+            self.executor.submit(func, *args)
+    
+    def _release(self):
+        if self.admission is not None:
+            self.admission.release(self)
+    
+    def _past_deadline(self, deadline):
+        """returns whether the client has already given up on a deferred 
+        invocation, which is then dropped (see send_deadline_exceeded)"""
+        return deadline is not None and default_timer() >= deadline
+    
+    def _expired(self, queued_at):
+        """called before a deferred invocation starts; returns whether it 
+        has run out of its queue time budget (and is to be replied 
+        REPLY_OVERLOADED)"""
+        if self.admission is None or not self.admission.expired(queued_at):
+            return False
+        self.logger.info("    queue time budget exceeded")
+        return True
+    
+    def _dispatch(self, seq, cmd):
+        if cmd == CMD_INVOKE:
+            self.process_invoke(seq)
+        elif cmd == CMD_PING:
+            self.process_ping(seq)
+        elif cmd == CMD_DECREF:
+            self.process_decref(seq)
+        elif cmd == CMD_QUIT:
+            self.process_quit(seq)
+        elif cmd == CMD_GETINFO:
+            self.process_get_info(seq)
+        elif cmd == CMD_QUERY_PROXY_TYPE:
+            self.process_query_proxy_type(seq)
+        elif cmd == CMD_CHECK_CAST:
+            self.process_check_cast(seq)
+        elif cmd == CMD_SET_COMPRESSION:
+            self.process_set_compression(seq)
+        elif cmd == CMD_SET_CHUNKING:
+            self.process_set_chunking(seq)
+        elif cmd == CMD_SET_WIRE_FORMAT:
+            self.process_set_wire_format(seq)
+        else:
+            raise ProtocolError("unknown command code: %d" % (cmd,))
+    
+    def _handle(self, func, *args):
+        """calls func(*args) within a write transaction, and returns its 
+        result. should it fail, the exception is sent as the reply instead
+        (of whatever has been written) and None is returned"""
+        try:
+            return func(*args)
+        except _REPLIED_ERRORS:
+            self.transport.restart_write()
+            self._send_error(*sys.exc_info())
+        return None
+    
+    def _send_error(self, typ, ex, tb, stream = None):
+        """replies the error of a request (one of _REPLIED_ERRORS), within a
+        write transaction (or to the given stream)"""
+        if isinstance(ex, ProtocolError):
+            self.logger.info("    got ProtocolError %r", ex)
+            self.send_protocol_error(ex, stream)
+        elif isinstance(ex, GenericException):
+            self.logger.info("    got GenericException %r", ex)
+            self.send_generic_exception(ex, stream)
+        elif isinstance(ex, PackingError):
+            self.logger.info("    got PackingError %r", ex)
+            tbtext = "".join(traceback.format_exception(typ, ex, tb)[:-1])
+            self.send_generic_exception(GenericException(str(ex), tbtext), stream)
+        elif isinstance(ex, PackedException):
+            self.logger.info("    got PackedException %r", ex)
+            self.send_packed_exception(ex, stream)
+        else:
+            # the client has given up on the request; nothing is sent
+            self.logger.info("    got MessageAborted %r", ex)
+    
+    def _read_deferred(self, seq, read, oneway = False):
+        """reads an invocation (or a batch, by the given read function), to 
+        be carried out later. returns what has been read, or None if it 
+        could not be read (in which case the error has already been replied,
+        unless the invocation is oneway). the write lock is taken only to 
+        reply the error"""
+        try:
+            return read()
+        except _REPLIED_ERRORS:
+            exc_info = sys.exc_info()
+        except Exception:
+            self._release()
+            raise
+        self._release()
+        if not oneway:
+            with self.transport.writing(seq):
+                self._send_error(*exc_info)
+        return None
+    
+    def _execute(self, seq, invocation, queued_at, deadline):
+        """runs on the executor: invokes the function and sends the reply. 
+        the reply is made ready first, and the write lock is taken only to 
+        send it, so that the invocations of a connection run in parallel"""
+        try:
+            stream = None
+            if not self._past_deadline(deadline) and not self._expired(queued_at):
+                funcid, func, args, res_packer = invocation
+                stream = _BufferStream(self.transport.wire_format)
+                self.invoke_to(stream, func, args, res_packer, deadline)
+            with self.transport.writing(seq):
+                if self._past_deadline(deadline):
+                    self.send_deadline_exceeded()
+                elif stream is None:
+                    self.send_overloaded("queue time budget exceeded")
+                else:
+                    self.transport.write(stream.getvalue())
+        except Exception:
+            # the connection is probably gone; there's no one to reply to
+            self.logger.exception()
+        finally:
+            self._release()
+    
+    def _execute_oneway(self, seq, invocation, queued_at, deadline):
+        """runs on the executor: invokes a oneway function"""
+        try:
+            if self.admission is not None and self.admission.expired(queued_at):
+                self.logger.info("    queue time budget exceeded, dropped")
+            else:
+                funcid, func, args, res_packer = invocation
+                self.invoke_oneway(func, args)
+        finally:
+            self._release()
+    
+    def _execute_batch(self, seq, invocations, queued_at):
+        """runs on the executor: carries out a batch, taking the write lock 
+        only to send its reply"""
+        try:
+            if self._expired(queued_at):
+                reply = None
+            else:
+                reply = self.invoke_batch(invocations)
+            with self.transport.writing(seq):
+                if reply is None:
+                    self.send_overloaded("queue time budget exceeded")
+                else:
+                    self.transport.write(reply)
+        except Exception:
+            # the connection is probably gone; there's no one to reply to
+            self.logger.exception()
+        finally:
+            self._release()
 
     def process_ping(self, seq):
         msg = Str.unpack(self.transport)
@@ -247,6 +584,34 @@ class BaseProcessor(object):
         Int8.pack(REPLY_SUCCESS, self.transport)
         Bool.pack(res, self.transport)
 
+    def process_set_compression(self, seq):
+        codec = Str.unpack(self.transport)
+        enabled = self.transport.enabled_compression([codec], 
+            adaptive = self.adaptive_compression)
+        self.logger.info("    compression codec %r, enabled = %r", codec, enabled)
+        Int8.pack(REPLY_SUCCESS, self.transport)
+        Bool.pack(enabled, self.transport)
+
+    def process_set_chunking(self, seq):
+        chunk_size = Int32.unpack(self.transport)
+        if chunk_size > 0:
+            enabled = self.transport.enable_chunking(chunk_size)
+        else:
+            self.transport.disable_chunking()
+            enabled = False
+        self.logger.info("    chunk size %r, enabled = %r", chunk_size, enabled)
+        Int8.pack(REPLY_SUCCESS, self.transport)
+        Bool.pack(enabled, self.transport)
+
+    def process_set_wire_format(self, seq):
+        version = Int8.unpack(self.transport)
+        accepted = version in self.transport.supported_wire_formats()
+        self.logger.info("    wire format %r, accepted = %r", version, accepted)
+        Int8.pack(REPLY_SUCCESS, self.transport)
+        Bool.pack(accepted, self.transport)
+        if accepted:
+            self._next_wire_format = version
+
     def process_incref(self, seq):
         oid = Int64.unpack(self.transport)
         self.incref(oid)
@@ -270,14 +635,32 @@ class BaseProcessor(object):
         Int8.pack(REPLY_SUCCESS, self.transport)
         BuiltinHeteroMapPacker.pack(info, self.transport)
 
-    def process_invoke(self, seq):
+    def process_invoke(self, seq, deadline = None):
+        funcid, func, args, res_packer = self.read_invocation()
+        self.invoke(func, args, res_packer, deadline)
+    
+    def process_invoke_oneway(self, seq):
+        funcid, func, args, res_packer = self.read_invocation()
+        self.invoke_oneway(func, args)
+    
+    def read_invocation(self):
+        """reads an invocation request, returning (funcid, func, args, 
+        res_packer)"""
         funcid = Int32.unpack(self.transport)
         self.logger.info("     invoking %r", funcid)
         try:
             func, unpack_args, res_packer = self.func_mapping[funcid]
         except KeyError:
             raise ProtocolError("unknown function id: %d" % (funcid,))
-        args = unpack_args()
+        return funcid, func, unpack_args(), res_packer
+    
+    def invoke(self, func, args, res_packer, deadline = None, stream = None):
+        """invokes the function and writes the reply (to the transport, or to
+        the given stream). the deadline is made available to the function 
+        through remaining_time()"""
+        if stream is None:
+            stream = self.transport
+        token = _deadline.set(deadline)
         try:
             res = func(args)
         except PackedException:
@@ -286,11 +669,51 @@ class BaseProcessor(object):
             raise
         except Exception:
             raise self.pack_exception(*sys.exc_info())
+        finally:
+            _deadline.reset(token)
+        self.logger.info("     invoke success")
+        Int8.pack(REPLY_SUCCESS, stream)
+        if res_packer:
+            res_packer.pack(res, stream)
+    
+    def invoke_oneway(self, func, args):
+        """invokes a oneway function (CMD_INVOKE_ONEWAY), which has no reply;
+        should it fail, the exception is only logged"""
+        try:
+            func(args)
+        except Exception:
+            self.logger.exception()
         else:
             self.logger.info("     invoke success")
-            Int8.pack(REPLY_SUCCESS, self.transport)
-            if res_packer:
-                res_packer.pack(res, self.transport)
+    
+    def read_batch(self):
+        """reads a batch request (CMD_BATCH), returning its invocations (as 
+        read_invocation does). all of them are read before any is carried 
+        out, as a request that cannot be read fails the whole batch"""
+        count = Int32.unpack(self.transport)
+        self.logger.info("    batch of %d", count)
+        return [self.read_invocation() for i in range(count)]
+    
+    def invoke_batch(self, invocations):
+        """carries out the invocations of a batch in order, and returns the 
+        reply, which holds the reply of each invocation (which does not 
+        affect the others should it fail)"""
+        stream = _BufferStream(self.transport.wire_format)
+        Int8.pack(REPLY_SUCCESS, stream)
+        Int32.pack(len(invocations), stream)
+        for funcid, func, args, res_packer in invocations:
+            self.invoke_to(stream, func, args, res_packer)
+        return stream.getvalue()
+    
+    def invoke_to(self, stream, func, args, res_packer, deadline = None):
+        """invokes the function, writing its reply (or its error, in place of
+        whatever has been written) to the given stream"""
+        mark = stream.mark()
+        try:
+            self.invoke(func, args, res_packer, deadline, stream)
+        except _REPLIED_ERRORS:
+            stream.rewind(mark)
+            self._send_error(*sys.exc_info(), stream = stream)
     
     def pack_exception(self, typ, val, tb):
         if typ not in self.exception_map:
@@ -334,6 +757,13 @@ class ClientUtils(object):
         self.replies = {}
         self.proxy_cache = weakref.WeakValueDictionary()
         self.packed_exceptions = packed_exceptions
+        # whether the server accepts CMD_INVOKE_DEADLINE; the compatibility
+        # handshake finds out (from "DEADLINES_SUPPORTED" in INFO_META)
+        self.deadlines_supported = False
+        # whether the server accepts CMD_BATCH ("BATCH_SUPPORTED")
+        self.batches_supported = False
+        # whether the server accepts CMD_INVOKE_ONEWAY ("ONEWAY_SUPPORTED")
+        self.oneway_supported = False
     
     def __del__(self):
         try:
@@ -381,14 +811,36 @@ class ClientUtils(object):
         return self.get_reply(seq)
 
     @contextmanager
-    def invocation(self, funcid, reply_packer):
+    def invocation(self, funcid, reply_packer, timeout = None):
+        """writes an invocation request, whose arguments are to be packed 
+        within the block. the timeout (in seconds) is sent along as its 
+        deadline, if the server supports deadlines"""
         seq = self.seq.next()
         with self.transport.writing(seq):
-            Int8.pack(CMD_INVOKE, self.transport)
+            if timeout is not None and self.deadlines_supported:
+                Int8.pack(CMD_INVOKE_DEADLINE, self.transport)
+                Int32.pack(max(0, min(int(timeout * 1000), 2 ** 31 - 1)), self.transport)
+            else:
+                Int8.pack(CMD_INVOKE, self.transport)
             Int32.pack(funcid, self.transport)
             self.replies[seq] = (self.REPLY_SLOT_EMPTY, reply_packer)
             yield seq
     
+    @contextmanager
+    def oneway_invocation(self, funcid):
+        """writes the request of a oneway function, which has no reply. 
+        should the server not support oneway invocations, the function is 
+        invoked as usual, and its reply is dropped when it arrives"""
+        seq = self.seq.next()
+        with self.transport.writing(seq):
+            if self.oneway_supported:
+                Int8.pack(CMD_INVOKE_ONEWAY, self.transport)
+            else:
+                Int8.pack(CMD_INVOKE, self.transport)
+                self.replies[seq] = (self.REPLY_SLOT_DISCARDED, None)
+            Int32.pack(funcid, self.transport)
+            yield seq
+    
     def tunnel_request(self, blob):
         seq = self.seq.next()
         with self.transport.writing(seq):
@@ -408,6 +860,11 @@ class ClientUtils(object):
         msg = Str.unpack(self.transport)
         return ProtocolError(msg)
 
+    def load_overloaded(self):
+        msg = Str.unpack(self.transport)
+        retry_after = Int32.unpack(self.transport)
+        return ServerOverloaded(msg, retry_after / 1000.0)
+
     def load_generic_exception(self):
         msg = Str.unpack(self.transport)
         tb = Str.unpack(self.transport)
@@ -426,6 +883,78 @@ class ClientUtils(object):
             raise ProtocolError("ping reply does not match payload")
         return dt
     
+    def set_compression(self, codec):
+        seq = self.seq.next()
+        with self.transport.writing(seq):
+            Int8.pack(CMD_SET_COMPRESSION, self.transport)
+            Str.pack(codec, self.transport)
+        self.replies[seq] = (self.REPLY_SLOT_EMPTY, Bool)
+        return self.get_reply(seq)
+    
+    def enable_compression(self, codecs = None, level = None, adaptive = False):
+        """negotiates compression with the server, and returns whether it has 
+        been enabled. the codec is chosen from `codecs` (by default, all the 
+        supported codecs, in order of preference) among those the server 
+        supports; the level and `adaptive` apply only to the requests this 
+        client sends"""
+        meta_info = self.get_service_info(INFO_META)
+        if not meta_info.get("COMPRESSION_SUPPORTED", False):
+            return False
+        peer_codecs = meta_info.get("COMPRESSION_CODECS", None)
+        if peer_codecs is None:
+            # the server only knows zlib, and cannot be told to compress its 
+            # replies
+            return self.transport.enabled_compression(["zlib"], level, adaptive)
+        if codecs is None:
+            codecs = compression.supported_codecs()
+        codec = compression.negotiate([c for c in codecs if c in peer_codecs])
+        if codec is None or not self.transport.enabled_compression([codec.NAME], 
+                level, adaptive):
+            return False
+        return self.set_compression(codec.NAME)
+    
+    def set_chunking(self, chunk_size):
+        seq = self.seq.next()
+        with self.transport.writing(seq):
+            Int8.pack(CMD_SET_CHUNKING, self.transport)
+            Int32.pack(chunk_size, self.transport)
+        self.replies[seq] = (self.REPLY_SLOT_EMPTY, Bool)
+        return self.get_reply(seq)
+    
+    def enable_chunking(self, chunk_size = None):
+        """negotiates chunking (see Transport.enable_chunking) with the server,
+        in both directions, and returns whether it has been enabled"""
+        meta_info = self.get_service_info(INFO_META)
+        if not meta_info.get("CHUNKED_FRAMES_SUPPORTED", False):
+            return False
+        if chunk_size is None:
+            chunk_size = transports.Transport.CHUNK_SIZE
+        if not self.transport.enable_chunking(chunk_size):
+            return False
+        return self.set_chunking(chunk_size)
+    
+    def set_wire_format(self, version):
+        seq = self.seq.next()
+        with self.transport.writing(seq):
+            Int8.pack(CMD_SET_WIRE_FORMAT, self.transport)
+            Int8.pack(version, self.transport)
+        self.replies[seq] = (self.REPLY_SLOT_EMPTY, Bool)
+        return self.get_reply(seq)
+    
+    def negotiate_wire_format(self, meta_info):
+        """switches the connection to the most compact wire format that both
+        parties support (the server reports its formats under "WIRE_FORMATS"
+        in INFO_META), and returns the format in use. this must take place 
+        before any other request is made, so it is part of the service 
+        compatibility handshake"""
+        peer_formats = meta_info.get("WIRE_FORMATS", None) or [1]
+        common = [v for v in self.transport.supported_wire_formats() 
+            if v in peer_formats]
+        version = max(common) if common else 1
+        if version != self.transport.wire_format and self.set_wire_format(version):
+            self.transport.set_wire_format(version)
+        return self.transport.wire_format
+    
     def get_service_info(self, code):
         seq = self.seq.next()
         with self.transport.writing(seq):
@@ -435,32 +964,50 @@ class ClientUtils(object):
         return self.get_reply(seq)
 
     def process_incoming(self, timeout):
+        """receives a reply, and returns its sequence number (or None if the
+        reply has been aborted)"""
+        try:
+            return self._process_incoming(timeout)
+        except transports.MessageAborted:
+            # the server has aborted a reply it has been sending in chunks; 
+            # the reply slot remains empty, for the reply it sends instead
+            return None
+    
+    def _process_incoming(self, timeout):
         with self.transport.reading(timeout) as seq:
             code = Int8.unpack(self.transport)
             tp, packer = self.replies.get(seq, (None, None))
             if tp != self.REPLY_SLOT_EMPTY and tp != self.REPLY_SLOT_DISCARDED:
                 raise ProtocolError("invalid sequence number %d" % (seq,))
-            if code == REPLY_SUCCESS:
-                if packer is NotImplemented:
-                    val = self.transport.read_all()
-                elif packer:
-                    val = packer.unpack(self.transport)
-                else:
-                    val = None
-                self.replies[seq] = (self.REPLY_SLOT_SUCCESS, val)
-            elif code == REPLY_PACKED_EXCEPTION:
-                self.replies[seq] = (self.REPLY_SLOT_ERROR, self.load_packed_exception())
-            elif code == REPLY_GENERIC_EXCEPTION:
-                self.replies[seq] = (self.REPLY_SLOT_ERROR, self.load_generic_exception())
-            elif code == REPLY_PROTOCOL_ERROR:
+            if code == REPLY_PROTOCOL_ERROR:
                 # protocol errors are not enqueued, because the stream has probably
                 # been corrupted, so we stop as ealry as possible 
                 raise self.load_protocol_error()
-            else:
-                raise ProtocolError("unknown reply code: %d" % (code,))
+            self.replies[seq] = self.load_reply(code, packer)
             
             if tp == self.REPLY_SLOT_DISCARDED:
                 del self.replies[seq]
+        return seq
+    
+    def load_reply(self, code, packer):
+        """reads the payload of a reply with the given code (other than 
+        REPLY_PROTOCOL_ERROR), returning its reply slot"""
+        if code == REPLY_SUCCESS:
+            if packer is NotImplemented:
+                val = self.transport.read_all()
+            elif packer:
+                val = packer.unpack(self.transport)
+            else:
+                val = None
+            return (self.REPLY_SLOT_SUCCESS, val)
+        elif code == REPLY_PACKED_EXCEPTION:
+            return (self.REPLY_SLOT_ERROR, self.load_packed_exception())
+        elif code == REPLY_GENERIC_EXCEPTION:
+            return (self.REPLY_SLOT_ERROR, self.load_generic_exception())
+        elif code == REPLY_OVERLOADED:
+            return (self.REPLY_SLOT_ERROR, self.load_overloaded())
+        else:
+            raise ProtocolError("unknown reply code: %d" % (code,))
     
     def is_reply_ready(self, seq):
         tp = self.replies[seq][0]
@@ -474,7 +1021,10 @@ class ClientUtils(object):
                 _, val = self.replies[seq]
                 self.replies[seq] = (self.REPLY_SLOT_DISCARDED, val)
     
-    def wait_reply(self, seq, timeout = None):
+    def wait_reply(self, seq, timeout = None, discard = True):
+        """waits for the reply and returns its slot. should it not arrive in 
+        time, TransportTimeout is raised, and the slot is discarded (unless
+        `discard` is False, in which case it may be waited for again)"""
         if timeout is not None:
             tend = time.time() + timeout
         else:
@@ -482,17 +1032,376 @@ class ClientUtils(object):
         while not self.is_reply_ready(seq):
             if timeout is not None:
                 remaining = tend - time.time() 
-            self.process_incoming(remaining)
+            try:
+                self.process_incoming(remaining)
+            except transports.TransportTimeout:
+                if discard:
+                    # the reply will be dropped when (and if) it arrives
+                    self.discard_reply(seq)
+                raise
         return self.replies.pop(seq)
     
-    def get_reply(self, seq, timeout = None):
-        tp, obj = self.wait_reply(seq, timeout)
+    def get_reply(self, seq, timeout = None, discard = True):
+        tp, obj = self.wait_reply(seq, timeout, discard)
         if tp == self.REPLY_SLOT_SUCCESS:
             return obj
         elif tp == self.REPLY_SLOT_ERROR:
             raise obj
         else:
             raise ValueError("invalid reply slot type: %r" % (seq,))
+    
+    def call_lock(self):
+        """returns the lock the generated functions hold for the duration of
+        a call (sending the request and waiting for its reply), as only the 
+        thread that waits for a reply may receive it"""
+        return threading.Lock()
+
+
+class _NullLock(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, t, v, tb):
+        pass
+
+class MultiplexedClientUtils(ClientUtils):
+    """
+    ClientUtils that lets any number of threads have calls in flight on the 
+    connection at the same time: a thread only holds the write transaction 
+    while it sends its request. replies are received by one of the waiting
+    threads at a time (the reader), which wakes up the threads whose 
+    replies it receives; once its own reply has arrived, it wakes up another
+    waiting thread to take its place. this way, a thread that is the only
+    one waiting receives its reply by itself, as a non-multiplexed client 
+    does, and otherwise a reply takes a single thread switch to arrive
+    """
+    
+    def __init__(self, transport, packed_exceptions):
+        ClientUtils.__init__(self, transport, packed_exceptions)
+        # seq -> the event its waiting thread waits on
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+        self._reading = False
+        self._failure = None
+    
+    def call_lock(self):
+        return _NullLock()
+    
+    def _wake_reader(self):
+        # called with the lock held, when no thread is reading. (the slot of
+        # a thread that is done waiting may be gone already)
+        for seq, event in self._waiters.items():
+            if seq in self.replies and not self.is_reply_ready(seq):
+                event.set()
+                break
+    
+    def wait_reply(self, seq, timeout = None, discard = True):
+        if timeout is not None:
+            tend = time.time() + timeout
+        remaining = timeout
+        event = threading.Event()
+        with self._waiters_lock:
+            self._waiters[seq] = event
+        try:
+            while True:
+                with self._waiters_lock:
+                    event.clear()
+                    if self._failure is not None:
+                        raise self._failure
+                    if self.is_reply_ready(seq):
+                        # along with the slot, so that no other thread finds
+                        # a waiter without one
+                        del self._waiters[seq]
+                        return self.replies.pop(seq)
+                    if timeout is not None:
+                        remaining = tend - time.time()
+                        if remaining <= 0:
+                            raise transports.TransportTimeout("no reply received within %r seconds" % (timeout,))
+                    reader = not self._reading
+                    self._reading = True
+                if reader:
+                    self._read(remaining)
+                else:
+                    event.wait(remaining)
+        except transports.TransportTimeout:
+            if discard:
+                with self._waiters_lock:
+                    # the reply will be dropped when (and if) it arrives
+                    self.discard_reply(seq)
+            raise
+        finally:
+            with self._waiters_lock:
+                self._waiters.pop(seq, None)
+                if not self._reading:
+                    self._wake_reader()
+    
+    def _read(self, timeout):
+        """receives a reply as the reader, waking up the thread it belongs to"""
+        try:
+            rseq = self.process_incoming(timeout)
+        except transports.TransportTimeout:
+            with self._waiters_lock:
+                self._reading = False
+            raise
+        except Exception:
+            # the connection is broken; every waiting thread gets the error
+            with self._waiters_lock:
+                self._failure = sys.exc_info()[1]
+                self._reading = False
+                for event in self._waiters.values():
+                    event.set()
+            raise
+        with self._waiters_lock:
+            self._reading = False
+            event = self._waiters.get(rseq)
+        if event is not None:
+            event.set()
+
+
+class ReplyFuture(object):
+    """
+    the reply of a call whose request has already been sent (the async_ 
+    functions of generated clients return these). the reply is received 
+    when result() is called, or by any other call waiting on the connection 
+    in the meantime, so a single thread may send any number of requests 
+    before collecting their replies. as with synchronous calls, a reply that
+    has not arrived by the call's timeout is given up (and the call fails 
+    with TransportTimeout); one that has not arrived by the (shorter) 
+    timeout given to result() may still be waited for again
+    """
+    __slots__ = ["utils", "seq", "lock", "deadline", "_outcome"]
+    
+    def __init__(self, utils, seq, lock, timeout = None):
+        self.utils = utils
+        self.seq = seq
+        self.lock = lock
+        self.deadline = None if timeout is None else time.time() + timeout
+        # (True, value) or (False, exception) once the reply is collected
+        self._outcome = None
+    def __repr__(self):
+        if self._outcome is None:
+            state = "done" if self.done() else "pending"
+        else:
+            state = "succeeded" if self._outcome[0] else "failed"
+        return "<ReplyFuture #%d, %s>" % (self.seq, state)
+    
+    def done(self):
+        """returns whether the reply has arrived (without waiting for it)"""
+        return self._outcome is not None or self.utils.is_reply_ready(self.seq)
+    
+    def _collect(self, timeout):
+        """waits for the reply (up to the given timeout), and stores the 
+        outcome of the call. should the call's own deadline pass first, its 
+        outcome is TransportTimeout; otherwise, TransportTimeout is raised 
+        but nothing is stored, so the reply may be waited for again"""
+        if self._outcome is not None:
+            return
+        final = False
+        if self.deadline is not None:
+            remaining = max(self.deadline - time.time(), 0)
+            if timeout is None or remaining <= timeout:
+                timeout = remaining
+                final = True
+        try:
+            with self.lock:
+                self._outcome = (True, self.utils.get_reply(self.seq, timeout, final))
+        except (PackedException, GenericException, ServerOverloaded):
+            self._outcome = (False, sys.exc_info()[1])
+        except transports.TransportTimeout:
+            if not final:
+                raise
+            self._outcome = (False, sys.exc_info()[1])
+    
+    def result(self, timeout = None):
+        """waits for the reply and returns the result of the call, or raises 
+        its exception (TransportTimeout if it has not arrived by the call's 
+        timeout). raises TransportTimeout as well if it has not arrived 
+        within the given timeout, but the call remains pending"""
+        self._collect(timeout)
+        success, obj = self._outcome
+        if not success:
+            raise obj
+        return obj
+    
+    def exception(self, timeout = None):
+        """waits for the reply and returns the exception the call raised, or
+        None if it succeeded (raises TransportTimeout as result() does)"""
+        self._collect(timeout)
+        success, obj = self._outcome
+        return None if success else obj
+
+def wait_all(futures, timeout = None):
+    """waits for the replies of all the given futures (within the given 
+    total timeout, in seconds), and returns whether all of them succeeded. 
+    their outcomes are then available through result() or exception(). 
+    should the timeout pass first, TransportTimeout is raised, and the 
+    calls that have not been replied to remain pending"""
+    if timeout is not None:
+        tend = time.time() + timeout
+    ok = True
+    for fut in futures:
+        if timeout is None:
+            remaining = None
+        else:
+            remaining = max(tend - time.time(), 0)
+        if fut.exception(remaining) is not None:
+            ok = False
+    return ok
+
+def gather(futures, timeout = None):
+    """waits for the replies of all the given futures, and returns the list
+    of their results; raises the exception of the first call that failed 
+    (or TransportTimeout, as wait_all does)"""
+    futures = list(futures)
+    wait_all(futures, timeout)
+    return [fut.result() for fut in futures]
+
+
+class BatchResult(object):
+    """the outcome of an invocation within a batch, which is available once
+    the batch has been sent (it has the interface of ReplyFuture)"""
+    __slots__ = ["_outcome"]
+    
+    def __init__(self):
+        # (True, value) or (False, exception) once the batch is sent
+        self._outcome = None
+    def __repr__(self):
+        if self._outcome is None:
+            state = "pending"
+        else:
+            state = "succeeded" if self._outcome[0] else "failed"
+        return "<BatchResult, %s>" % (state,)
+    
+    def done(self):
+        return self._outcome is not None
+    def result(self, timeout = None):
+        if self._outcome is None:
+            raise ValueError("the batch has not been sent")
+        success, obj = self._outcome
+        if not success:
+            raise obj
+        return obj
+    def exception(self, timeout = None):
+        if self._outcome is None:
+            raise ValueError("the batch has not been sent")
+        success, obj = self._outcome
+        return None if success else obj
+
+class Batch(object):
+    """
+    records invocations, to be sent to the server as a single request 
+    (CMD_BATCH) and carried out there in order, when the with-block is left
+    (or by send()). the functions of the client (including namespaces) are 
+    available as attributes of the batch, and proxy() binds proxies to it; 
+    invoking them returns a BatchResult. 
+    
+        with client.batch() as b:
+            results = [b.func(i) for i in range(1000)]
+            b.proxy(obj).method(7)
+    """
+    
+    def __init__(self, client, timeout = None):
+        self.client = client
+        self.timeout = timeout
+        # the recorded invocations (this is the 'transport' that the 
+        # generated functions pack their arguments to)
+        self.transport = _BufferStream(client._utils.transport.wire_format)
+        # (reply_packer, BatchResult) of each invocation
+        self.results = []
+        self.sent = False
+        # the generated functions, with this batch as their ClientUtils
+        self._funcs = type(client._funcs)(self)
+    def __enter__(self):
+        return self
+    def __exit__(self, t, v, tb):
+        if t is None:
+            self.send()
+    def __len__(self):
+        return len(self.results)
+    
+    def __getattr__(self, name):
+        if name.startswith("__") or name not in self.client._functions:
+            obj = getattr(self.client, name)
+            if not isinstance(obj, Namespace):
+                raise AttributeError("%r cannot be batched" % (name,))
+            return self._rebind(obj)
+        func = getattr(type(self.client), name)
+        # an unbound method on python 2
+        func = getattr(func, "__func__", func)
+        return partial(func, self)
+    
+    def _rebind(self, obj):
+        if isinstance(obj, Namespace):
+            ns = Namespace()
+            for name, value in obj.__dict__.items():
+                setattr(ns, name, self._rebind(value))
+            return ns
+        if getattr(obj, "__self__", None) is self.client._funcs:
+            return getattr(self._funcs, obj.__name__)
+        return obj
+    
+    def proxy(self, proxy):
+        """returns a copy of the given proxy, whose methods and attributes
+        are invoked within this batch"""
+        return type(proxy)(self, proxy._objref, False)
+    
+    # the part of the ClientUtils interface that the generated functions use
+    def call_lock(self):
+        return _NullLock()
+    
+    @contextmanager
+    def invocation(self, funcid, reply_packer, timeout = None):
+        if self.sent:
+            raise ValueError("the batch has already been sent")
+        mark = self.transport.mark()
+        Int32.pack(funcid, self.transport)
+        try:
+            yield len(self.results)
+        except Exception:
+            # drop whatever has been packed of the invocation
+            self.transport.rewind(mark)
+            raise
+        self.results.append((reply_packer, BatchResult()))
+    
+    def oneway_invocation(self, funcid):
+        # within a batch, oneway functions are invoked like any other
+        return self.invocation(funcid, None)
+    
+    def get_reply(self, index, timeout = None):
+        return self.results[index][1]
+    
+    def send(self):
+        """sends the batch, and waits for the outcome of its invocations. 
+        raises an exception only if the batch as a whole has failed"""
+        if self.sent:
+            raise ValueError("the batch has already been sent")
+        self.sent = True
+        if not self.results:
+            return
+        utils = self.client._utils
+        if not utils.batches_supported:
+            raise ProtocolError("the server does not support batches")
+        with self.client._funcs.lock:
+            seq = utils.seq.next()
+            with utils.transport.writing(seq):
+                Int8.pack(CMD_BATCH, utils.transport)
+                Int32.pack(len(self.results), utils.transport)
+                utils.transport.write(self.transport.getvalue())
+                utils.replies[seq] = (utils.REPLY_SLOT_EMPTY, self)
+            utils.get_reply(seq, self.timeout)
+    
+    def unpack(self, stream):
+        """reads the reply of the batch (this is its reply packer)"""
+        utils = self.client._utils
+        count = Int32.unpack(stream)
+        if count != len(self.results):
+            raise ProtocolError("expected %d replies, got %d" % (len(self.results), count))
+        for packer, res in self.results:
+            code = Int8.unpack(stream)
+            if code == REPLY_PROTOCOL_ERROR:
+                res._outcome = (False, utils.load_protocol_error())
+            else:
+                tp, val = utils.load_reply(code, packer)
+                res._outcome = (tp == utils.REPLY_SLOT_SUCCESS, val)
 
 
 class BaseClient(object):
@@ -501,28 +1410,312 @@ class BaseClient(object):
     def __exit__(self, *args):
         self.close()
     
+    # a multiplexed client (see MultiplexedClientUtils) may be used by any 
+    # number of threads at the same time, each with a call in flight
+    @classmethod
+    def connect(cls, host, port, checked = True, multiplexed = False):
+        return cls(transports.SocketTransport.connect(host, port), checked, multiplexed)
     @classmethod
-    def connect(cls, host, port, checked = True):
-        return cls(transports.SocketTransport.connect(host, port), checked)
+    def connect_unix(cls, path, checked = True, multiplexed = False):
+        return cls(transports.UnixSocketTransport.connect(path), checked, multiplexed)
     @classmethod
-    def connect_executable(cls, filename, args = None, checked = True):
+    def connect_shm(cls, path, checked = True, multiplexed = False):
+        return cls(transports.SharedMemoryTransport.connect(path), checked, multiplexed)
+    @classmethod
+    def connect_executable(cls, filename, args = None, checked = True, multiplexed = False):
         if args is None:
-            return cls(transports.ProcTransport.from_executable(filename), checked)
+            trans = transports.ProcTransport.from_executable(filename)
         else:
-            return cls(transports.ProcTransport.from_executable(filename, args), checked)
+            trans = transports.ProcTransport.from_executable(filename, args)
+        return cls(trans, checked, multiplexed)
+    @classmethod
+    def connect_proc(cls, proc, checked = True, multiplexed = False):
+        return cls(transports.ProcTransport.from_proc(proc), checked, multiplexed)
     @classmethod
-    def connect_proc(cls, proc, checked = True):
-        return cls(transports.ProcTransport.from_proc(proc), checked)
+    def connect_pool(cls, pool, checked = True, multiplexed = False):
+        """connects to a library-mode server taken from the given ProcPool"""
+        return cls(pool.get(), checked, multiplexed)
     @classmethod
     def connect_url(cls, url, checked = True):
+        # http requests are sent one at a time
         return cls(httptransport.HttpClientTransport(url), checked)
     
     def close(self):
         self._utils.close()
     def get_service_info(self, code):
         return self._utils.get_service_info(code)
+    def enable_compression(self, codecs = None, level = None, adaptive = False):
+        return self._utils.enable_compression(codecs, level, adaptive)
+    def enable_chunking(self, chunk_size = None):
+        return self._utils.enable_chunking(chunk_size)
     def tunnel_request(self, blob):
         return self._utils.tunnel_request(blob)
+    def batch(self, timeout = None):
+        """returns a Batch of invocations, to be used as a context manager"""
+        return Batch(self, timeout)
+
+
+class ClientPool(object):
+    """
+    a pool of connected clients (instances of the given generated Client 
+    class), to the given endpoints -- (host, port) tuples, or paths of 
+    unix-domain sockets. get() lends out an idle client, pinging it first 
+    if it has been idle for more than `validate_after` seconds, or connects 
+    a new one to the endpoint with the fewest clients lent out, as long as 
+    the endpoint has fewer than `max_size` clients (idle or lent out). 
+    otherwise, it waits for a client to be returned by put(). clients that 
+    fail the ping are closed, and so are the ones that have been idle for 
+    more than `max_idle_time` seconds, as long as `min_size` clients remain
+    connected to their endpoint.
+    
+    an endpoint that cannot be connected to is not connected to again for
+    `backoff` seconds, and the other endpoints are connected to instead. 
+    get() raises the connection error only when no other endpoint has room 
+    for a client, and no client is lent out (to be returned).
+    
+        with pool.client() as c:
+            c.func(...)
+    """
+    
+    def __init__(self, client_class, endpoints, min_size = 0, max_size = 8, 
+            max_idle_time = 300, validate_after = 5, ping_timeout = 5, 
+            checked = True, multiplexed = False, backoff = 5):
+        if not endpoints:
+            raise ValueError("no endpoints given")
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("invalid pool size: min %r, max %r" % (min_size, max_size))
+        self.client_class = client_class
+        self.endpoints = list(endpoints)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.validate_after = validate_after
+        self.ping_timeout = ping_timeout
+        self.checked = checked
+        self.multiplexed = multiplexed
+        self.backoff = backoff
+        # endpoint -> idle clients, as (client, returned_at), the most 
+        # recently returned last
+        self._idle = dict((ep, []) for ep in self.endpoints)
+        # endpoint -> the number of its clients (idle or lent out)
+        self._open = dict((ep, 0) for ep in self.endpoints)
+        # id(client) -> the endpoint of a client that is lent out
+        self._lent = {}
+        # endpoint -> (the time it may be connected to again, the error it 
+        # failed with), of the endpoints that are backed off
+        self._down = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self.counters = dict(connected = 0, validated = 0, broken = 0, 
+            evicted = 0, waited = 0, connect_failed = 0)
+        # the endpoints that cannot be connected to now are connected to
+        # on demand
+        for ep in self.endpoints:
+            for i in range(min_size):
+                try:
+                    client = self._connect(ep)
+                except Exception as ex:
+                    self._back_off(ep, ex)
+                    break
+                self._open[ep] += 1
+                self._idle[ep].append((client, time.time()))
+    def __repr__(self):
+        return "<ClientPool %d endpoints (%d idle, %d lent out)>" % (len(self.endpoints),
+            sum(len(idle) for idle in self._idle.values()), len(self._lent))
+    def __enter__(self):
+        return self
+    def __exit__(self, t, v, tb):
+        self.close()
+    
+    def _connect(self, endpoint):
+        if isinstance(endpoint, tuple):
+            host, port = endpoint
+            client = self.client_class.connect(host, port, self.checked, self.multiplexed)
+        else:
+            client = self.client_class.connect_unix(endpoint, self.checked, self.multiplexed)
+        with self._cond:
+            self.counters["connected"] += 1
+            self._down.pop(endpoint, None)
+        return client
+    
+    def _back_off(self, endpoint, ex):
+        with self._cond:
+            self.counters["connect_failed"] += 1
+            self._down[endpoint] = (time.time() + self.backoff, ex)
+    
+    def _evict(self, now):
+        # called with the lock held; returns the clients to close
+        evicted = []
+        for ep, idle in self._idle.items():
+            # the least recently returned come first
+            while idle and self._open[ep] > self.min_size and \
+                    now - idle[0][1] > self.max_idle_time:
+                evicted.append(idle.pop(0)[0])
+                self._open[ep] -= 1
+        self.counters["evicted"] += len(evicted)
+        return evicted
+    
+    def _take(self, timeout):
+        """picks a client to lend out, or an endpoint to connect to, waiting
+        if needed. returns (endpoint, client, returned_at), where client is 
+        None if a new one is to be connected"""
+        if timeout is not None:
+            tend = time.time() + timeout
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise ValueError("pool is closed")
+                lent = dict((ep, 0) for ep in self.endpoints)
+                for ep in self._lent.values():
+                    lent[ep] += 1
+                endpoints = sorted(self.endpoints, key = lent.__getitem__)
+                for ep in endpoints:
+                    if self._idle[ep]:
+                        client, returned_at = self._idle[ep].pop()
+                        self._lent[id(client)] = ep
+                        return ep, client, returned_at
+                now = time.time()
+                for ep, (retry_at, ex) in list(self._down.items()):
+                    if retry_at <= now:
+                        del self._down[ep]
+                down = []
+                for ep in endpoints:
+                    if self._open[ep] >= self.max_size:
+                        continue
+                    if ep in self._down:
+                        down.append(ep)
+                        continue
+                    self._open[ep] += 1
+                    return ep, None, None
+                if down and not self._lent:
+                    # no client will be returned to wait for
+                    raise self._down[down[0]][1]
+                if timeout is None:
+                    remaining = None
+                else:
+                    remaining = tend - now
+                    if remaining <= 0:
+                        raise transports.TransportTimeout("no client available "
+                            "within %r seconds" % (timeout,))
+                if down:
+                    # wake up once an endpoint may be connected to again
+                    retry_in = min(self._down[ep][0] for ep in down) - now
+                    remaining = retry_in if remaining is None else min(remaining, retry_in)
+                if not waited:
+                    waited = True
+                    self.counters["waited"] += 1
+                self._cond.wait(remaining)
+    
+    def _discard(self, endpoint, client = None):
+        # a client of the given endpoint (which has been lent out) is closed
+        with self._cond:
+            if client is not None:
+                del self._lent[id(client)]
+                self.counters["broken"] += 1
+            self._open[endpoint] -= 1
+            self._cond.notify()
+        if client is not None:
+            client.close()
+    
+    def get(self, timeout = None):
+        """lends out a client, which must be returned by put(). raises 
+        TransportTimeout if none is available within the given timeout"""
+        with self._cond:
+            evicted = self._evict(time.time())
+        for client in evicted:
+            client.close()
+        if timeout is not None:
+            tend = time.time() + timeout
+        while True:
+            if timeout is not None:
+                # what remains of it, after a broken client has been discarded
+                timeout = max(tend - time.time(), 0)
+            ep, client, returned_at = self._take(timeout)
+            if client is None:
+                try:
+                    client = self._connect(ep)
+                except Exception as ex:
+                    # try the other endpoints (or raise the error, if there
+                    # are none)
+                    self._back_off(ep, ex)
+                    self._discard(ep)
+                    continue
+                with self._cond:
+                    self._lent[id(client)] = ep
+                return client
+            if time.time() - returned_at <= self.validate_after:
+                return client
+            with self._cond:
+                self.counters["validated"] += 1
+            try:
+                client._utils.ping("", self.ping_timeout)
+            except Exception:
+                self._discard(ep, client)
+            else:
+                return client
+    
+    def put(self, client, broken = False):
+        """returns a client that get() has lent out; a broken client (whose
+        connection is in an unknown state) is closed"""
+        now = time.time()
+        with self._cond:
+            ep = self._lent.pop(id(client))
+            if broken or self._closed:
+                self._open[ep] -= 1
+                if broken:
+                    self.counters["broken"] += 1
+            else:
+                self._idle[ep].append((client, now))
+            evicted = self._evict(now)
+            self._cond.notify()
+        if broken or self._closed:
+            client.close()
+        for client2 in evicted:
+            client2.close()
+    
+    @contextmanager
+    def client(self, timeout = None):
+        """lends out a client for the duration of the block. should the block
+        fail with an error of the connection (rather than of an invocation),
+        the client is deemed broken"""
+        client = self.get(timeout)
+        # anything but an invocation's error (including KeyboardInterrupt)
+        # leaves the connection in an unknown state
+        broken = True
+        try:
+            yield client
+            broken = False
+        except (PackedException, GenericException, ServerOverloaded):
+            broken = False
+            raise
+        finally:
+            self.put(client, broken)
+    
+    def close(self):
+        """closes the idle clients; the ones that are lent out are closed 
+        when they are returned"""
+        with self._cond:
+            self._closed = True
+            idle = [client for clients in self._idle.values() for client, _ in clients]
+            for ep in self.endpoints:
+                self._open[ep] -= len(self._idle[ep])
+                del self._idle[ep][:]
+            self._cond.notify_all()
+        for client in idle:
+            client.close()
+    
+    def get_stats(self):
+        """returns the counters, and the number of idle clients and clients 
+        lent out of each endpoint"""
+        with self._cond:
+            stats = dict(self.counters)
+            lent = dict((ep, 0) for ep in self.endpoints)
+            for ep in self._lent.values():
+                lent[ep] += 1
+            stats["endpoints"] = dict((ep, dict(idle = len(self._idle[ep]), 
+                lent = lent[ep])) for ep in self.endpoints)
+        return stats
 
 
 
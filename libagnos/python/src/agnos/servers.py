@@ -22,23 +22,87 @@ import sys
 import os
 import time
 import errno
+import gc
 import threading
 import signal
-from select import select
+import heapq
+from struct import Struct
+from timeit import default_timer
 from optparse import OptionParser
-from .transports import SocketTransportFactory
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from .transports import SocketTransportFactory, UnixSocketTransportFactory
+from .transports import SharedMemoryTransportFactory
 from .utils import Logger, LogSink, NullLogger
-from .compat import icount
+from .compat import icount, selectors
+from .protocol import AdmissionControl
 
 
-def _handle_client(processor, logger):
-    """the default implementation of handling a client"""
+def _current_rss():
+    """returns the resident set size of this process, in bytes. where it is 
+    not available (outside of linux), the peak resident set size is returned
+    instead"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes, except on osx
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+class WorkerLimits(object):
+    """
+    limits the requests a worker process serves (`max_requests`) and the 
+    memory it may hold (`max_rss`, in bytes). a worker that has reached a 
+    limit finishes its connections, stops accepting and exits, to be 
+    replaced by a fresh one. this keeps the memory of long-running servers
+    (which accumulates in handler-side caches, for instance) bounded.
+    
+    `on_exceeded`, if set, is called with the reason once the server has 
+    stopped accepting (and begins draining its connections)
+    """
+    
+    def __init__(self, max_requests = None, max_rss = None):
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.requests = 0
+        self.on_exceeded = None
+        self._lock = threading.Lock()
+    
+    def count(self):
+        """called for every request served"""
+        with self._lock:
+            self.requests += 1
+    
+    def exceeded(self):
+        """returns the reason the worker should be replaced, or None. a 
+        worker that has not served any request yet is never replaced (its
+        memory is all inherited), lest a low max_rss keep replacing it"""
+        if not self.requests:
+            return None
+        if self.max_requests and self.requests >= self.max_requests:
+            return "served %d requests" % (self.requests,)
+        if self.max_rss:
+            rss = _current_rss()
+            if rss >= self.max_rss:
+                return "resident set size is %d bytes" % (rss,)
+        return None
+
+
+def _handle_client(processor, logger, limits = None):
+    """the default implementation of handling a client. the requests it 
+    serves are counted by the given WorkerLimits"""
     logger.info("handling %s", processor.transport)
     processor.logger = logger.sublogger("proc")
     processor.transport.logger = logger.sublogger("trns")
     try:
         while True:
             processor.process()
+            if limits is not None:
+                limits.count()
     except EOFError:
         logger.info("got EOF")
     except KeyboardInterrupt:
@@ -54,6 +118,9 @@ def _handle_client(processor, logger):
 class BaseServer(object):
     """abstract Agnos server"""
     LOGGER_NAME = None
+    # a WorkerLimits, for the servers that support them; once exceeded, 
+    # serve() stops accepting and returns
+    limits = None
     
     def __init__(self, processor_factory, transport_factory, logger):
         self.processor_factory = processor_factory
@@ -75,7 +142,7 @@ class BaseServer(object):
     def serve(self):
         """the server's main-loop: accepts a client and serves it"""
         self.logger.info("started serving")
-        while True:
+        while not self._limits_exceeded():
             try:
                 trans = self.transport_factory.accept()
             except IOError as ex:
@@ -87,6 +154,14 @@ class BaseServer(object):
             processor = self.processor_factory(trans)
             self._serve_client(processor)
     
+    def _limits_exceeded(self):
+        reason = self.limits.exceeded() if self.limits is not None else None
+        if reason is not None:
+            self.logger.info("worker limit reached (%s), no longer accepting", reason)
+            if self.limits.on_exceeded is not None:
+                self.limits.on_exceeded(reason)
+        return reason is not None
+    
     def _serve_client(self, processor):
         """implement this to create customize serving schemes"""
         raise NotImplementedError()
@@ -106,44 +181,101 @@ class SimpleServer(BaseServer):
 
 class SelectingServer(BaseServer):
     """
-    an implementation of an Agnos server where only a a number of clients can
-    be juggled simultaneously using select()
+    an implementation of an Agnos server where many clients are juggled by a
+    single thread, using an event loop (epoll, where available). incoming
+    data is buffered per connection, and a request is processed only once 
+    all of it has been received, so processing never blocks on a slow 
+    client; likewise, replies that cannot be sent right away are queued. 
+    requires a transport factory of socket-based transports
     """
     LOGGER_NAME = "slctsvr"
 
+    def __init__(self, processor_factory, transport_factory, logger = NullLogger):
+        BaseServer.__init__(self, processor_factory, transport_factory, logger.sublogger("srv"))
+        self.selector = None
+        self.processors = set()
+    
+    def close(self):
+        for processor in self.processors:
+            processor.close()
+        self.processors.clear()
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        BaseServer.close(self)
+
     def serve(self):
         self.logger.info("started serving")
-        sources = [self.transport_factory]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.transport_factory, selectors.EVENT_READ, None)
         try:
             while True:
                 try:
-                    rlist = select(sources, (), (), None)[0]
-                except IOError as ex:
+                    events = self.selector.select()
+                except (IOError, OSError) as ex:
                     if ex.errno == errno.EINTR:
                         continue
                     else:
                         raise
-    
-                for src in rlist:
-                    if src is self.transport_factory:
-                        trans = self.transport_factory.accept()
-                        self.logger.info("accepted %s", trans)
-                        processor = self.processor_factory(trans)
-                        sources.add(processor)
+                for key, mask in events:
+                    if key.data is None:
+                        self._accept()
                     else:
-                        try:
-                            src.process()
-                        except EOFError:
-                            self.logger.info("%s got EOF", src)
-                            src.close()
-                            self.logger.info("disconnected %s", src)
-                        except Exception:
-                            self.logger.exception()
-                            src.close()
-                            self.logger.info("disconnected %s", src)
+                        self._handle_events(key, mask)
         except KeyboardInterrupt:
             self.logger.info("got SIGINT")
             raise
+    
+    def _accept(self):
+        trans = self.transport_factory.accept()
+        infile = trans.infile
+        if not hasattr(infile, "fill") or not hasattr(infile, "queue_writes"):
+            self.logger.error("%s does not support non-blocking I/O", trans)
+            trans.close()
+            return
+        self.logger.info("accepted %s", trans)
+        infile.queue_writes()
+        processor = self.processor_factory(trans)
+        processor.logger = self.logger.sublogger("proc")
+        processor.transport.logger = self.logger.sublogger("trns")
+        self.selector.register(infile, selectors.EVENT_READ, processor)
+        self.processors.add(processor)
+    
+    def _disconnect(self, processor):
+        self.selector.unregister(processor.transport.infile)
+        self.processors.discard(processor)
+        processor.close()
+        self.logger.info("disconnected %s", processor.transport)
+    
+    def _handle_events(self, key, mask):
+        processor = key.data
+        transport = processor.transport
+        sockfile = transport.infile
+        try:
+            if mask & selectors.EVENT_WRITE:
+                sockfile.send_queued()
+            if mask & selectors.EVENT_READ:
+                sockfile.fill()
+                while transport.has_complete_message():
+                    processor.process()
+                sockfile.release_buffer()
+        except EOFError:
+            self.logger.info("%s got EOF", transport)
+            self._disconnect(processor)
+            return
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            self.logger.exception()
+            self._disconnect(processor)
+            return
+        # wait for writability only while replies are queued
+        if sockfile.queued:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        else:
+            events = selectors.EVENT_READ
+        if events != key.events:
+            self.selector.modify(sockfile, events, processor)
 
             
 class ThreadedServer(BaseServer):
@@ -162,6 +294,127 @@ class ThreadedServer(BaseServer):
         t = threading.Thread(target = _handle_client, args = (processor, logger2))
         t.start()
 
+class PooledServer(BaseServer):
+    """
+    an implementation of an Agnos server where clients are served by a fixed
+    pool of worker threads, each serving one client at a time. accepted 
+    clients wait in a queue (of up to `queue_size` clients) for a worker to 
+    become free. clients are rejected (disconnected right away) when the 
+    queue is full, or when `max_connections` clients are already connected
+    (served or queued)
+    """
+    LOGGER_NAME = "poolsvr"
+
+    def __init__(self, processor_factory, transport_factory, logger = NullLogger,
+            workers = 8, queue_size = 64, max_connections = None, limits = None):
+        BaseServer.__init__(self, processor_factory, transport_factory, logger.sublogger("srv"))
+        self.limits = limits
+        self.num_workers = workers
+        self.max_connections = max_connections
+        self.queue = queue.Queue(queue_size)
+        self.workers = []
+        self._lock = threading.Lock()
+        self._connections = 0
+        # the start time of the client each busy worker is serving
+        self._busy_since = {}
+        self._busy_time = 0.0
+        self._started = time.time()
+        self.counters = dict(accepted = 0, rejected = 0, served = 0, 
+            max_queue_depth = 0)
+
+    def get_stats(self):
+        """returns the server's counters: the current queue depth, number of
+        connections and busy workers, and the utilization of the pool (the 
+        fraction of time the workers have been busy since the server started)"""
+        with self._lock:
+            stats = dict(self.counters)
+            now = time.time()
+            busy_time = self._busy_time + sum(now - t0 for t0 in self._busy_since.values())
+            stats.update(workers = self.num_workers, busy_workers = len(self._busy_since), 
+                connections = self._connections, queue_depth = self.queue.qsize(),
+                utilization = busy_time / max(self.num_workers * (now - self._started), 1e-9))
+        return stats
+
+    def serve(self):
+        for i in range(self.num_workers):
+            logger2 = self.logger.sublogger("worker%02d" % (i,))
+            t = threading.Thread(target = self._worker, args = (logger2,))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        BaseServer.serve(self)
+        # the limits have been reached: finish serving the connections, 
+        # including the queued ones, and return
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        del self.workers[:]
+
+    def close(self):
+        # drop the clients that have not been served yet, and stop the workers
+        while True:
+            try:
+                processor = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if processor is not None:
+                processor.close()
+        for t in self.workers:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+        del self.workers[:]
+        BaseServer.close(self)
+
+    def _reject(self, processor, reason):
+        self.logger.info("rejected %s: %s", processor.transport, reason)
+        with self._lock:
+            self.counters["rejected"] += 1
+        processor.close()
+
+    def _serve_client(self, processor):
+        with self._lock:
+            self.counters["accepted"] += 1
+            full = self.max_connections and self._connections >= self.max_connections
+            if not full:
+                self._connections += 1
+        if full:
+            self._reject(processor, "too many connections")
+            return
+        try:
+            self.queue.put_nowait(processor)
+        except queue.Full:
+            with self._lock:
+                self._connections -= 1
+            self._reject(processor, "accept queue is full")
+            return
+        with self._lock:
+            depth = self.queue.qsize()
+            if depth > self.counters["max_queue_depth"]:
+                self.counters["max_queue_depth"] = depth
+
+    def _worker(self, logger):
+        while True:
+            processor = self.queue.get()
+            if processor is None:
+                break
+            ident = threading.current_thread().ident
+            with self._lock:
+                self._busy_since[ident] = time.time()
+            try:
+                _handle_client(processor, logger, self.limits)
+            except (Exception, KeyboardInterrupt):
+                # already logged by _handle_client; a client that fails (or 
+                # sends CMD_QUIT) does not take its worker down
+                pass
+            finally:
+                with self._lock:
+                    self._busy_time += time.time() - self._busy_since.pop(ident)
+                    self._connections -= 1
+                    self.counters["served"] += 1
+
 class ForkingServer(BaseServer):
     """
     an implementation of an Agnos server where each client is served by a 
@@ -240,6 +493,210 @@ class ForkingServer(BaseServer):
             self.logger.info("spawned %d", pid)
     
 
+# what a prefork worker writes to its parent (see PreforkServer)
+_WORKER_NOTICE = Struct("!i")
+
+class PreforkServer(BaseServer):
+    """
+    an implementation of an Agnos server where clients are served by a fixed
+    number of long-lived worker processes, forked when the server starts. 
+    all workers accept on the (inherited) listener, each serving one client 
+    at a time; the parent only supervises them, respawning the workers that
+    die. a worker that has reached its `limits` (see WorkerLimits) notifies
+    the parent, which spawns its replacement right away, while the old 
+    worker drains its connections (which may be long-lived) and exits.
+    before forking, the garbage collector is frozen (where supported), 
+    so that the objects created so far (imported modules, caches) are not
+    touched by collections, and their pages remain shared by the workers.
+    
+    instead of serving clients one at a time, each worker may run a server 
+    of its own on the listener: `worker_server` is called with the 
+    processor factory, the transport factory, a logger and the limits, and 
+    returns that server (e.g., a PooledServer)
+    """
+    LOGGER_NAME = "pfrksvr"
+    # a worker that dies sooner than this (in seconds) is respawned only 
+    # after this long, so that a failing worker does not make us fork busily
+    MIN_WORKER_LIFETIME = 1.0
+    
+    def __init__(self, processor_factory, transport_factory, logger = NullLogger, 
+            workers = 8, limits = None, worker_server = None):
+        BaseServer.__init__(self, processor_factory, transport_factory, 
+            logger.sublogger("srv"))
+        self.num_workers = workers
+        self.limits = limits
+        self.worker_server = worker_server
+        # pid -> (worker index, start time)
+        self.workers = {}
+        # the pids of the workers that have been replaced, but are still 
+        # finishing their connections
+        self.draining = set()
+        self.respawns = 0
+        self._prev_handler = signal.SIG_DFL
+        self._prev_chld_handler = signal.SIG_DFL
+        self._notify_r = self._notify_w = None
+        self._closed = True
+    
+    def _sigterm_handler(self, signum, unused):
+        # shut down cleanly (see close), taking the workers down as well
+        raise SystemExit()
+    
+    def _sigchld_handler(self, signum, unused):
+        # wakes up the main loop, to reap the worker
+        os.write(self._notify_w, _WORKER_NOTICE.pack(0))
+    
+    def serve(self):
+        self.logger.info("started serving")
+        # a worker writes its pid to this pipe once it begins draining, and 
+        # SIGCHLD writes 0 to it, so that both wake up the main loop
+        self._notify_r, self._notify_w = os.pipe()
+        self._closed = False
+        self._prev_handler = signal.signal(signal.SIGTERM, self._sigterm_handler)
+        self._prev_chld_handler = signal.signal(signal.SIGCHLD, self._sigchld_handler)
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+        for i in range(self.num_workers):
+            self._spawn(i)
+        while not self._closed:
+            try:
+                data = os.read(self._notify_r, 4096)
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                else:
+                    raise
+            # the notices are written (and hence read) whole, as pipe writes
+            # of up to PIPE_BUF bytes are atomic
+            for offset in range(0, len(data), _WORKER_NOTICE.size):
+                pid, = _WORKER_NOTICE.unpack_from(data, offset)
+                if pid not in self.workers:
+                    continue
+                index, t0 = self.workers.pop(pid)
+                self.draining.add(pid)
+                self.logger.info("worker %d (pid %d) is draining", index, pid)
+                self._respawn(index, t0)
+            self._reap()
+    
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                elif ex.errno == errno.ECHILD:
+                    break
+                else:
+                    raise
+            if pid == 0:
+                break
+            if pid in self.draining:
+                self.draining.remove(pid)
+                self.logger.info("drained worker (pid %d) exited with status %d", pid, status)
+            elif pid in self.workers:
+                index, t0 = self.workers.pop(pid)
+                self.logger.info("worker %d (pid %d) exited with status %d", index, pid, status)
+                self._respawn(index, t0)
+    
+    def _respawn(self, index, t0):
+        if time.time() - t0 < self.MIN_WORKER_LIFETIME:
+            time.sleep(self.MIN_WORKER_LIFETIME)
+        self.respawns += 1
+        self._spawn(index)
+    
+    def _notify_draining(self, reason):
+        os.write(self._notify_w, _WORKER_NOTICE.pack(os.getpid()))
+    
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # child
+            self.workers = {}
+            self.draining = set()
+            self._closed = True
+            self.logger = self.logger.sublogger("worker%02d" % (index,))
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.close(self._notify_r)
+                if self.limits is not None:
+                    self.limits.on_exceeded = self._notify_draining
+                self.logger.info("worker started, pid = %d", os.getpid())
+                self._worker()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                self.logger.exception()
+            finally:
+                # do not go back to the parent's stack (which would close the
+                # listener, e.g., unlink the unix-domain socket)
+                os._exit(0)
+        else:
+            # parent
+            self.workers[pid] = (index, time.time())
+            self.logger.info("spawned worker %d, pid = %d", index, pid)
+    
+    def _worker(self):
+        if self.worker_server is not None:
+            # kept referenced until the worker exits, as closing it (when it
+            # is collected) would close the listener
+            self._server = self.worker_server(self.processor_factory, 
+                self.transport_factory, self.logger, self.limits)
+            self._server.serve()
+            return
+        while not self._limits_exceeded():
+            try:
+                trans = self.transport_factory.accept()
+            except (IOError, OSError) as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                else:
+                    raise
+            self.logger.info("accepted %s", trans)
+            processor = self.processor_factory(trans)
+            try:
+                _handle_client(processor, self.logger, self.limits)
+            except Exception:
+                # already logged by _handle_client
+                pass
+    
+    def close(self, grace_period = 2):
+        if self._closed:
+            return
+        self._closed = True
+        signal.signal(signal.SIGTERM, self._prev_handler)
+        signal.signal(signal.SIGCHLD, self._prev_chld_handler)
+        os.close(self._notify_r)
+        os.close(self._notify_w)
+        workers = list(self.workers) + list(self.draining)
+        self.workers.clear()
+        self.draining.clear()
+        
+        BaseServer.close(self)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+        tend = time.time() + grace_period
+        while workers and time.time() < tend:
+            for pid in list(workers):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                        workers.remove(pid)
+                except OSError:
+                    workers.remove(pid)
+            if workers:
+                time.sleep(0.05)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+
 class LibraryModeServer(BaseServer):
     """
     library-mode server: writes the server's details (host and port number) to
@@ -260,13 +717,155 @@ class LibraryModeServer(BaseServer):
         _handle_client(processor, self.logger)
 
 
+class _PriorityStats(object):
+    __slots__ = ["submitted", "queued", "max_queued", "completed", "wait_time"]
+    def __init__(self):
+        self.submitted = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.wait_time = 0.0
+
+class PriorityExecutor(object):
+    """
+    a pool of threads that carries out tasks by their priority: the queued 
+    tasks of the highest priority first, and tasks of the same priority in 
+    the order they were submitted. a task that has started is never 
+    preempted, so a higher priority only shortens the time spent in the 
+    queue. the processors pass the priorities of the functions they invoke
+    (see BaseProcessor.func_priorities)
+    """
+    
+    def __init__(self, threads):
+        self._queue = []
+        self._order = icount()
+        self._cond = threading.Condition()
+        self._stats = {}
+        self._active = True
+        self._threads = []
+        for i in range(threads):
+            thd = threading.Thread(target = self._worker)
+            thd.daemon = True
+            thd.start()
+            self._threads.append(thd)
+    
+    def submit(self, func, *args):
+        self.submit_prioritized(0, func, *args)
+    
+    def submit_prioritized(self, priority, func, *args):
+        with self._cond:
+            stats = self._stats.get(priority)
+            if stats is None:
+                stats = self._stats[priority] = _PriorityStats()
+            stats.submitted += 1
+            stats.queued += 1
+            stats.max_queued = max(stats.max_queued, stats.queued)
+            heapq.heappush(self._queue, (-priority, self._order.next(), 
+                default_timer(), func, args))
+            self._cond.notify()
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._active and not self._queue:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                priority, _, queued_at, func, args = heapq.heappop(self._queue)
+                stats = self._stats[-priority]
+                stats.queued -= 1
+                stats.wait_time += default_timer() - queued_at
+            try:
+                func(*args)
+            except Exception:
+                # tasks are expected to handle (and log) their own errors
+                pass
+            with self._cond:
+                stats.completed += 1
+    
+    def shutdown(self, wait = True):
+        """stops the threads once the queued tasks have been carried out"""
+        with self._cond:
+            self._active = False
+            self._cond.notify_all()
+        if wait:
+            for thd in self._threads:
+                thd.join()
+        del self._threads[:]
+    
+    def get_stats(self):
+        """returns the metrics of each priority: the number of tasks 
+        submitted, queued (now and at most) and completed, and the mean 
+        time (in seconds) tasks have waited in the queue"""
+        with self._cond:
+            return dict((priority, dict(submitted = stats.submitted, 
+                    queued = stats.queued, max_queued = stats.max_queued, 
+                    completed = stats.completed, mean_wait_time = 
+                    stats.wait_time / max(stats.submitted - stats.queued, 1)))
+                for priority, stats in self._stats.items())
+
+
+def _pipelined_factory(processor_factory, threads):
+    """wraps the processor factory, so that the processors it creates carry
+    out invocations on a PriorityExecutor of `threads` threads. the pool is 
+    created on first use, so that each (forked) process gets its own"""
+    executors = {}
+    def factory(transport):
+        pid = os.getpid()
+        if pid not in executors:
+            executors.clear()
+            executors[pid] = PriorityExecutor(threads)
+        processor = processor_factory(transport)
+        processor.executor = executors[pid]
+        return processor
+    return factory
+
+def _admission_factory(processor_factory, admission):
+    """wraps the processor factory, so that the processors it creates share
+    the given AdmissionControl"""
+    def factory(transport):
+        processor = processor_factory(transport)
+        processor.admission = admission
+        return processor
+    return factory
+
+def _add_admission_options(parser, max_in_flight = 0, 
+        max_in_flight_per_connection = 0, max_queue_time = 0):
+    parser.add_option("--max-in-flight", dest="max_in_flight", default=max_in_flight, 
+                      type="int", help="maximal number of invocations carried out at the "
+                      "same time; further ones are turned down as overloaded; 0 = unlimited", 
+                      metavar="N")
+    parser.add_option("--max-in-flight-per-connection", dest="max_in_flight_per_connection", 
+                      default=max_in_flight_per_connection, type="int",
+                      help="maximal number of invocations of a single connection carried out "
+                      "at the same time; 0 = unlimited", metavar="N")
+    parser.add_option("--max-queue-time", dest="max_queue_time", default=max_queue_time, 
+                      type="float", help="maximal number of seconds a pipelined invocation "
+                      "may wait to start before it is turned down as overloaded; 0 = unlimited", 
+                      metavar="SECONDS")
+
+def _admission_from_options(options):
+    """returns an AdmissionControl by the options added by 
+    _add_admission_options, or None if no limit was given"""
+    if not (options.max_in_flight or options.max_in_flight_per_connection or 
+            options.max_queue_time):
+        return None
+    return AdmissionControl(options.max_in_flight or None, 
+        options.max_in_flight_per_connection or None, options.max_queue_time or None)
+
 def server_main(processor_factory, mode = "simple", port = 0, host = "localhost", 
-        logfile = ".server.log"):
+        logfile = ".server.log", unix = None, shm = None, workers = 8, 
+        queue_size = 64, max_connections = 0, pipeline = 0, max_in_flight = 0,
+        max_in_flight_per_connection = 0, max_queue_time = 0, max_requests = 0, 
+        max_rss = 0):
     SERVER_MODES = {
         "lib" : LibraryModeServer,
         "simple" : SimpleServer,
         "threaded" : ThreadedServer,
+        "selecting" : SelectingServer,
+        "pooled" : PooledServer,
         "forking" : ForkingServer,
+        "prefork" : PreforkServer,
     }
 
     parser = OptionParser(conflict_handler="resolve")
@@ -279,6 +878,27 @@ def server_main(processor_factory, mode = "simple", port = 0, host = "localhost"
                       help="host to bind", metavar="HOST")
     parser.add_option("-l", "--log", dest="logfile", default=None,
                       help="log file to write to", metavar="FILENAME")
+    parser.add_option("-u", "--unix", dest="unix", default=unix,
+                      help="unix-domain socket to bind (instead of tcp)", metavar="PATH")
+    parser.add_option("-s", "--shm", dest="shm", default=shm,
+                      help="unix-domain socket to bind for shared memory connections", metavar="PATH")
+    parser.add_option("-w", "--workers", dest="workers", default=workers, type="int",
+                      help="number of worker threads (pooled mode) or processes (prefork mode)", metavar="N")
+    parser.add_option("--queue-size", dest="queue_size", default=queue_size, type="int",
+                      help="maximal number of clients waiting for a worker (pooled mode)", metavar="N")
+    parser.add_option("--max-connections", dest="max_connections", default=max_connections, type="int",
+                      help="maximal number of connected clients; 0 = unlimited (pooled mode)", metavar="N")
+    parser.add_option("--pipeline", dest="pipeline", default=pipeline, type="int",
+                      help="number of threads carrying out invocations, so that requests are "
+                      "pipelined and replied out of order; 0 = no pipelining", metavar="N")
+    _add_admission_options(parser, max_in_flight, max_in_flight_per_connection, 
+        max_queue_time)
+    parser.add_option("--max-requests", dest="max_requests", default=max_requests, type="int",
+                      help="number of requests a worker process serves before it is replaced; "
+                      "0 = unlimited (prefork and pooled modes)", metavar="N")
+    parser.add_option("--max-rss", dest="max_rss", default=max_rss, type="int",
+                      help="resident set size (in megabytes) at which a worker process is "
+                      "replaced; 0 = unlimited (prefork and pooled modes)", metavar="MB")
 
     options, args = parser.parse_args()
     if args:
@@ -292,14 +912,51 @@ def server_main(processor_factory, mode = "simple", port = 0, host = "localhost"
     else:
         logger = NullLogger
 
-    transport_factory = SocketTransportFactory(int(options.port), options.host)
+    if options.pipeline > 0:
+        if options.mode == "selecting":
+            parser.error("pipelining is not supported in selecting mode")
+        processor_factory = _pipelined_factory(processor_factory, options.pipeline)
+    admission = _admission_from_options(options)
+    if admission is not None:
+        processor_factory = _admission_factory(processor_factory, admission)
+    if options.max_requests or options.max_rss:
+        limits = WorkerLimits(options.max_requests or None, 
+            options.max_rss * 1024 * 1024 or None)
+    else:
+        limits = None
+
+    if options.shm:
+        transport_factory = SharedMemoryTransportFactory(options.shm)
+    elif options.unix:
+        transport_factory = UnixSocketTransportFactory(options.unix)
+    else:
+        transport_factory = SocketTransportFactory(int(options.port), options.host)
     if options.mode == "lib" or options.mode == "library":
         s = LibraryModeServer(processor_factory, transport_factory, logger)
     elif options.mode in SERVER_MODES:
-        if int(options.port) == 0:
+        if int(options.port) == 0 and not options.unix and not options.shm:
             parser.error("must specify port for %s mode" % (options.mode,))
         cls = SERVER_MODES[options.mode]
-        s = cls(processor_factory, transport_factory, logger)
+        # (a forking server serves each client in a fresh process, which exits 
+        # along with its connection, so it has no worker to limit)
+        if limits is not None and cls not in (PreforkServer, PooledServer):
+            parser.error("worker limits are not supported in %s mode" % (options.mode,))
+        if cls is PooledServer and limits is not None:
+            # the pool runs in a worker process, which is replaced as soon as
+            # it has reached its limits (and begins draining)
+            def pooled_server(processor_factory, transport_factory, logger, limits):
+                return PooledServer(processor_factory, transport_factory, logger, 
+                    options.workers, options.queue_size, options.max_connections or None, 
+                    limits)
+            s = PreforkServer(processor_factory, transport_factory, logger, 1, limits, 
+                pooled_server)
+        elif cls is PooledServer:
+            s = cls(processor_factory, transport_factory, logger, options.workers,
+                options.queue_size, options.max_connections or None)
+        elif cls is PreforkServer:
+            s = cls(processor_factory, transport_factory, logger, options.workers, limits)
+        else:
+            s = cls(processor_factory, transport_factory, logger)
     else:
         parser.error("invalid mode: %r" % (options.mode,))
     try:
@@ -18,24 +18,75 @@
 # limitations under the License.
 ##############################################################################
 
+import os
+import sys
 import socket
 import ssl
 import signal
 import time
+import errno
+import threading
+from collections import deque
+import mmap
+import tempfile
+import stat
+from struct import Struct
 from select import select
 from contextlib import contextmanager
 from subprocess import Popen, PIPE
+from timeit import default_timer
 from . import packers
-from .utils import RLock, BoundedStream, ZlibStream, NullLogger
-try:
-    from zlib import compress as zlib_compress
-except ImportError:
-    zlib_compress = None
+from . import compression
+from .utils import RLock, BoundedStream, FrameReader, DecompressingStream, ChunkedStream
+from .utils import NullLogger, pack_varint, read_varint, unpack_varint_from
 
 
+class MessageAborted(IOError):
+    """raised when the other party aborts a message it has been sending in 
+    chunks"""
+    pass
+
 class TransportTimeout(IOError):
     pass
 
+# seq, packet_length, uncompressed_length
+FRAME_HEADER = Struct("!lll")
+
+# a frame that is followed by more frames of the same message (a chunk) has
+# an uncompressed length of -1 - the actual uncompressed length. a frame whose
+# length is FRAME_ABORTED tells the reader to discard the chunks it has 
+# received of the message
+FRAME_ABORTED = -1
+
+# wire formats: in format 1, the frame header is FRAME_HEADER and integers 
+# are fixed-size; in format 2, the three fields of the header, as well as all
+# integers (including lengths and object references), are varints
+WIRE_FORMATS = (1, 2)
+
+# the port number reported in library mode by servers that listen for 
+# shared memory connections (0 stands for a unix-domain socket)
+SHM_PORT = -1
+
+# SO_PEERCRED (which python 2 does not define) and its struct ucred: pid, 
+# uid, gid
+_SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17 if sys.platform.startswith("linux") else None)
+_PEERCRED = Struct("3i")
+
+# errors of non-blocking sockets that mean "try again later"
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+def _would_block(ex):
+    """returns whether the given socket error means "try again later". 
+    ssl sockets say so by the type of the error (or, before python 2.7.9,
+    by an SSL_ERROR_WANT_XXX code, which is not an errno value)"""
+    if isinstance(ex, ssl.SSLError):
+        return isinstance(ex, _SSL_WOULD_BLOCK) or \
+            ex.args[:1] in [(ssl.SSL_ERROR_WANT_READ,), (ssl.SSL_ERROR_WANT_WRITE,)]
+    return ex.errno in _WOULD_BLOCK
+
+_SSL_WOULD_BLOCK = tuple(getattr(ssl, name) for name in ("SSLWantReadError", 
+    "SSLWantWriteError") if hasattr(ssl, name))
+
 class _DebugFile(object):
     def __init__(self, fileobj):
         self.fileobj = fileobj
@@ -63,43 +114,125 @@ class Transport(object):
     e.g., in the case of sockets.
     """
     
+    # frames up to this size are received in full by begin_read and unpacked
+    # from memory; larger frames are streamed from the underlying file
+    MAX_FRAME_BUFFER = 16 * 1024 * 1024
+    # the default size of the chunks of messages, when chunking is enabled
+    CHUNK_SIZE = 1024 * 1024
+    # the wire formats this transport supports (see WIRE_FORMATS)
+    SUPPORTED_WIRE_FORMATS = WIRE_FORMATS
+    
     def __init__(self, infile, outfile):
         self.infile = infile
         #self.outfile = _DebugFile(outfile)
         self.outfile = outfile
         self.compression_threshold = -1
+        self.compression_codec = None
+        self.compression_policy = None
+        # the codecs of the frames this transport accepts: the ones that have
+        # been negotiated, and zlib, which parties may use without it
+        self.decompression_codecs = set([compression.ZlibCodec])
+        self.chunk_size = None
+        self.wire_format = 1
         self.logger = NullLogger
         self._rlock = RLock()
         self._wlock = RLock()
         self._wseq = -1
         self._wbuffer = []
+        self._wlength = 0
+        self._wchunked = False
+        self._rseq = -1
         self._rstream = None
     
     def is_compression_enabled(self):
         """returns whether compression is enabled on this transport"""
         return self.compression_threshold > 0
-    def enabled_compression(self):
+    def enabled_compression(self, codecs = ("zlib",), level = None, adaptive = False):
         """
         attempts to enable compression on this transport, and returns whether 
         compression has been enabled. note that not all transport implementation
         support compression, and not all implementations of libagnos support
         compression. before calling this method, be sure to test that the other
         party reports True under "COMPRESSION_SUPPOTED" in INFO_META.
+        
+        `codecs` are the codecs the other party supports, in order of 
+        preference (as reported under "COMPRESSION_CODECS" in INFO_META; 
+        parties that do not report it only support zlib). the first of these 
+        that is supported locally is used, at the given compression level.
+        negotiating the "none" codec disables compression.
+        
+        if `adaptive` is True, frames above the threshold are compressed only 
+        when it pays off (see compression.AdaptiveCompression); `adaptive` may
+        also be an AdaptiveCompression instance
         """
-        if zlib_compress is None:
+        codec = compression.negotiate(codecs, level)
+        threshold = self._get_compression_threshold()
+        if codec is None or codec.NAME == compression.NoneCodec.NAME or threshold <= 0:
             self.disable_compresion()
             return False
-        self.compression_threshold = self._get_compression_threshold()
-        return self.is_compression_enabled()
+        self.compression_codec = codec
+        self.compression_threshold = threshold
+        # (frames compressed with it may arrive even after compression is 
+        # disabled again, so it remains accepted)
+        self.decompression_codecs.add(type(codec))
+        if adaptive is True:
+            self.compression_policy = compression.AdaptiveCompression()
+        elif adaptive:
+            self.compression_policy = adaptive
+        else:
+            self.compression_policy = None
+        return True
     def disable_compresion(self):
         """disables compression on this transport"""
         self.compression_threshold = -1
+        self.compression_codec = None
+        self.compression_policy = None
+    def get_compression_stats(self):
+        """returns the statistics of the adaptive compression policy, or None
+        if adaptive compression is not enabled"""
+        policy = self.compression_policy
+        if policy is None:
+            return None
+        return policy.get_stats()
     def _get_compression_threshold(self):
         """returns the compression threshold to be used on this transport. 
         packets larger than this threshold will be compressed. a negative value
         means compression is not supported"""
         return -1
     
+    def is_chunking_enabled(self):
+        """returns whether chunking is enabled on this transport"""
+        return bool(self.chunk_size)
+    def enable_chunking(self, chunk_size = None):
+        """
+        enables chunking on this transport, and returns whether it has been 
+        enabled: once `chunk_size` bytes of a message have been written, they
+        are sent right away as a frame of their own (a chunk), instead of 
+        buffering the whole message. before calling this method, be sure to 
+        test that the other party reports True under 
+        "CHUNKED_FRAMES_SUPPORTED" in INFO_META
+        """
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self.chunk_size = chunk_size
+        return True
+    def disable_chunking(self):
+        """disables chunking on this transport"""
+        self.chunk_size = None
+    
+    def supported_wire_formats(self):
+        """returns the wire formats this transport supports"""
+        return self.SUPPORTED_WIRE_FORMATS
+    def set_wire_format(self, version):
+        """switches the wire format of this transport (of both directions). 
+        the other party must be switched at the very same point of the 
+        stream, so this is normally done by ClientUtils.negotiate_wire_format"""
+        if version not in self.SUPPORTED_WIRE_FORMATS:
+            raise ValueError("unsupported wire format %r" % (version,))
+        self.wire_format = version
+    
     def close(self):
         self.logger.info("closing")
         if self.infile:
@@ -127,30 +260,101 @@ class Transport(object):
         try:
             if timeout is not None and timeout < 0:
                 timeout = 0
-            if not select([self.infile], [], [], timeout)[0]:
-                self._rlock.release()
+            poll = getattr(self.infile, "poll", None)
+            if poll is not None:
+                ready = poll(timeout)
+            else:
+                ready = select([self.infile], [], [], timeout)[0]
+            if not ready:
                 raise TransportTimeout("no data received within %r seconds" % (timeout,))
             
-            seq = packers.Int32.unpack(self.infile)
-            packet_length = packers.Int32.unpack(self.infile)
-            uncompressed_length = packers.Int32.unpack(self.infile)
-            
             assert self._rstream is None
-
-            self._rstream = BoundedStream(self.infile, packet_length, 
-                skip_underlying = True, close_underlying = False)
-            
-            if uncompressed_length > 0:
-                self._rstream = BoundedStream(ZlibStream(self._rstream), 
-                    uncompressed_length, skip_underlying = False, 
-                    close_underlying = True)
-
+            seq, stream, more = self._read_frame()
+            if more:
+                self._rseq = seq
+                stream = ChunkedStream(stream, self._read_chunk)
+            self._rstream = stream
             return seq
         except Exception:
             self._rstream = None
             self._rlock.release()
             raise
     
+    def _read_frame(self):
+        """reads the next frame, and returns (seq, stream, more), where 
+        `more` tells whether the frame is a chunk followed by more frames"""
+        if self.wire_format >= 2:
+            seq = read_varint(self.infile)
+            packet_length = read_varint(self.infile)
+            uncompressed_length = read_varint(self.infile)
+        else:
+            header = self.infile.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                raise EOFError("incomplete frame header")
+            seq, packet_length, uncompressed_length = FRAME_HEADER.unpack(header)
+        if packet_length == FRAME_ABORTED:
+            raise MessageAborted("message %r has been aborted" % (seq,))
+        more = uncompressed_length < 0
+        if more:
+            uncompressed_length = -1 - uncompressed_length
+        
+        expect = getattr(self.infile, "expect", None)
+        if expect is not None:
+            expect(packet_length)
+        
+        stream = BoundedStream(self.infile, packet_length, 
+            skip_underlying = True, close_underlying = False)
+        if uncompressed_length > 0:
+            magic = stream.read(compression.MAGIC_LENGTH)
+            codec = compression.detect_codec(magic, self.decompression_codecs)
+            stream = DecompressingStream(stream, codec.decompressor(), 
+                uncompressed_length, initial_data = magic)
+            frame_length = uncompressed_length
+        else:
+            frame_length = packet_length
+        
+        if frame_length <= self.MAX_FRAME_BUFFER:
+            data = stream.read(frame_length)
+            stream.close()
+            if len(data) < frame_length:
+                raise EOFError("incomplete frame")
+            stream = FrameReader(data)
+        return seq, stream, more
+    
+    def _read_chunk(self):
+        """reads the next chunk of the message being read (see ChunkedStream)"""
+        seq, stream, more = self._read_frame()
+        if seq != self._rseq:
+            raise IOError("expected a chunk of message %r, got %r" % (self._rseq, seq))
+        return stream, more
+    
+    def has_complete_message(self):
+        """returns whether the input file already holds a complete message 
+        (all of its frames), so that reading it would not block. the input 
+        file must support peek() (see SocketFile)"""
+        buffer, offset, end = self.infile.peek()
+        try:
+            while True:
+                if self.wire_format >= 2:
+                    seq, offset = unpack_varint_from(buffer, offset, end)
+                    packet_length, offset = unpack_varint_from(buffer, offset, end)
+                    uncompressed_length, offset = unpack_varint_from(buffer, offset, end)
+                else:
+                    if offset + FRAME_HEADER.size > end:
+                        return False
+                    seq, packet_length, uncompressed_length = \
+                        FRAME_HEADER.unpack_from(buffer, offset)
+                    offset += FRAME_HEADER.size
+                if packet_length == FRAME_ABORTED:
+                    return True
+                offset += packet_length
+                if offset > end:
+                    return False
+                if uncompressed_length >= 0:
+                    return True
+        except EOFError:
+            return False
+    
     def _assert_rlock(self):
         if not self._rlock.is_held_by_current_thread():
             raise IOError("thread must first call begin_read")
@@ -159,12 +363,26 @@ class Transport(object):
         """reads up to `count` bytes from the ongoing read transaction. 
         begin_read() must have been called prior to this"""
         self._assert_rlock()
-        if count > self._rstream.available():
+        available = self._rstream.available()
+        if available is not None and count > available:
             raise EOFError("request to read more than available")
-        self.logger.info("read(%r)", count)
-        data = self._rstream.read(count)
-        self.logger.info("    <- %r bytes", len(data))
-        return data
+        return self._rstream.read(count)
+    
+    def unpack_struct(self, st):
+        """unpacks the given struct.Struct from the ongoing read transaction.
+        begin_read() must have been called prior to this. this is the fast 
+        path used by the packers, so unlike read(), it does not verify that
+        the calling thread is the one holding the read transaction"""
+        if self._rstream is None:
+            raise IOError("thread must first call begin_read")
+        return self._rstream.unpack_struct(st)
+    
+    def unpack_varint(self):
+        """unpacks a varint from the ongoing read transaction (see 
+        unpack_struct)"""
+        if self._rstream is None:
+            raise IOError("thread must first call begin_read")
+        return self._rstream.unpack_varint()
     
     def read_all(self):
         """reads all the available data in the ongoing read transaction.
@@ -179,11 +397,13 @@ class Transport(object):
         """ends the ongoing read transaction. begin_read() must have been 
         called prior to this. you must call this to finalize the transaction"""
         self._assert_rlock()
-        if self._rstream is not None:
-            self._rstream.close()
+        try:
+            if self._rstream is not None:
+                self._rstream.close()
+        finally:
             self._rstream = None
-        self.logger.info("end_read")
-        self._rlock.release()
+            self.logger.info("end_read")
+            self._rlock.release()
     
     def begin_write(self, seq):
         """begins a write transaction. only a single thread can have an ongoing
@@ -196,6 +416,8 @@ class Transport(object):
         self._wlock.acquire()
         self._wseq = seq
         del self._wbuffer[:]
+        self._wlength = 0
+        self._wchunked = False
         self.logger.info("begin_write seq = %r", seq)
     
     def _assert_wlock(self):
@@ -207,12 +429,22 @@ class Transport(object):
         begin_write must have been called prior to this"""
         self._assert_wlock()
         self._wbuffer.append(data)
+        if self.chunk_size:
+            self._wlength += len(data)
+            if self._wlength >= self.chunk_size:
+                self._send_frame(self._wbuffer, self._wlength, True)
+                self._wchunked = True
+                del self._wbuffer[:]
+                self._wlength = 0
     
     def restart_write(self):
         """clears the transaction buffer (non-blocking), effectively restarting
         the write transaction. begin_write must have been called prior to this"""
         self._assert_wlock()
         del self._wbuffer[:]
+        self._wlength = 0
+        if self._wchunked:
+            self._abort_chunks()
         self.logger.info("restart_write")
     
     def end_write(self):
@@ -221,22 +453,63 @@ class Transport(object):
         must be called to finalize the transaction"""
         self._assert_wlock()
         self.logger.info("end_write")
-        data = "".join(self._wbuffer)
-        del self._wbuffer[:]
-        self.logger.info("    data = %r bytes", len(data))
-        if data:
-            packers.Int32.pack(self._wseq, self.outfile)
-            if self.compression_threshold > 0 and len(data) > self.compression_threshold:
-                uncompressed_length = len(data)
-                data = zlib_compress(data)
-            else:
-                uncompressed_length = 0
-            packers.Int32.pack(len(data), self.outfile)
-            packers.Int32.pack(uncompressed_length, self.outfile)
-            self.outfile.write(data)
-            self.outfile.flush()
-        self.logger.info("    ok")
-        self._wlock.release()
+        try:
+            length = sum(len(chunk) for chunk in self._wbuffer)
+            self.logger.info("    data = %r bytes", length)
+            # the last chunk of a message is sent even if it is empty
+            if length or self._wchunked:
+                self._send_frame(self._wbuffer, length, False)
+            self.logger.info("    ok")
+        finally:
+            del self._wbuffer[:]
+            self._wlength = 0
+            self._wchunked = False
+            self._wlock.release()
+    
+    def _send_frame(self, chunks, length, more):
+        """sends the given data (`length` bytes in total) as a single frame,
+        compressing it if needed. `more` tells whether more frames (chunks) of
+        the same message follow"""
+        uncompressed_length = 0
+        policy = self.compression_policy
+        if self.compression_threshold > 0 and length > self.compression_threshold \
+                and (policy is None or policy.should_compress(length)):
+            t0 = default_timer()
+            data = self.compression_codec.compress(b"".join(chunks))
+            if policy is not None:
+                policy.record(length, len(data), default_timer() - t0)
+            # send incompressible data as-is
+            if len(data) < length:
+                uncompressed_length = length
+                chunks = [data]
+                length = len(data)
+        if more:
+            uncompressed_length = -1 - uncompressed_length
+        self._write_frame(self._pack_header(length, uncompressed_length), chunks)
+        self.outfile.flush()
+    
+    def _abort_chunks(self):
+        """tells the reader to discard the chunks of the current message that
+        have already been sent"""
+        self._wchunked = False
+        self._write_frame(self._pack_header(FRAME_ABORTED, 0), [])
+        self.outfile.flush()
+    
+    def _pack_header(self, packet_length, uncompressed_length):
+        if self.wire_format >= 2:
+            return (pack_varint(self._wseq) + pack_varint(packet_length) + 
+                pack_varint(uncompressed_length))
+        return FRAME_HEADER.pack(self._wseq, packet_length, uncompressed_length)
+    
+    def _write_frame(self, header, chunks):
+        """writes a single frame (header followed by the payload chunks) to the
+        underlying stream. if the stream supports scatter-gather writes, 
+        the chunks are handed over as they are, without joining them first"""
+        writev = getattr(self.outfile, "writev", None)
+        if writev is not None:
+            writev([header] + chunks)
+        else:
+            self.outfile.write(header + b"".join(chunks))
     
     def cancel_write(self):
         """finalizes the transaction and WITHOUT writing anything to the 
@@ -246,7 +519,12 @@ class Transport(object):
         self._assert_wlock()
         self.logger.info("cancel_write")
         del self._wbuffer[:]
-        self._wlock.release()
+        self._wlength = 0
+        try:
+            if self._wchunked:
+                self._abort_chunks()
+        finally:
+            self._wlock.release()
     
     @contextmanager
     def reading(self, timeout = None):
@@ -279,10 +557,25 @@ class WrappedTransport(object):
         return "WrappedTransport(%s)" % (self.transport,)
     def is_compression_enabled(self):
         return self.transport.is_compression_enabled()
-    def enabled_compression(self):
-        return self.transport.enabled_compression()
+    def enabled_compression(self, codecs = ("zlib",), level = None, adaptive = False):
+        return self.transport.enabled_compression(codecs, level, adaptive)
+    def get_compression_stats(self):
+        return self.transport.get_compression_stats()
     def disable_compresion(self):
         self.transport.disable_compresion()
+    def is_chunking_enabled(self):
+        return self.transport.is_chunking_enabled()
+    def enable_chunking(self, chunk_size = None):
+        return self.transport.enable_chunking(chunk_size)
+    def disable_chunking(self):
+        self.transport.disable_chunking()
+    @property
+    def wire_format(self):
+        return self.transport.wire_format
+    def supported_wire_formats(self):
+        return self.transport.supported_wire_formats()
+    def set_wire_format(self, version):
+        self.transport.set_wire_format(version)
     def close(self):
         return self.transport.close()
     def begin_read(self, timeout = None):
@@ -291,6 +584,10 @@ class WrappedTransport(object):
         return self.transport.read(count)
     def read_all(self):
         return self.transport.read_all()
+    def unpack_struct(self, st):
+        return self.transport.unpack_struct(st)
+    def unpack_varint(self):
+        return self.transport.unpack_varint()
     def begin_write(self, seq):
         return self.transport.begin_write(seq)
     def write(self, data):
@@ -311,19 +608,57 @@ class SocketFile(object):
     """file-like wrapper for sockets"""
     
     CHUNK = 16*1024
+    IOV_MAX = 1024
+    MIN_READAHEAD = 4*1024
+    MAX_READAHEAD = 1024*1024
+    
     def __init__(self, sock, read_buffer_size = 64*1024):
         self.sock = sock
-        self.sock_host, self.sock_port = sock.getsockname()
-        self.peer_host, self.peer_port = sock.getpeername()
+        self.sock_host, self.sock_port = self._split_address(sock.getsockname())
+        self.peer_host, self.peer_port = self._split_address(sock.getpeername())
         self.sock.setblocking(False)
+        if sock.family in (socket.AF_INET, getattr(socket, "AF_INET6", None)):
+            try:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error:
+                pass
+        # the receive buffer holds the unread data in _rbuf[_rstart:_rend];
+        # it is filled in-place by recv_into() and compacted when it runs out
+        # of room, so reads never re-slice (copy) the whole buffered data
+        # the buffer is allocated on first use
         self.read_buffer_size = read_buffer_size
-        self.read_buffer = ""
+        self.readahead = self.MIN_READAHEAD
+        self._rbuf = bytearray()
+        self._rview = memoryview(self._rbuf)
+        self._rstart = 0
+        self._rend = 0
+        # when not None, writes never block (see queue_writes)
+        self.write_queue = None
+        self.queued = 0
+        # SSL sockets expose sendmsg(), but do not implement it
+        if isinstance(sock, ssl.SSLSocket):
+            self._sendmsg = None
+        else:
+            self._sendmsg = getattr(sock, "sendmsg", None)
+
+    @staticmethod
+    def _split_address(addr):
+        """returns (host, port) for internet sockets, or (path, None) for
+        unix-domain sockets"""
+        if isinstance(addr, tuple):
+            return addr[0], addr[1]
+        return addr, None
 
     @classmethod
     def connect(cls, host, port):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((host, port))
         return cls(s)
+    @classmethod
+    def connect_unix(cls, path):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        return cls(s)
     def close(self):
         self.sock.close()
     def fileno(self):
@@ -331,45 +666,490 @@ class SocketFile(object):
     def flush(self):
         pass
     
+    def pending(self):
+        """returns the number of bytes already received but not yet read"""
+        return self._rend - self._rstart
+    
+    def poll(self, timeout = None):
+        """waits up to `timeout` seconds until reading would not block"""
+        return bool(self.pending() or select([self.sock], [], [], timeout)[0])
+    
+    def peek(self):
+        """returns (buffer, start, end), where buffer[start:end] is the data 
+        already received but not yet read. the buffer must not be modified,
+        and is only valid until the next read"""
+        return self._rbuf, self._rstart, self._rend
+    
+    def fill(self):
+        """receives whatever data the socket has, without blocking, and 
+        returns the number of bytes received. raises EOFError if the other 
+        party has closed the connection"""
+        total = 0
+        while True:
+            if len(self._rbuf) - self._rend < self.MIN_READAHEAD:
+                self._make_room(self._rend - self._rstart)
+            try:
+                received = self.sock.recv_into(self._rview[self._rend:], 
+                    len(self._rbuf) - self._rend)
+            except socket.error as ex:
+                if not _would_block(ex):
+                    raise
+                return total
+            if not received:
+                if total:
+                    return total
+                raise EOFError()
+            self._rend += received
+            total += received
+            if self._rend < len(self._rbuf):
+                return total
+    
+    def release_buffer(self):
+        """gives back the memory of the receive buffer, if it holds no unread
+        data (useful for idle connections)"""
+        if self._rstart == self._rend:
+            self._rbuf = bytearray()
+            self._rview = memoryview(self._rbuf)
+            self._rstart = self._rend = 0
+    
+    def expect(self, count):
+        """hints that a frame of `count` bytes is about to be read. the 
+        readahead size follows a moving average of the expected frame sizes,
+        so that a whole (typical) frame is received with a single recv_into"""
+        avg = (self.readahead * 7 + count) // 8
+        self.readahead = max(self.MIN_READAHEAD, min(self.MAX_READAHEAD, avg))
+    
+    def _make_room(self, count):
+        """makes sure the buffer can hold `count` unread bytes plus the 
+        readahead, by compacting or reallocating it"""
+        available = self._rend - self._rstart
+        size = max(count + self.readahead, self.read_buffer_size)
+        if len(self._rbuf) < size or len(self._rbuf) > 4 * size:
+            # grow (at least twofold, so that receiving a huge frame piece by
+            # piece takes a logarithmic number of reallocations), or give back
+            # the memory of a past huge read
+            if len(self._rbuf) < size:
+                size = max(size, 2 * len(self._rbuf))
+            buf = bytearray(size)
+            buf[:available] = self._rview[self._rstart:self._rend]
+            self._rbuf = buf
+            self._rview = memoryview(buf)
+        elif self._rstart + size > len(self._rbuf):
+            self._rbuf[:available] = self._rbuf[self._rstart:self._rend]
+        else:
+            return
+        self._rstart = 0
+        self._rend = available
+    
     def _underlying_read(self, count):
-        bufs = []
-        upper_count = count + self.read_buffer_size
-        timeout = None
-        while upper_count > 0:
-            rl = select([self.sock], [], [], timeout)[0]
-            if not rl:
+        """receives data into the buffer until at least `count` bytes are 
+        available, or EOF is reached"""
+        if self._rstart + count + self.MIN_READAHEAD > len(self._rbuf):
+            self._make_room(count)
+        target = self._rstart + count
+        while self._rend < target:
+            try:
+                received = self.sock.recv_into(self._rview[self._rend:], 
+                    len(self._rbuf) - self._rend)
+            except socket.error as ex:
+                if not _would_block(ex):
+                    raise
+                select([self.sock], [], [], None) # wait until readable
+                continue
+            if not received:
                 break
-            data = self.sock.recv(min(upper_count, self.CHUNK))
-            if not data:
-                break
-            bufs.append(data)
-            if timeout == 0:
+            self._rend += received
+    
+    def read(self, count):
+        if self._rend - self._rstart < count:
+            self._underlying_read(count)
+        start = self._rstart
+        end = min(start + count, self._rend)
+        self._rstart = end
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
+        if count > 0 and end == start:
+            raise EOFError()
+        return self._rview[start:end].tobytes()
+    
+    def _send(self, sendfunc, data):
+        """calls sendfunc(data), waiting for the socket to become writable
+        only if the send would block"""
+        while True:
+            try:
+                return sendfunc(data)
+            except socket.error as ex:
+                if not _would_block(ex):
+                    raise
+            select([], [self.sock], [], None) # wait until writable
+    
+    def queue_writes(self):
+        """makes writes non-blocking: whatever cannot be sent right away is 
+        queued, to be sent by send_queued() once the socket is writable"""
+        if self.write_queue is None:
+            self.write_queue = deque()
+    
+    def send_queued(self):
+        """sends as much of the write queue as possible, without blocking, 
+        and returns the number of bytes that remain queued"""
+        queue = self.write_queue
+        while queue:
+            try:
+                if self._sendmsg is not None:
+                    sent = self._sendmsg([queue[i] for i in range(min(len(queue), self.IOV_MAX))])
+                else:
+                    sent = self.sock.send(queue[0])
+            except socket.error as ex:
+                if not _would_block(ex):
+                    raise
                 break
-            count -= len(data)
-            upper_count -= len(data)
-            if count < 0:
-                timeout = 0
-        return "".join(bufs)
+            self.queued -= sent
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+            if sent:
+                queue[0] = memoryview(queue[0])[sent:]
+        return self.queued
+    
+    def _enqueue(self, buffers):
+        for buf in buffers:
+            if buf:
+                self.write_queue.append(buf)
+                self.queued += len(buf)
+        self.send_queued()
+    
+    def write(self, data):
+        if self.write_queue is not None:
+            self._enqueue([data])
+            return
+        view = memoryview(data)
+        while view:
+            sent = self._send(self.sock.send, view[:self.CHUNK])
+            view = view[sent:]
+    
+    def writev(self, buffers):
+        """writes a sequence of buffers using scatter-gather I/O (sendmsg), 
+        where supported; otherwise, falls back to a single write()"""
+        if self.write_queue is not None:
+            self._enqueue(buffers)
+            return
+        if self._sendmsg is None:
+            self.write(b"".join(buffers))
+            return
+        buffers = [buf for buf in buffers if buf]
+        while buffers:
+            sent = self._send(self._sendmsg, buffers[:self.IOV_MAX])
+            i = 0
+            while i < len(buffers) and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            del buffers[:i]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+
+class SharedMemoryRing(object):
+    """
+    a single-producer, single-consumer byte queue over a region of a shared 
+    mmap. the region starts with a header holding the number of bytes ever 
+    written (head, updated only by the producer), the number of bytes ever 
+    read (tail, updated only by the consumer) and a closed flag, each on its
+    own cache line. the head is published only after the data has been 
+    copied in, so the consumer never sees uncommitted data
+    """
+    COUNTER = Struct("Q")
+    HEAD_OFFSET = 0
+    TAIL_OFFSET = 64
+    CLOSED_OFFSET = 128
+    HEADER_SIZE = 192
+    
+    def __init__(self, mm, offset, size):
+        self.mm = mm
+        self.offset = offset
+        self.size = size
+        self.data_offset = offset + self.HEADER_SIZE
+        self.head = self._get(self.HEAD_OFFSET)
+        self.tail = self._get(self.TAIL_OFFSET)
+    
+    def _get(self, field):
+        return self.COUNTER.unpack_from(self.mm, self.offset + field)[0]
+    def _set(self, field, value):
+        self.COUNTER.pack_into(self.mm, self.offset + field, value)
+    
+    def available(self):
+        """returns the number of bytes that can be read (consumer side)"""
+        return self._get(self.HEAD_OFFSET) - self.tail
+    def free(self):
+        """returns the number of bytes that can be written (producer side)"""
+        return self.size - (self.head - self._get(self.TAIL_OFFSET))
+    def is_closed(self):
+        return self._get(self.CLOSED_OFFSET) != 0
+    def set_closed(self):
+        self._set(self.CLOSED_OFFSET, 1)
     
     def read(self, count):
-        if len(self.read_buffer) >= count:
-            data = self.read_buffer[:count]
-            self.read_buffer = self.read_buffer[count:]
+        """reads (and consumes) up to `count` bytes"""
+        count = min(count, self.available())
+        if count <= 0:
+            return b""
+        pos = self.tail % self.size
+        first = min(count, self.size - pos)
+        start = self.data_offset + pos
+        data = self.mm[start:start + first]
+        if first < count:
+            data += self.mm[self.data_offset:self.data_offset + count - first]
+        self.tail += count
+        self._set(self.TAIL_OFFSET, self.tail)
+        return data
+    
+    def write(self, data):
+        """writes as much of `data` as there is room for, and returns the 
+        number of bytes written"""
+        count = min(len(data), self.free())
+        if count <= 0:
+            return 0
+        if count < len(data):
+            data = data[:count]
+        pos = self.head % self.size
+        first = min(count, self.size - pos)
+        start = self.data_offset + pos
+        if first < count:
+            self.mm[start:start + first] = data[:first]
+            self.mm[self.data_offset:self.data_offset + count - first] = data[first:]
         else:
-            req = count - len(self.read_buffer)
-            data2 = self._underlying_read(req)
-            data = self.read_buffer + data2[:req]
-            self.read_buffer = data2[req:]
-        if count > 0 and not data:
+            self.mm[start:start + count] = data
+        self.head += count
+        self._set(self.HEAD_OFFSET, self.head)
+        return count
+
+
+class SharedMemoryFile(object):
+    """
+    file-like object for parties on the same host, which exchanges data 
+    through a pair of ring buffers in a shared mmap, one for each direction. 
+    the data never passes through the kernel: the unix-domain socket over 
+    which the mapping is set up only carries wakeups (a byte written after
+    data has been committed to a ring), which also makes the file selectable.
+    a writer that finds its ring full polls (with backoff) until the reader 
+    makes room, so the rings should be sized to hold a typical frame
+    """
+    
+    RING_SIZE = 1024*1024
+    MIN_SPACE_WAIT = 0.0001
+    MAX_SPACE_WAIT = 0.01
+    
+    def __init__(self, sock, mm, path, inring, outring):
+        self.sock = sock
+        self.mm = mm
+        self.path = path
+        self.inring = inring
+        self.outring = outring
+        self._eof = False
+        self.sock.setblocking(False)
+    
+    @classmethod
+    def _layout(cls, ring_size):
+        """returns the total size of the mapping and the offsets of the two 
+        rings: the first carries data from the client to the server, and the
+        second from the server to the client"""
+        region = SharedMemoryRing.HEADER_SIZE + ring_size
+        region += -region % mmap.PAGESIZE
+        return 2 * region, 0, region
+    
+    @staticmethod
+    def _directory():
+        """the directory in which the shared mappings are created"""
+        if os.path.isdir("/dev/shm"):
+            return "/dev/shm"
+        return tempfile.gettempdir()
+    
+    @classmethod
+    def connect(cls, path, ring_size = RING_SIZE):
+        """creates the shared mapping and hands it over to the server 
+        listening on the unix-domain socket at `path`"""
+        fd, mmpath = tempfile.mkstemp(prefix = "agnos-", suffix = ".shm", dir = cls._directory())
+        try:
+            total, off1, off2 = cls._layout(ring_size)
+            os.ftruncate(fd, total)
+            mm = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.sendall(("%d %s\n" % (ring_size, mmpath)).encode("utf8"))
+            if sock.recv(1) != b"+":
+                sock.close()
+                raise IOError("shared memory handshake failed")
+        except Exception:
+            mm.close()
+            raise
+        finally:
+            os.unlink(mmpath)
+        return cls(sock, mm, mmpath, SharedMemoryRing(mm, off2, ring_size), 
+            SharedMemoryRing(mm, off1, ring_size))
+    
+    @classmethod
+    def from_socket(cls, sock):
+        """maps the shared memory handed over by a client (see connect) that
+        has connected on the given socket"""
+        line = b""
+        while not line.endswith(b"\n"):
+            data = sock.recv(1)
+            if not data:
+                raise EOFError("shared memory handshake failed")
+            line += data
+        ring_size, mmpath = line.decode("utf8").strip().split(" ", 1)
+        ring_size = int(ring_size)
+        if ring_size <= 0:
+            raise IOError("shared memory handshake failed: invalid ring size")
+        total, off1, off2 = cls._layout(ring_size)
+        fd = cls._open_mapping(sock, mmpath, total)
+        try:
+            mm = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+        sock.sendall(b"+")
+        return cls(sock, mm, mmpath, SharedMemoryRing(mm, off1, ring_size), 
+            SharedMemoryRing(mm, off2, ring_size))
+    
+    @classmethod
+    def _open_mapping(cls, sock, mmpath, total):
+        """opens the file of a mapping that a client has created (see 
+        connect), making sure that it is one: the client names the file, 
+        so it must not get the server to open (and write to) any other"""
+        name = os.path.basename(mmpath)
+        if os.path.dirname(mmpath) != cls._directory() or \
+                not name.startswith("agnos-") or not name.endswith(".shm"):
+            raise IOError("shared memory handshake failed: invalid path %r" % (mmpath,))
+        flags = os.O_RDWR | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_NOCTTY", 0)
+        fd = os.open(mmpath, flags)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_nlink != 1 or st.st_size != total:
+                raise IOError("shared memory handshake failed: %r is not a mapping" % (mmpath,))
+            if st.st_uid != cls._peer_uid(sock):
+                raise IOError("shared memory handshake failed: %r is not owned "
+                    "by the client" % (mmpath,))
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+    
+    @staticmethod
+    def _peer_uid(sock):
+        """the user id of the process at the other end of the socket (where 
+        the platform cannot tell, it is assumed to be the server's user)"""
+        if _SO_PEERCRED is not None:
+            creds = sock.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _PEERCRED.size)
+            return _PEERCRED.unpack(creds)[1]
+        return os.geteuid()
+    
+    def close(self):
+        if self.mm is None:
+            return
+        self.inring.set_closed()
+        self.outring.set_closed()
+        self.sock.close()
+        self.mm.close()
+        self.mm = None
+    def fileno(self):
+        return self.sock.fileno()
+    def flush(self):
+        pass
+    
+    def _drain(self):
+        """consumes the pending wakeups"""
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error as ex:
+                if not _would_block(ex):
+                    raise
+                return
+            if not data:
+                self._eof = True
+                return
+    
+    def _notify(self):
+        """wakes up the other party"""
+        try:
+            self.sock.send(b"\x00")
+        except socket.error as ex:
+            # a full socket buffer means there are wakeups pending anyway
+            if not _would_block(ex):
+                raise
+    
+    def pending(self):
+        """returns the number of bytes already received but not yet read"""
+        return self.inring.available()
+    
+    def poll(self, timeout = None):
+        """waits up to `timeout` seconds until reading would not block, i.e., 
+        until there is data to read or the other party has closed"""
+        if timeout is not None:
+            deadline = default_timer() + timeout
+        while True:
+            closed = self._eof or self.inring.is_closed()
+            if self.inring.available() or closed:
+                return True
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - default_timer()
+                if remaining <= 0:
+                    return False
+            if select([self.sock], [], [], remaining)[0]:
+                self._drain()
+    
+    def read(self, count):
+        chunks = []
+        while count > 0:
+            data = self.inring.read(count)
+            if data:
+                chunks.append(data)
+                count -= len(data)
+            elif self._eof or self.inring.is_closed():
+                if not self.inring.available():
+                    break
+            else:
+                self.poll()
+        if count > 0 and not chunks:
             raise EOFError()
-        return data
+        return b"".join(chunks)
+    
+    def _peer_closed(self):
+        if self._eof or self.outring.is_closed():
+            return True
+        if select([self.sock], [], [], 0)[0]:
+            try:
+                return not self.sock.recv(1, socket.MSG_PEEK)
+            except socket.error as ex:
+                if not _would_block(ex):
+                    raise
+        return False
+    
+    def _put(self, data):
+        written = self.outring.write(data)
+        delay = self.MIN_SPACE_WAIT
+        while written < len(data):
+            # wake the reader up so it drains the ring
+            self._notify()
+            while not self.outring.free():
+                if self._peer_closed():
+                    raise EOFError("the other party has closed")
+                time.sleep(delay)
+                delay = min(delay * 2, self.MAX_SPACE_WAIT)
+            written += self.outring.write(data[written:])
     
     def write(self, data):
-        while data:
-            buf = data[:self.CHUNK]
-            select([], [self.sock], [], None) # wait until writable
-            sent = self.sock.send(buf)
-            data = data[sent:]
+        self._put(data)
+        self._notify()
+    
+    def writev(self, buffers):
+        """writes a sequence of buffers, waking the reader up only once"""
+        for buf in buffers:
+            self._put(buf)
+        self._notify()
 
 
 class SocketTransport(Transport):
@@ -381,8 +1161,7 @@ class SocketTransport(Transport):
             self.infile.sock_port, self.infile.peer_host, self.infile.peer_port)
     
     def _get_compression_threshold(self):
-        #return 4 * 1024
-        return -1
+        return 4 * 1024
     
     @classmethod
     def connect(cls, host, port):
@@ -392,6 +1171,38 @@ class SocketTransport(Transport):
         return cls(SocketFile(sock))
 
 
+class UnixSocketTransport(Transport):
+    """implementation of a unix-domain socket-backed transport, for parties 
+    that run on the same host"""
+    def __init__(self, sockfile):
+        Transport.__init__(self, sockfile, sockfile)
+    def __repr__(self):
+        return "<UnixSocketTransport %s>" % (self.infile.sock_host or self.infile.peer_host,)
+    
+    @classmethod
+    def connect(cls, path):
+        return cls(SocketFile.connect_unix(path))
+    @classmethod
+    def from_socket(cls, sock):
+        return cls(SocketFile(sock))
+
+
+class SharedMemoryTransport(Transport):
+    """implementation of a transport that exchanges frames through shared 
+    memory (see SharedMemoryFile), for parties that run on the same host"""
+    def __init__(self, shmfile):
+        Transport.__init__(self, shmfile, shmfile)
+    def __repr__(self):
+        return "<SharedMemoryTransport %s>" % (self.infile.path,)
+    
+    @classmethod
+    def connect(cls, path, ring_size = SharedMemoryFile.RING_SIZE):
+        return cls(SharedMemoryFile.connect(path, ring_size))
+    @classmethod
+    def from_socket(cls, sock):
+        return cls(SharedMemoryFile.from_socket(sock))
+
+
 class SslSocketTransport(Transport):
     """implementation of an SSL socket-backed transport"""
     def __init__(self, sslsockfile):
@@ -423,6 +1234,9 @@ class ProcTransport(WrappedTransport):
     from_proc() factory methods.
     """
     
+    # whether close() leaves the child process to be reaped by a thread
+    reap_in_background = False
+    
     def __init__(self, proc, transport):
         WrappedTransport.__init__(self, transport)
         self.proc = proc
@@ -430,15 +1244,48 @@ class ProcTransport(WrappedTransport):
         return "<ProcTransport pid=%s (%s)>" % (self.proc.pid, "alive" if self.proc.poll() is None else "terminated")
     
     def close(self, grace_period = 0.7):
-        """closes the transport and kills the child process, should it not die
-        within the given grace period"""
+        """closes the transport, upon which the child process is expected to 
+        die, and waits for it (unless reap_in_background is set). should it 
+        not die within the given grace period, it is terminated (SIGTERM), 
+        and should it still be alive after another grace period, killed 
+        (SIGKILL)"""
         WrappedTransport.close(self)
-        self.proc.send_signal(signal.SIGINT)
-        tend = time.time() + grace_period
-        while self.proc.poll() is None and time.time() <= tend:
-            time.sleep(0.1)
-        if self.proc.poll() is None:
-            self.proc.terminate()
+        if self.proc.poll() is not None:
+            return
+        if self.reap_in_background:
+            thd = threading.Thread(target = self._reap, args = (grace_period,))
+            thd.daemon = True
+            thd.start()
+        else:
+            self._reap(grace_period)
+    
+    def _reap(self, grace_period):
+        # a blocking wait, which returns as soon as the child is gone
+        reaped = threading.Event()
+        killer = threading.Thread(target = self._kill, args = (grace_period, reaped))
+        killer.daemon = True
+        killer.start()
+        try:
+            self.proc.wait()
+        finally:
+            reaped.set()
+            # so that the killer does not outlive the child (daemon threads 
+            # that are still waiting at interpreter shutdown produce spurious
+            # errors)
+            killer.join()
+    
+    def _kill(self, grace_period, reaped):
+        """terminates the child, should it not be reaped within the grace 
+        period, and kills it, should it not be reaped within another one"""
+        for signal_func in (self.proc.terminate, self.proc.kill):
+            reaped.wait(grace_period)
+            if reaped.is_set():
+                return
+            try:
+                signal_func()
+            except OSError:
+                # already gone
+                pass
     
     def enable_compression(self):
         return False
@@ -447,17 +1294,24 @@ class ProcTransport(WrappedTransport):
     def from_executable(cls, filename, args = ("-m", "lib")):
         """spawn the given executable wit the given arguments. expected to be 
         a library-mode Agnos server"""
+        return cls.from_proc(cls.spawn(filename, args))
+    
+    @staticmethod
+    def spawn(filename, args = ("-m", "lib")):
+        """spawns the given executable with the given arguments, returning the
+        subprocess.Popen instance (see from_proc)"""
         if isinstance(filename, str):
             cmdline = [filename]
         else:
-            cmdline = filename
+            cmdline = list(filename)
         cmdline.extend(args)
-        proc = Popen(cmdline, shell = False, stdin = PIPE, stdout = PIPE)
-        return cls.from_proc(proc)
+        return Popen(cmdline, shell = False, stdin = PIPE, stdout = PIPE)
 
     @classmethod
     def from_proc(cls, proc):
-        """connect to a running subprocess.Popen instance"""
+        """connect to a running subprocess.Popen instance. a port number of 0 
+        means the server listens on the unix-domain socket given as its host,
+        and SHM_PORT means it expects shared memory connections there"""
         if proc.poll() is not None:
             raise ValueError("process terminated with exit code %r" % (proc.poll(),))
         if proc.stdout.readline().strip() != "AGNOS":
@@ -465,10 +1319,108 @@ class ProcTransport(WrappedTransport):
         host = proc.stdout.readline().strip()
         port = int(proc.stdout.readline().strip())
         proc.stdout.close()
-        transport = SocketTransport.connect(host, port)
+        if port == SHM_PORT:
+            transport = SharedMemoryTransport.connect(host)
+        elif port == 0:
+            transport = UnixSocketTransport.connect(host)
+        else:
+            transport = SocketTransport.connect(host, port)
         return cls(proc, transport)
 
 
+class ProcPool(object):
+    """
+    a pool of library-mode servers (see ProcTransport), spawned ahead of 
+    time: get() hands out a ProcTransport to a server that has already 
+    started (and been connected to), and spawns a replacement in the 
+    background, so that `size` servers are kept ready or starting. should 
+    none be ready, get() waits for one that is starting, or spawns one 
+    itself. the transports it hands out belong to their users, who close 
+    them as usual; their servers are then reaped in the background
+    """
+    
+    def __init__(self, filename, args = ("-m", "lib"), size = 4):
+        self.filename = filename
+        self.args = args
+        self.size = size
+        self._ready = deque()
+        self._starting = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        with self._cond:
+            self._replenish()
+    def __repr__(self):
+        return "<ProcPool %r (%d ready, %d starting)>" % (self.filename, 
+            len(self._ready), self._starting)
+    def __enter__(self):
+        return self
+    def __exit__(self, t, v, tb):
+        self.close()
+    
+    def _replenish(self):
+        # called with the lock held; servers start in parallel, each spawned
+        # by a thread of its own
+        while len(self._ready) + self._starting < self.size:
+            self._starting += 1
+            thd = threading.Thread(target = self._start_server)
+            thd.daemon = True
+            thd.start()
+    
+    def _start_server(self):
+        try:
+            trans = self._spawn()
+        except Exception:
+            # get() spawns a server by itself, which reports the error
+            trans = None
+        with self._cond:
+            self._starting -= 1
+            if trans is not None and not self._closed:
+                self._ready.append(trans)
+                trans = None
+            self._cond.notify_all()
+        if trans is not None:
+            trans.close()
+    
+    def _spawn(self):
+        trans = ProcTransport.from_executable(self.filename, self.args)
+        trans.reap_in_background = True
+        return trans
+    
+    def get(self):
+        """returns a ProcTransport to a (new) library-mode server"""
+        trans = None
+        with self._cond:
+            while trans is None:
+                if self._closed:
+                    raise ValueError("pool is closed")
+                if self._ready:
+                    trans = self._ready.popleft()
+                    if trans.proc.poll() is not None:
+                        # the server has died while waiting
+                        trans.close()
+                        trans = None
+                elif self._starting:
+                    self._cond.wait()
+                else:
+                    break
+            self._replenish()
+        if trans is None:
+            trans = self._spawn()
+        return trans
+    
+    def close(self):
+        """closes the pool and the servers it holds (but not the ones it has
+        handed out). servers that are still starting are closed once they 
+        have started"""
+        with self._cond:
+            self._closed = True
+            ready = list(self._ready)
+            self._ready.clear()
+            self._cond.notify_all()
+        for trans in ready:
+            trans.close()
+
+
 #===============================================================================
 # transport factory
 #===============================================================================
@@ -505,6 +1457,62 @@ class SocketTransportFactory(TransportFactory):
         return self.sock.fileno()
 
 
+def _listen_unix(path, backlog):
+    """returns a unix-domain socket that listens at the given path. it is 
+    bound to a temporary name, and renamed into place once it listens, so 
+    that clients that wait for the file to appear are not refused"""
+    tmppath = "%s.%d" % (path, os.getpid())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        sock.bind(tmppath)
+        sock.listen(backlog)
+        # (replacing the stale socket file of a previous server, if any)
+        os.rename(tmppath, path)
+    except Exception:
+        sock.close()
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    return sock
+
+class UnixSocketTransportFactory(TransportFactory):
+    """unix-domain socket-backed transport factory. the socket file is 
+    removed when the factory is closed. for compatibility with the library
+    mode protocol, `host` is the path and `port` is 0"""
+    
+    def __init__(self, path, backlog = 10):
+        self.sock = _listen_unix(path, backlog)
+        self.path = path
+        self.host, self.port = path, 0
+    def accept(self):
+        return UnixSocketTransport.from_socket(self.sock.accept()[0])
+    def close(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class SharedMemoryTransportFactory(UnixSocketTransportFactory):
+    """shared memory-backed transport factory. clients connect on the 
+    unix-domain socket at `path` to hand over the shared memory. for the 
+    library mode protocol, `host` is the path and `port` is SHM_PORT"""
+    
+    def __init__(self, path, backlog = 10):
+        UnixSocketTransportFactory.__init__(self, path, backlog)
+        self.port = SHM_PORT
+    def accept(self):
+        return SharedMemoryTransport.from_socket(self.sock.accept()[0])
+
+
 class SslSocketTransportFactory(TransportFactory):
     """SSL socket-backed transport factory"""
 
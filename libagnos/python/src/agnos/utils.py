@@ -24,6 +24,7 @@ import sys
 import os
 import time
 import traceback
+from struct import Struct
 try:
     long
 except NameError:
@@ -32,11 +33,6 @@ try:
     basestring
 except NameError:
     basestring = str
-try:
-    from zlib import decompressobj
-except ImportError:
-    def decompressobj():
-        raise ImportError("zlib is not supported")
 
 
 class RLock(object):
@@ -173,7 +169,7 @@ class HeteroMap(object):
     def itervalues(self):
         return (v[0] for v in self.fields.values())
     def iterfields(self):
-        for k, v in self.fields.iteritems():
+        for k, v in self.fields.items():
             vv, kp, vp = v
             yield k, kp, vv, vp
     def keys(self):
@@ -283,7 +279,7 @@ class Logger(object):
         t0 = datetime.now()
         line = self.LINE_FORMAT.format(
             level = level, 
-            source = self.name, 
+            source = self.name or "", 
             text = text, 
             pid = os.getpid(), 
             tid = threading.current_thread().ident,
@@ -316,6 +312,57 @@ StdoutLogger = Logger(StdoutSink)
 StderrLogger = Logger(StderrSink)
 
 
+#===============================================================================
+# varints (zigzag-encoded, 7 bits per byte, least significant group first)
+#===============================================================================
+_BYTE = Struct("B")
+_VARINT_BYTES = [_BYTE.pack(i) for i in range(0x80)]
+# the size of the largest varint of a 64-bit integer
+MAX_VARINT_SIZE = 10
+
+def pack_varint(n):
+    """returns the varint encoding of the (signed) integer n"""
+    n = (n << 1) if n >= 0 else ((~n) << 1) | 1
+    if n < 0x80:
+        return _VARINT_BYTES[n]
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _unzigzag(n):
+    return (n >> 1) if not n & 1 else ~(n >> 1)
+
+def unpack_varint_from(buffer, offset, end):
+    """decodes a varint at the given offset of the buffer, which ends at 
+    `end`. returns (value, offset after the varint)"""
+    n = shift = 0
+    while True:
+        if offset >= end:
+            raise EOFError("request to read more than available")
+        b = _BYTE.unpack_from(buffer, offset)[0]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return _unzigzag(n), offset
+        shift += 7
+
+def read_varint(stream):
+    """reads a varint from the given stream, one byte at a time"""
+    n = shift = 0
+    while True:
+        data = stream.read(1)
+        if not data:
+            raise EOFError("incomplete varint")
+        b = _BYTE.unpack(data)[0]
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return _unzigzag(n)
+        shift += 7
+
+
 class BoundedStream(object):
     """a fixed-length input stream (file-like object)"""
     
@@ -360,60 +407,234 @@ class BoundedStream(object):
         """same as read(), only it does not return the buffer.
         if count < 0, skips all the unread data"""
         self.read(count)
+    
+    def unpack_struct(self, st):
+        """reads and unpacks the given struct.Struct"""
+        data = self.read(st.size)
+        if len(data) < st.size:
+            raise EOFError("request to read more than available")
+        return st.unpack(data)
+    
+    def unpack_varint(self):
+        """reads and decodes a varint"""
+        return read_varint(self)
 
 
-class ZlibStream(object):
+class FrameReader(object):
     """
-    a version of encodings.zlib_codec.StreamReader that actually works
+    a cursor over a frame that has been received in full. primitives are 
+    unpacked in-place (struct.unpack_from) at the current offset, so reading 
+    a field does not copy or touch the underlying stream
     """
+    __slots__ = ["buffer", "offset", "length"]
+    
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+        self.length = len(buffer)
     
-    def __init__(self, stream, underlying_read_size = 1024):
+    def available(self):
+        """returns the number of remaining, unread bytes""" 
+        return self.length - self.offset
+    
+    def close(self):
+        self.buffer = None
+        self.offset = self.length = 0
+    
+    def read(self, count = -1):
+        """reads `count` bytes at the current offset. if count is negative, 
+        reads all the remaining data"""
+        offset = self.offset
+        if count < 0:
+            end = self.length
+        else:
+            end = offset + count
+            if end > self.length:
+                raise EOFError("request to read more than available")
+        self.offset = end
+        return self.buffer[offset:end]
+    
+    def skip(self, count):
+        """same as read(), only it does not return the buffer.
+        if count < 0, skips all the unread data"""
+        if count < 0 or self.offset + count > self.length:
+            self.offset = self.length
+        else:
+            self.offset += count
+    
+    def unpack_struct(self, st):
+        """unpacks the given struct.Struct at the current offset"""
+        offset = self.offset
+        if offset + st.size > self.length:
+            raise EOFError("request to read more than available")
+        self.offset = offset + st.size
+        return st.unpack_from(self.buffer, offset)
+    
+    def unpack_varint(self):
+        """decodes a varint at the current offset"""
+        value, self.offset = unpack_varint_from(self.buffer, self.offset, self.length)
+        return value
+
+
+class DecompressingStream(object):
+    """
+    an input stream that incrementally decompresses the data it reads from an
+    underlying (compressed) stream. the decompressed output is limited to 
+    `length` bytes: the decompressor is never asked for more than that, so 
+    a small compressed frame cannot inflate beyond its declared size. the 
+    output is decompressed in blocks into a reusable buffer, from which reads 
+    are served.
+    
+    `decompressor` is a compression.Decompressor; `initial_data` is compressed
+    data that has already been read from the underlying stream
+    """
+    
+    def __init__(self, stream, decompressor, length, initial_data = b"",
+            underlying_read_size = 16*1024, block_size = 64*1024):
         self.stream = stream
+        self.decompressor = decompressor
+        self.remaining_length = length
         self.underlying_read_size = underlying_read_size
-        self.buffer = ""
-        self.decompressobj = decompressobj()
+        self.block_size = block_size
+        self._unproduced = length
+        self._input = initial_data
+        self._buffer = bytearray()
+        self._pos = 0
+    
+    def available(self):
+        """returns the number of remaining, unread bytes""" 
+        return self.remaining_length
     
     def close(self):
+        if self.stream is None:
+            return
         self.stream.close()
+        self.stream = None
+        self.decompressor = None
+        self._buffer = None
     
-    def read(self, count):
-        if self.decompressobj is None:
-            return ""
-        while len(self.buffer) < count:
-            chunk = self.stream.read(self.underlying_read_size)
-            if not chunk:
-                self.buffer += self.decompressobj.flush()
-                self.decompressobj = None
-                break
-            self.buffer += self.decompressobj.decompress(chunk)
-        data = self.buffer[:count]
-        self.buffer = self.buffer[:count]
+    def _produce(self, count):
+        """decompresses (at least) `count` more bytes into the buffer"""
+        if self._pos > 0:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        while self._unproduced > 0 and len(self._buffer) < count:
+            if self.decompressor.needs_input and not self._input:
+                self._input = self.stream.read(self.underlying_read_size)
+                if not self._input:
+                    self.decompressor.finish()
+                    if self.decompressor.needs_input:
+                        raise EOFError("compressed data is truncated")
+            max_length = min(count - len(self._buffer) + self.block_size, self._unproduced)
+            data = self.decompressor.decompress(self._input, max_length)
+            self._input = b""
+            self._buffer += data
+            self._unproduced -= len(data)
+    
+    def read(self, count = -1):
+        """reads up to `count` bytes of decompressed data. if count is 
+        negative, reads all the available data"""
+        if count < 0 or count > self.remaining_length:
+            count = self.remaining_length
+        if len(self._buffer) - self._pos < count:
+            self._produce(count)
+        pos = self._pos
+        data = memoryview(self._buffer)[pos:pos + count].tobytes()
+        self._pos = pos + len(data)
+        self.remaining_length -= len(data)
         return data
+    
+    def skip(self, count):
+        """same as read(), only it does not return the buffer.
+        if count < 0, skips all the unread data"""
+        self.read(count)
+    
+    def unpack_struct(self, st):
+        """reads and unpacks the given struct.Struct"""
+        data = self.read(st.size)
+        if len(data) < st.size:
+            raise EOFError("request to read more than available")
+        return st.unpack(data)
+    
+    def unpack_varint(self):
+        """reads and decodes a varint"""
+        return read_varint(self)
 
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+class ChunkedStream(object):
+    """
+    an input stream over a message that has been sent as a sequence of frames
+    (chunks). the chunks are read on demand, so only the current one is held
+    in memory. `next_chunk` is called to read the next chunk, and returns 
+    (stream, more), where `more` tells whether further chunks follow
+    """
+    
+    def __init__(self, stream, next_chunk):
+        self.stream = stream
+        self.next_chunk = next_chunk
+        self.more = True
+    
+    def _advance(self):
+        """moves on to the next chunk; returns False at the end of the 
+        message"""
+        if not self.more:
+            return False
+        self.stream.close()
+        # should next_chunk fail (e.g., the message has been aborted), the 
+        # message is over
+        self.more = False
+        self.stream, self.more = self.next_chunk()
+        return True
+    
+    def available(self):
+        """returns the number of remaining, unread bytes, or None if it is 
+        not known yet (more chunks follow)"""
+        if self.more:
+            return None
+        return self.stream.available()
+    
+    def close(self):
+        if self.stream is None:
+            return
+        try:
+            while self._advance():
+                pass
+            self.stream.close()
+        finally:
+            self.stream = None
+    
+    def read(self, count = -1):
+        """reads `count` bytes, possibly spanning several chunks. if count is
+        negative, reads all the remaining data of the message"""
+        parts = []
+        while count != 0:
+            n = self.stream.available()
+            if count > 0 and n > count:
+                n = count
+            if n:
+                parts.append(self.stream.read(n))
+                if count > 0:
+                    count -= n
+            if count != 0 and not self._advance():
+                break
+        if count > 0:
+            raise EOFError("request to read more than available")
+        return b"".join(parts)
+    
+    def skip(self, count):
+        """same as read(), only it does not return the buffer.
+        if count < 0, skips all the unread data"""
+        self.read(count)
+    
+    def unpack_struct(self, st):
+        """reads and unpacks the given struct.Struct"""
+        if self.stream.available() >= st.size:
+            return self.stream.unpack_struct(st)
+        return st.unpack(self.read(st.size))
+    
+    def unpack_varint(self):
+        """reads and decodes a varint, possibly spanning chunks"""
+        if self.stream.available() >= MAX_VARINT_SIZE:
+            return self.stream.unpack_varint()
+        return read_varint(self)
@@ -30,10 +30,12 @@ class TargetTest(unittest.TestCase):
             self.fail("external process failed")
         return stdout, stderr
 
-    def run_agnosc(self, target, filename, outdir):
+    def run_agnosc(self, target, filename, outdir, options = ()):
         print "agnosc %s --> %s" % (filename, outdir)
-        self.run_cmdline([sys.executable, "compiler/bin/agnosc", "-t", target, 
-            "-o", outdir, filename], cwd = self.ROOT_DIR)
+        cmdline = [sys.executable, "compiler/bin/agnosc", "-t", target, "-o", outdir]
+        for opt in options:
+            cmdline.extend(["-O", opt])
+        self.run_cmdline(cmdline + [filename], cwd = self.ROOT_DIR)
 
 
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""runs the async client against the server listening on the unix-domain 
+socket given as the argument; with "overloaded" as the second argument, tests
+a server that admits only two invocations at a time instead"""
+import sys
+import asyncio
+import agnos
+from datetime import datetime
+import FeatureTest_bindings as FeatureTest
+
+
+async def main(path):
+    async with await FeatureTest.AsyncClient.connect_unix(path) as conn:
+        assert conn._utils.transport.wire_format == 2
+        
+        eve = await conn.Person.init("eve", None, None)
+        adam = await conn.Person.init("adam", None, None)
+        await eve.marry(adam)
+        assert await eve.name == "eve"
+        try:
+            await adam.marry(eve)
+        except FeatureTest.MartialStatusError:
+            pass
+        else:
+            assert False, "expected MartialStatusError"
+        assert await adam.think(17, 4) == 17 / 4
+        try:
+            await adam.think(17, 0)
+        except agnos.GenericException:
+            pass
+        else:
+            assert False, "expected GenericException"
+        # oneway invocations have no reply, even when they fail
+        assert await adam.divorce() is None
+        assert await adam.divorce() is None
+        
+        # many requests in flight at once
+        results = await asyncio.gather(*[conn.hmap_test(i, agnos.HeteroMap()) 
+            for i in range(10)])
+        assert [hm["a"] for hm in results] == list(range(10))
+        
+        assert await conn.enable_chunking(64 * 1024)
+        blob = b"\xff\xee\xaa\xbb" * 100000
+        everything = await conn.func_of_everything(
+            1, 2, 3, 4, 5.5, True, datetime.now(), blob, "hello world", 
+            [1.3] * 100000, set([18,19,20]), {34:"foo", 56:"bar"}, 
+            FeatureTest.Address(FeatureTest.State.NY, "albany", "foobar drive", 1772),
+            eve, FeatureTest.MyEnum.C)
+        assert everything.some_buffer == blob
+        assert len(everything.some_list) == 100000
+    print("OK")
+
+
+async def overloaded(path):
+    async with await FeatureTest.AsyncClient.connect_unix(path) as conn:
+        results = await asyncio.gather(*[conn.hmap_test(i, agnos.HeteroMap()) 
+            for i in range(10)], return_exceptions = True)
+        assert [hm["a"] for hm in results[:2]] == [0, 1]
+        for exc in results[2:]:
+            assert isinstance(exc, agnos.ServerOverloaded), exc
+            assert exc.retry_after == 0.1
+        # the rejected invocations were not carried out, so they can be retried
+        hm = await conn.hmap_test(9, agnos.HeteroMap())
+        assert hm["a"] == 9
+    print("OK")
+
+
+if __name__ == "__main__":
+    if sys.argv[2:] == ["overloaded"]:
+        asyncio.run(overloaded(sys.argv[1]))
+    else:
+        asyncio.run(main(sys.argv[1]))
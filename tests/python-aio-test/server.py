@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import asyncio
+from agnos import HeteroMap
+from agnos.aio import server_main
+from datetime import datetime
+import FeatureTest_bindings as FeatureTest
+
+
+class Person(object):
+    def __init__(self, name, father, mother):
+        self.name = name
+        self.date_of_birth = datetime.now()
+        self.father = father
+        self.mother = mother
+        self.spouse = None
+        self.address = FeatureTest.Address(FeatureTest.State.TX, "dallas", "cranberry rd", 6772)
+    
+    def marry(self, partner):
+        if self.spouse:
+            raise FeatureTest.MartialStatusError("already married", self)
+        if partner.spouse:
+            raise FeatureTest.MartialStatusError("already married", partner)
+        self.spouse = partner
+        partner.spouse = self
+    
+    async def think(self, a, b):
+        await asyncio.sleep(0)
+        return a / b
+
+
+class Handler(FeatureTest.IHandler):
+    async def Person_init(self, name, father, mother):
+        return Person(name, father, mother)
+    
+    async def func_of_everything(self, a, b, c, d, e, f, g, h, i, j, k, l, m, n, o):
+        return FeatureTest.Everything(a, b, c, d, e, f, g, h, i, j, k, l, m, n)
+    
+    async def hmap_test(self, a, b):
+        # replies are sent as soon as they are ready: the later the request,
+        # the sooner its reply
+        await asyncio.sleep(max(0, 10 - a) * 0.02)
+        hm = HeteroMap()
+        hm["a"] = a
+        hm["b"] = 18
+        return hm
+
+
+if __name__ == "__main__":
+    server_main(FeatureTest.AsyncProcessorFactory(Handler()))
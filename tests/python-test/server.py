@@ -1,5 +1,7 @@
 #!/usr/bin/env python
-from agnos import HeteroMap
+import os
+import time
+from agnos import HeteroMap, remaining_time
 from datetime import datetime
 import FeatureTest_bindings as FeatureTest
 
@@ -73,6 +75,13 @@ class Handler(FeatureTest.IHandler):
         hm = HeteroMap()
         hm["a"] = a
         hm["b"] = 18
+        if "remaining_time" in b:
+            remaining = remaining_time()
+            hm["remaining_time"] = -1.0 if remaining is None else remaining
+        if "pid" in b:
+            hm["pid"] = os.getpid()
+        if "sleep" in b:
+            time.sleep(b["sleep"])
         return hm
 
 
@@ -1,6 +1,13 @@
 import sys
+import os
+import socket
+import tempfile
+import threading
+import time
 import agnos 
 from datetime import datetime
+from distutils.spawn import find_executable
+from agnos.servers import PriorityExecutor
 from base import TargetTest
 
 
@@ -16,11 +23,487 @@ class FeatureTestClient(TargetTest):
         
         try:
             self.mytest(conn)
+            self.deadline_test(conn)
+            self.async_test(conn)
+            self.batch_test(conn)
+            self.oneway_test(conn)
         finally:
             conn.close()
+        
+        conn = FeatureTest.Client.connect_executable(self.REL("tests/python-test/server.py"),
+            ["-m", "lib", "--pipeline", "4"])
+        try:
+            self.mytest(conn)
+            self.pipelined_test(conn)
+            self.oneway_test(conn, ordered = False)
+            self.deadline_test(conn)
+            self.priority_test(conn)
+        finally:
+            conn.close()
+        
+        # the threads of a multiplexed client have their calls in flight at 
+        # the same time
+        conn = FeatureTest.Client.connect_executable(self.REL("tests/python-test/server.py"),
+            ["-m", "lib", "--pipeline", "4"], multiplexed = True)
+        try:
+            self.assertTrue(isinstance(conn._utils, agnos.MultiplexedClientUtils))
+            self.mytest(conn)
+            self.pipelined_test(conn)
+            self.overlap_test(conn)
+            self.async_test(conn)
+            self.batch_test(conn)
+        finally:
+            conn.close()
+        
+        if hasattr(socket, "AF_UNIX"):
+            path = os.path.join(tempfile.mkdtemp(), "agnos.sock")
+            conn = FeatureTest.Client.connect_executable(self.REL("tests/python-test/server.py"),
+                ["-m", "lib", "--unix", path])
+            try:
+                self.assertTrue(isinstance(conn._utils.transport.transport, agnos.UnixSocketTransport))
+                hm2 = conn.hmap_test(1999, agnos.HeteroMap())
+                self.assertEquals(hm2["a"], 1999)
+            finally:
+                conn.close()
+            
+            path = os.path.join(tempfile.mkdtemp(), "agnos-shm.sock")
+            conn = FeatureTest.Client.connect_executable(self.REL("tests/python-test/server.py"),
+                ["-m", "lib", "--shm", path])
+            try:
+                self.assertTrue(isinstance(conn._utils.transport.transport, agnos.SharedMemoryTransport))
+                blob = "\xff\xee\xaa\xbb" * 1000000
+                self.assertEquals(conn.func_of_everything(
+                    1, 2, 3, 4, 5.5, True, datetime.now(), blob, "hello world", 
+                    [1.3], set([18]), {34:"foo"}, 
+                    FeatureTest.Address(FeatureTest.State.NY, "albany", "foobar drive", 1772),
+                    None, FeatureTest.MyEnum.C).some_buffer, blob)
+            finally:
+                conn.close()
+            self.shm_handshake_test()
+
+        self.proc_pool_test()
+        self.proc_reap_test()
+        
+        if hasattr(socket, "AF_UNIX"):
+            self.compression_codecs_test()
+            self.selecting_server_test()
+            self.pooled_server_test()
+            self.prefork_server_test()
+            self.worker_limits_test()
+            self.client_pool_test()
+        
+        python3 = find_executable("python3")
+        if python3:
+            self.aio_test(python3)
+
+    def shm_handshake_test(self):
+        # the server maps only the files that the client has created as 
+        # shared mappings, not whatever file the client names
+        SharedMemoryFile = agnos.transports.SharedMemoryFile
+        fd, victim = tempfile.mkstemp(prefix = "agnos-", suffix = ".shm", 
+            dir = SharedMemoryFile._directory())
+        os.close(fd)
+        try:
+            for path in [victim, os.path.join(tempfile.mkdtemp(), "agnos-x.shm"), "/etc/passwd"]:
+                sock1, sock2 = socket.socketpair()
+                try:
+                    sock1.sendall("4096 %s\n" % (path,))
+                    self.assertRaises((IOError, OSError), SharedMemoryFile.from_socket, sock2)
+                finally:
+                    sock1.close()
+                    sock2.close()
+            self.assertEquals(os.path.getsize(victim), 0)
+        finally:
+            os.unlink(victim)
+
+    def compression_codecs_test(self):
+        # bz2 is not supported where its output cannot be bounded (python 2)
+        compression = agnos.compression
+        if compression.bz2 is None:
+            return
+        if not hasattr(compression.bz2.BZ2Decompressor(), "needs_input"):
+            self.assertFalse("bz2" in compression.supported_codecs())
+        # frames compressed with a codec that has not been negotiated are 
+        # refused
+        sock1, sock2 = socket.socketpair()
+        trans1 = agnos.SocketTransport.from_socket(sock1)
+        trans2 = agnos.SocketTransport.from_socket(sock2)
+        try:
+            trans1.compression_codec = compression.Bz2Codec()
+            trans1.compression_threshold = 1
+            with trans1.writing(1):
+                trans1.write("x" * 1000)
+            self.assertRaises(compression.CompressionError, trans2.begin_read)
+        finally:
+            trans1.close()
+            trans2.close()
+
+    def proc_pool_test(self):
+        with agnos.ProcPool(self.REL("tests/python-test/server.py"), size = 2) as pool:
+            pids = set()
+            for i in range(4):
+                conn = FeatureTest.Client.connect_pool(pool)
+                try:
+                    self.assertEquals(conn.hmap_test(i, agnos.HeteroMap())["a"], i)
+                    pids.add(conn._utils.transport.proc.pid)
+                finally:
+                    conn.close()
+            # every connection gets a server of its own
+            self.assertEquals(len(pids), 4)
+
+    def proc_reap_test(self):
+        # a child that ignores SIGTERM is killed after the second grace period
+        from subprocess import Popen, PIPE
+        proc = Popen([sys.executable, "-c", "import signal, sys, time\n"
+            "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+            "sys.stdout.write('ready\\n'); sys.stdout.flush()\n"
+            "time.sleep(60)\n"], stdout = PIPE)
+        self.assertEquals(proc.stdout.readline().strip(), "ready")
+        trans = agnos.ProcTransport.__new__(agnos.ProcTransport)
+        trans.proc = proc
+        t0 = time.time()
+        trans._reap(0.2)
+        self.assertTrue(time.time() - t0 < 3)
+        self.assertTrue(proc.poll() is not None)
+        proc.stdout.close()
+
+    def spawn_unix_server(self, *args):
+        path = os.path.join(tempfile.mkdtemp(), "agnos-server.sock")
+        proc = self.spawn([sys.executable, self.REL("tests/python-test/server.py"), 
+            "--unix", path] + list(args))
+        for i in range(50):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+        return proc, path
+
+    def pooled_server_test(self):
+        proc, path = self.spawn_unix_server("-m", "pooled", "--workers", "2")
+        try:
+            conn1 = FeatureTest.Client.connect_unix(path)
+            conn2 = FeatureTest.Client.connect_unix(path)
+            # no worker is free, so this client waits in the queue
+            conn3 = FeatureTest.Client.connect_unix(path, checked = False)
+            try:
+                self.assertEquals(conn2.hmap_test(2, agnos.HeteroMap())["a"], 2)
+                conn1.close()
+                self.assertEquals(conn3.hmap_test(3, agnos.HeteroMap())["a"], 3)
+            finally:
+                conn2.close()
+                conn3.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def client_pool_test(self):
+        proc, path = self.spawn_unix_server("-m", "threaded")
+        try:
+            pool = agnos.ClientPool(FeatureTest.Client, [path], min_size = 1, 
+                max_size = 2, validate_after = 0)
+            try:
+                with pool.client() as conn1:
+                    self.assertEquals(conn1.hmap_test(1, agnos.HeteroMap())["a"], 1)
+                # idle clients are lent out again (after a ping)
+                with pool.client() as conn2:
+                    self.assertTrue(conn2 is conn1)
+                    conn3 = pool.get()
+                    self.assertTrue(conn3 is not conn1)
+                    # no more than max_size clients per endpoint
+                    self.assertRaises(agnos.TransportTimeout, pool.get, 0.2)
+                    conn3.close()
+                    pool.put(conn3)
+                # the closed client fails the ping, and is replaced
+                conn4 = pool.get()
+                conn5 = pool.get()
+                self.assertTrue(conn4 is conn1)
+                self.assertTrue(conn5 is not conn3)
+                self.assertEquals(conn5.hmap_test(5, agnos.HeteroMap())["a"], 5)
+                pool.put(conn4)
+                pool.put(conn5)
+                stats = pool.get_stats()
+                self.assertEquals(stats["connected"], 3)
+                self.assertEquals(stats["broken"], 1)
+                self.assertEquals(stats["endpoints"][path], dict(idle = 2, lent = 0))
+                # the client is returned on any error
+                def interrupted():
+                    with pool.client():
+                        raise KeyboardInterrupt()
+                self.assertRaises(KeyboardInterrupt, interrupted)
+                self.assertEquals(pool.get_stats()["endpoints"][path], dict(idle = 1, lent = 0))
+            finally:
+                pool.close()
+            # an endpoint that cannot be connected to is backed off, and the 
+            # others are connected to instead
+            dead = os.path.join(tempfile.mkdtemp(), "agnos-dead.sock")
+            pool = agnos.ClientPool(FeatureTest.Client, [dead, path], max_size = 1)
+            try:
+                conn1 = pool.get()
+                self.assertEquals(conn1.hmap_test(1, agnos.HeteroMap())["a"], 1)
+                # rather than raising the error, wait for the client
+                self.assertRaises(agnos.TransportTimeout, pool.get, 0.2)
+                pool.put(conn1)
+                stats = pool.get_stats()
+                self.assertEquals(stats["connect_failed"], 1)
+                self.assertEquals(stats["endpoints"][dead], dict(idle = 0, lent = 0))
+            finally:
+                pool.close()
+            # with no other endpoint, the error is raised
+            pool = agnos.ClientPool(FeatureTest.Client, [dead])
+            try:
+                self.assertRaises(IOError, pool.get)
+                self.assertRaises(IOError, pool.get)
+                self.assertEquals(pool.get_stats()["connect_failed"], 1)
+            finally:
+                pool.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def prefork_server_test(self):
+        proc, path = self.spawn_unix_server("-m", "prefork", "--workers", "2")
+        try:
+            conns = [FeatureTest.Client.connect_unix(path) for i in range(2)]
+            try:
+                for i, conn in enumerate(conns):
+                    self.assertEquals(conn.hmap_test(i, agnos.HeteroMap())["a"], i)
+                conns[0].close()
+                # the worker goes back to accepting once its client is done
+                conn = FeatureTest.Client.connect_unix(path)
+                conns.append(conn)
+                self.assertEquals(conn.hmap_test(3, agnos.HeteroMap())["a"], 3)
+            finally:
+                for conn in conns:
+                    conn.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+        # SIGTERM shuts the server (and its workers) down cleanly
+        self.assertFalse(os.path.exists(path))
+
+    def worker_limits_test(self):
+        hm = agnos.HeteroMap()
+        hm["pid"] = True
+        def serving_pid(path):
+            conn = FeatureTest.Client.connect_unix(path)
+            try:
+                # along with the 3 requests of the handshake
+                return [conn.hmap_test(i, hm)["pid"] for i in range(2)][0]
+            finally:
+                conn.close()
+        # a worker is replaced once it has served 5 requests
+        proc, path = self.spawn_unix_server("-m", "prefork", "--workers", "1", 
+            "--max-requests", "5")
+        try:
+            self.assertNotEquals(serving_pid(path), serving_pid(path))
+        finally:
+            proc.terminate()
+            proc.wait()
+        # the pool notices the limit once it accepts a client, which it still
+        # serves. its replacement serves the next clients, while the old 
+        # connection is still open
+        proc, path = self.spawn_unix_server("-m", "pooled", "--workers", "2",
+            "--max-requests", "5")
+        try:
+            conn = FeatureTest.Client.connect_unix(path)
+            try:
+                # (each request is counted before the next one is replied to)
+                pid = [conn.hmap_test(i, hm)["pid"] for i in range(4)][0]
+                self.assertEquals(serving_pid(path), pid)
+                self.assertNotEquals(serving_pid(path), pid)
+                self.assertEquals(conn.hmap_test(4, hm)["pid"], pid)
+            finally:
+                conn.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def aio_test(self, python3):
+        self.run_agnosc("python", "tests/features.xml", "tests/python-aio-test", ["asyncio"])
+        # a synchronous client and an asyncio server (in library mode)
+        conn = FeatureTest.Client.connect_executable([python3, 
+            self.REL("tests/python-aio-test/server.py")])
+        try:
+            self.mytest(conn)
+        finally:
+            conn.close()
+        # an asyncio client and server
+        path = os.path.join(tempfile.mkdtemp(), "agnos-aio.sock")
+        proc = self.spawn([python3, self.REL("tests/python-aio-test/server.py"), 
+            "-m", "async", "--unix", path])
+        try:
+            for i in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            stdout, stderr = self.run_cmdline([python3, 
+                self.REL("tests/python-aio-test/client.py"), path])
+            self.assertEquals(stdout.strip(), "OK")
+        finally:
+            proc.terminate()
+            proc.wait()
+        # invocations beyond the limit are turned down as overloaded
+        path = os.path.join(tempfile.mkdtemp(), "agnos-aio.sock")
+        proc = self.spawn([python3, self.REL("tests/python-aio-test/server.py"), 
+            "-m", "async", "--unix", path, "--max-in-flight", "2"])
+        try:
+            for i in range(50):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.1)
+            stdout, stderr = self.run_cmdline([python3, 
+                self.REL("tests/python-aio-test/client.py"), path, "overloaded"])
+            self.assertEquals(stdout.strip(), "OK")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def selecting_server_test(self):
+        proc, path = self.spawn_unix_server("-m", "selecting")
+        try:
+            # a client that has sent an incomplete frame must not stall the others
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stalled.connect(path)
+            stalled.send("\x00\x00\x00")
+            conns = [FeatureTest.Client.connect_unix(path) for i in range(3)]
+            try:
+                for i, conn in enumerate(conns):
+                    hm2 = conn.hmap_test(i, agnos.HeteroMap())
+                    self.assertEquals(hm2["a"], i)
+                blob = "\xff\xee\xaa\xbb" * 200000
+                self.assertEquals(conns[0].func_of_everything(
+                    1, 2, 3, 4, 5.5, True, datetime.now(), blob, "hello world", 
+                    [1.3], set([18]), {34:"foo"}, 
+                    FeatureTest.Address(FeatureTest.State.NY, "albany", "foobar drive", 1772),
+                    None, FeatureTest.MyEnum.C).some_buffer, blob)
+            finally:
+                for conn in conns:
+                    conn.close()
+                stalled.close()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def pipelined_test(self, conn):
+        # several threads sharing a connection, whose replies may arrive out
+        # of order
+        results = {}
+        def worker(i):
+            results[i] = [conn.hmap_test(i * 100 + j, agnos.HeteroMap())["a"] 
+                for j in range(20)]
+        threads = [threading.Thread(target = worker, args = (i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(4):
+            self.assertEquals(results[i], [i * 100 + j for j in range(20)])
+
+    def overlap_test(self, conn):
+        # the calls of a multiplexed connection run in parallel on the server,
+        # and a fast call is not held up by a slow one
+        hm = agnos.HeteroMap()
+        hm["sleep"] = 0.5
+        elapsed = {}
+        def worker(i, hm):
+            t0 = time.time()
+            conn.hmap_test(i, hm)
+            elapsed[i] = time.time() - t0
+        threads = [threading.Thread(target = worker, args = (i, hm)) for i in range(2)]
+        threads.append(threading.Thread(target = worker, args = (2, agnos.HeteroMap())))
+        t0 = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(time.time() - t0 < 0.9)
+        self.assertTrue(elapsed[2] < 0.3)
+
+    def priority_test(self, conn):
+        funcs = conn.get_service_info(agnos.INFO_FUNCTIONS)
+        annotations = [info["annotations"] for info in funcs.values() 
+            if info["name"] == "hmap_test"]
+        self.assertEquals(annotations, [{"priority" : "10"}])
+        # queued tasks of higher priorities are carried out first
+        executor = PriorityExecutor(1)
+        started = threading.Event()
+        release = threading.Event()
+        def blocker():
+            started.set()
+            release.wait()
+        executor.submit(blocker)
+        started.wait()
+        order = []
+        for i, priority in enumerate([0, 10, 0, 5]):
+            executor.submit_prioritized(priority, order.append, i)
+        release.set()
+        executor.shutdown()
+        self.assertEquals(order, [1, 3, 0, 2])
+        stats = executor.get_stats()
+        self.assertEquals(stats[0]["completed"], 3)
+        self.assertEquals(stats[0]["max_queued"], 2)
+        self.assertEquals(stats[10]["completed"], 1)
+
+    def async_test(self, conn):
+        # the requests are all sent before any of the replies is collected
+        futures = [conn.hmap_test_async(i, agnos.HeteroMap()) for i in range(100)]
+        self.assertEquals([hm["a"] for hm in agnos.gather(futures)], range(100))
+        adam = conn.Person.init("adam", None, None)
+        futures = [adam.think_async(17, 2), adam.think_async(17, 0)]
+        self.assertFalse(agnos.wait_all(futures))
+        self.assertEquals(futures[0].result(), 8.5)
+        self.assertTrue(isinstance(futures[1].exception(), agnos.GenericException))
+        self.assertRaises(agnos.GenericException, agnos.gather, futures)
+        # a reply that has not arrived within the time waited for it may be 
+        # waited for again, until the call's own timeout passes
+        hm = agnos.HeteroMap()
+        hm["sleep"] = 0.3
+        fut = conn.hmap_test_async(5, hm, _timeout = 10)
+        self.assertRaises(agnos.TransportTimeout, fut.result, 0)
+        self.assertRaises(agnos.TransportTimeout, agnos.wait_all, [fut], 0.05)
+        self.assertFalse(fut.done())
+        self.assertEquals(fut.result()["a"], 5)
+        fut = conn.hmap_test_async(6, hm, _timeout = 0.05)
+        self.assertTrue(isinstance(fut.exception(5), agnos.TransportTimeout))
+        self.assertEquals(conn.hmap_test(7, agnos.HeteroMap())["a"], 7)
+
+    def batch_test(self, conn):
+        adam = conn.Person.init("adam", None, None)
+        with conn.batch() as b:
+            results = [b.hmap_test(i, agnos.HeteroMap()) for i in range(100)]
+            eve = b.Person.init("eve", None, None)
+            thoughts = [b.proxy(adam).think(17, 2), b.proxy(adam).think(17, 0)]
+            self.assertFalse(results[0].done())
+        self.assertEquals(len(b), 103)
+        self.assertEquals([hm["a"] for hm in agnos.gather(results)], range(100))
+        self.assertEquals(eve.result().name, "eve")
+        self.assertEquals(thoughts[0].result(), 8.5)
+        # the failure of an invocation does not affect the others
+        self.assertTrue(isinstance(thoughts[1].exception(), agnos.GenericException))
+        self.assertRaises(ValueError, b.hmap_test, 1, agnos.HeteroMap())
+
+    def oneway_test(self, conn, ordered = True):
+        adam = conn.Person.init("adam", None, None)
+        eve = conn.Person.init("eve", None, None)
+        adam.marry(eve)
+        self.assertEquals(adam.divorce(), None)
+        if ordered:
+            # the requests are carried out in order
+            self.assertEquals(adam.spouse, None)
+        # the failure of a oneway invocation is not reported
+        eve.divorce()
+        self.assertEquals(adam.think(17, 2), 8.5)
+
+    def deadline_test(self, conn):
+        # the timeout is passed on to the handler as its deadline
+        hm = agnos.HeteroMap()
+        hm["remaining_time"] = True
+        self.assertEquals(conn.hmap_test(1, hm)["remaining_time"], -1.0)
+        remaining = conn.hmap_test(1, hm, _timeout = 10)["remaining_time"]
+        self.assertTrue(0 < remaining <= 10)
 
     def mytest(self, conn):
         conn.assert_service_compatibility();
+        self.assertEquals(conn._utils.transport.wire_format, 2)
 
         eve = conn.Person.init("eve", None, None)
         adam = conn.Person.init("adam", None, None)
@@ -44,6 +527,24 @@ class FeatureTestClient(TargetTest):
         hm1["x"] = "y"
         hm2 = conn.hmap_test(1999, hm1)
         self.assertEquals(hm2["a"], 1999)
+        
+        self.assertTrue(conn.enable_compression())
+        blob = "\xff\xee\xaa\xbb" * 100000
+        everything = conn.func_of_everything(
+            1, 2, 3, 4, 5.5, True, datetime.now(), blob, "hello world" * 1000, 
+            [1.3, FeatureTest.pi, 4.4], set([18,19,20]), {34:"foo", 56:"bar"}, 
+            FeatureTest.Address(FeatureTest.State.NY, "albany", "foobar drive", 1772),
+            eve, FeatureTest.MyEnum.C)
+        self.assertEquals(everything.some_buffer, blob)
+        
+        self.assertTrue(conn.enable_chunking(64 * 1024))
+        everything = conn.func_of_everything(
+            1, 2, 3, 4, 5.5, True, datetime.now(), blob, "hello world" * 100000, 
+            [1.3] * 100000, set([18,19,20]), {34:"foo", 56:"bar"}, 
+            FeatureTest.Address(FeatureTest.State.NY, "albany", "foobar drive", 1772),
+            eve, FeatureTest.MyEnum.C)
+        self.assertEquals(everything.some_buffer, blob)
+        self.assertEquals(len(everything.some_list), 100000)
 
         
         